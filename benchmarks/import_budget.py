@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Import-time budget check for run-radiopadre.
+
+Each run-radiopadre mode (local venv, docker, singularity, remote, k8s, in-container, nbconvert) only imports
+the modules it needs. This script imports each mode's module set in a fresh interpreter under "python -X importtime",
+reports the total import time (the best of several runs, since this is noisy), lists the heaviest top-level
+imports, and exits with a non-zero status if any mode exceeds its budget.
+
+Usage:
+    python benchmarks/import_budget.py [MODE ...] [--repeat N] [--budget MODE=MS ...] [--top N]
+"""
+import os, sys, subprocess, argparse, re, tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# what bin/run-radiopadre imports before it knows what mode it is in. Keep these lists in step with the script.
+PROLOGUE = ["argparse", "glob", "pickle", "iglesia", "radiopadre_client.config", "radiopadre_client.default_config",
+            "iglesia.utils", "iglesia.logger", "iglesia.certificates", "iglesia.profiler"]
+
+# recent session management, only done by interactive front-end invocations
+FRONTEND = ["radiopadre_client.sessions"]
+
+# mode -> (list of modules, budget in milliseconds)
+MODES = {
+    "venv":         (PROLOGUE + FRONTEND + ["radiopadre_client.server", "radiopadre_client.backends.venv"], 150),
+    "docker":       (PROLOGUE + FRONTEND + ["radiopadre_client.server", "radiopadre_client.backends.docker"], 150),
+    "singularity":  (PROLOGUE + FRONTEND + ["radiopadre_client.server", "radiopadre_client.backends.singularity"], 150),
+    "remote":       (PROLOGUE + FRONTEND + ["radiopadre_client.remote"], 250),
+    "remote-side":  (PROLOGUE + ["radiopadre_client.server", "radiopadre_client.backends.docker"], 120),
+    "container":    (PROLOGUE + ["radiopadre_client.server", "radiopadre_client.backends.venv"], 120),
+    "nbconvert":    (PROLOGUE + ["radiopadre_client.server", "radiopadre_client.backends.docker"], 120),
+    "k8s":          (PROLOGUE + FRONTEND + ["radiopadre_client.kube"], 1500),
+}
+
+_importtime_re = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)")
+_error_re = re.compile(r"^\w+(Error|Exception): ")
+
+
+def measure(modules, exclude=()):
+    """
+    Imports modules in a fresh interpreter with -X importtime.
+
+    :param exclude: top-level modules to leave out of the total (i.e. those imported by interpreter startup)
+    :return:        total time in ms, and list of (cumulative ms, module) for top-level imports
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join([REPO_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+        env['RADIOPADRE_DIR'] = tmpdir  # iglesia creates this on import
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+                              cwd=tmpdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+    if proc.returncode:
+        errors = [line for line in proc.stderr.split("\n") if _error_re.match(line)]
+        raise RuntimeError(errors[0] if errors else f"exit code {proc.returncode}")
+    toplevel = []
+    for line in proc.stderr.split("\n"):
+        match = _importtime_re.match(line)
+        # top-level imports are indented by a single space, nested ones by more
+        if match and len(match.group(3)) == 1 and match.group(4) not in exclude:
+            toplevel.append((int(match.group(2)) / 1000., match.group(4)))
+    return sum(ms for ms, _ in toplevel), toplevel
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks run-radiopadre import times against per-mode budgets")
+    parser.add_argument("modes", nargs="*", metavar="MODE", help=f"modes to check: {', '.join(MODES)}. Default is all.")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs per mode, best is taken. Default 5.")
+    parser.add_argument("--budget", action="append", default=[], metavar="MODE=MS",
+                        help="override budget (in milliseconds) for a mode.")
+    parser.add_argument("--top", type=int, default=5, help="number of heaviest imports to list per mode.")
+    options = parser.parse_args()
+
+    budgets = {mode: budget for mode, (_, budget) in MODES.items()}
+    for override in options.budget:
+        mode, ms = override.split("=", 1)
+        if mode not in MODES:
+            parser.error(f"unknown mode {mode}")
+        budgets[mode] = float(ms)
+
+    unknown = set(options.modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown mode(s): {', '.join(unknown)}")
+
+    # modules imported by the interpreter itself are not counted
+    startup = {name for _, name in measure(["sys"])[1]} - {"sys"}
+
+    failed = []
+    for mode in options.modes or MODES:
+        modules = MODES[mode][0]
+        try:
+            runs = [measure(modules, exclude=startup) for _ in range(options.repeat)]
+        except RuntimeError as exc:
+            print(f"{mode:12} FAILED to import: {exc}")
+            failed.append(mode)
+            continue
+        total, toplevel = min(runs)
+        status = "ok" if total <= budgets[mode] else "OVER BUDGET"
+        print(f"{mode:12} {total:8.1f} ms  (budget {budgets[mode]:.0f} ms)  {status}")
+        for ms, name in sorted(toplevel, reverse=True)[:options.top]:
+            print(f"    {ms:8.1f} ms  {name}")
+        if total > budgets[mode]:
+            failed.append(mode)
+
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark for message() (iglesia.logger), with console output only, log file output only, and both,
+with the log file written out by a background thread (threaded) or by the caller (unthreaded). Console output is
+always written by the caller, so the console-only numbers serve as a baseline.
+
+Each configuration runs in a fresh interpreter (since the logger is set up once per process), with the console
+output going to the given file (/dev/null by default; use e.g. /dev/tty to see the effect of a real terminal),
+and the log file going to a temporary RADIOPADRE_DIR (or the given directory, to try e.g. an NFS mount). Two rates
+are reported: the rate at which the caller gets through its message() calls, and the rate at which the output is
+actually written out (i.e. including the final logger.flush()).
+
+Usage:
+    python benchmarks/logger_throughput.py [--messages N] [--repeat N] [--console FILE] [--logdir DIR]
+"""
+import os, sys, time, json, argparse, tempfile, subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ["console", "file", "both"]
+
+
+def child(mode, threaded, num_messages, result_file):
+    """Runs one configuration, writes caller and total times to result_file"""
+    sys.path.insert(0, REPO_DIR)
+    from iglesia import logger
+    from iglesia.utils import message
+
+    logger.init("radiopadre.bench", threaded=threaded)
+    if mode != "console":
+        logger.enable_logfile("bench")
+    if mode == "file":
+        logger.disable_printing()
+
+    start = time.perf_counter()
+    for i in range(num_messages):
+        message(f"kernel output line {i}: the quick brown fox jumps over the lazy dog")
+    caller = time.perf_counter() - start
+    logger.flush()
+    total = time.perf_counter() - start
+    with open(result_file, "wt") as f:
+        json.dump(dict(caller=caller, total=total), f)
+
+
+def run(mode, threaded, options):
+    """Runs configuration in a fresh interpreter, returns best caller and total times"""
+    best = None
+    for _ in range(options.repeat):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            result_file = os.path.join(tmpdir, "result.json")
+            env = dict(os.environ, RADIOPADRE_DIR=tempfile.mkdtemp(dir=options.logdir or tmpdir))
+            with open(options.console, "wt") as console:
+                subprocess.check_call([sys.executable, __file__, "--child", mode, str(int(threaded)),
+                                       str(options.messages), result_file], stdout=console, env=env)
+            result = json.load(open(result_file))
+        best = result if best is None else {key: min(best[key], result[key]) for key in best}
+    return best
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        mode, threaded, num_messages, result_file = sys.argv[2:]
+        return child(mode, bool(int(threaded)), int(num_messages), result_file)
+
+    parser = argparse.ArgumentParser(description="Benchmarks the throughput of message()")
+    parser.add_argument("--messages", type=int, default=100000, help="number of messages, default %(default)s.")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs, best is taken. Default %(default)s.")
+    parser.add_argument("--console", type=str, default=os.devnull, metavar="FILE",
+                        help="where console output goes, default %(default)s.")
+    parser.add_argument("--logdir", type=str, metavar="DIR",
+                        help="directory to put log files under, default is a temporary directory.")
+    options = parser.parse_args()
+
+    print(f"{options.messages} messages, console output to {options.console}")
+    print(f"    {'':8}  {'backend':10}  {'caller':>14}  {'written out':>14}")
+    for mode in MODES:
+        for threaded in False, True:
+            result = run(mode, threaded, options)
+            print(f"    {mode:8}  {'threaded' if threaded else 'unthreaded':10}  "
+                  f"{options.messages / result['caller']:10,.0f} /s  {options.messages / result['total']:10,.0f} /s")
+
+
+if __name__ == "__main__":
+    main()
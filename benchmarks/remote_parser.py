@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark for the parser of remote session output (radiopadre_client.remote_parser).
+
+Replays transcripts of remote sessions (one line of remote output per line, as captured from "run-radiopadre -v"
+with the "host: " prefix stripped) through the parser, and reports lines per second. For comparison, the same
+lines are also fed through the per-line logic the remote reader used before (a dict of substrings for dispatch,
+then a series of re.match calls with the ports regex formed up anew for every line). Without transcripts, a
+synthetic one is generated: a session startup followed by chatty kernel output.
+
+Usage:
+    python benchmarks/remote_parser.py [TRANSCRIPT ...] [--lines N] [--repeat N]
+"""
+import os, sys, re, time, argparse, tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault('RADIOPADRE_DIR', tempfile.mkdtemp())   # iglesia creates this on import
+
+from iglesia.helpers import NUM_PORTS
+from radiopadre_client import remote_parser
+
+_welcome_regex = re.compile("Welcome to the radiopadre client (.*)!")
+
+
+def version_extracter(line):
+    match = _welcome_regex.search(line)
+    return match.group(1) if match else None
+
+
+def synthetic_transcript(num_lines):
+    ports = ":".join(str(port) for port in range(9000, 9000 + NUM_PORTS * 2))
+    startup = [
+        "Welcome to the radiopadre client release 1.2.4!",
+        "radiopadre: radiopadre is running on host node17",
+        "radiopadre: using docker backend",
+        f"radiopadre:   Selected ports: {ports}",
+        "radiopadre:   Session ID/notebook token is '0123456789abcdef0123456789abcdef'",
+        "radiopadre: Browse to URL: http://localhost:9002/?token=0123456789abcdef0123456789abcdef",
+        "[I 12:00:00.000 NotebookApp] The jupyter notebook server is running at: http://localhost:9000/"]
+    chatter = [
+        "[I 12:00:01.123 NotebookApp] Kernel started: 5d1e3f1a-2c3b-4a5d-9e8f-7a6b5c4d3e2f, name: python3",
+        "[I 12:00:02.456 NotebookApp] Saving file at /notebooks/radiopadre-default.ipynb",
+        "radiopadre: WARNING: image cube.fits has no WCS, using pixel coordinates",
+        "[W 12:00:03.789 NotebookApp] 404 GET /static/js9/js9prefs.js (127.0.0.1) 1.23ms",
+        "radiopadre: DEBUG: rendering thumbnail 17 of 240",
+        "[I 12:00:04.012 NotebookApp] Starting buffering for 5d1e3f1a-2c3b:0a1b2c3d",
+        "radiopadre: ERROR: unable to read casa table /data/obs.ms/SPECTRAL_WINDOW"]
+    return startup + [chatter[i % len(chatter)] for i in range(num_lines)]
+
+
+_dispatch_message = {': WARNING: ': "warning", ': ERROR: ': "error", ': DEBUG:': "debug"}
+
+
+def legacy_parse(lines):
+    """The per-line logic of the remote reader before remote_parser, minus the actions"""
+    running = False
+    for line in lines:
+        for key, dispatch in _dispatch_message.items():
+            if key in line:
+                break
+        version_extracter(line)
+        re.match(r".*radiopadre is running on host ([^\s]+)", line)
+        if not running:
+            if re.match(".*Session ID/notebook token is '([0-9a-f]+)'", line):
+                continue
+            re_ports = ":".join([r"([\d]+)"]*(NUM_PORTS*2))
+            if re.match(rf".*Selected ports: {re_ports}[\s]*$", line):
+                continue
+            if re.match(r".*Browse to URL: ([^\s\033]+)", line):
+                continue
+            if "jupyter notebook server is running" in line:
+                running = True
+    return running
+
+
+def parse(lines):
+    parser = remote_parser.RemoteOutputParser(version_extracter)
+    for line in lines:
+        remote_parser.dispatcher(line)
+        parser.parse(line)
+    return parser.running
+
+
+def best_rate(func, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(lines)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the parser of remote session output")
+    parser.add_argument("transcripts", nargs="*", metavar="TRANSCRIPT", help="transcript file(s) to replay.")
+    parser.add_argument("--lines", type=int, default=200000,
+                        help="number of lines of kernel output in the synthetic transcript, default %(default)s.")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs, best is taken. Default %(default)s.")
+    options = parser.parse_args()
+
+    if options.transcripts:
+        transcripts = [(name, open(name).read().rstrip().split("\n")) for name in options.transcripts]
+    else:
+        transcripts = [("synthetic", synthetic_transcript(options.lines))]
+
+    for name, lines in transcripts:
+        if not parse(lines):
+            print(f"{name}: warning, no 'jupyter notebook server is running' line found")
+        legacy = best_rate(legacy_parse, lines, options.repeat)
+        new = best_rate(parse, lines, options.repeat)
+        print(f"{name}: {len(lines)} lines")
+        print(f"    legacy parser   {legacy:12,.0f} lines/s")
+        print(f"    remote_parser   {new:12,.0f} lines/s   ({new / legacy:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -68,7 +68,7 @@ class PadreError(RuntimeError):
         super(PadreError, self).__init__(message)
         error(message)
 
-from .helpers import init_helpers, register_helpers, kill_helpers
+from .helpers import init_helpers, register_helpers, kill_helpers, detach_process
 
 def init():
     """Initialize padre runtime environment, and setup globals describing it"""
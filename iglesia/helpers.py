@@ -1,19 +1,29 @@
-import os, sys, subprocess, atexit, traceback, getpass, tempfile, psutil, stat, uuid
+import os, sys, subprocess, atexit, traceback, getpass, stat, uuid, time, threading
 from radiopadre_client.config import RADIOPADRE_VENV, NUM_PORTS
 
 import iglesia
 from iglesia import PadreError
-from .utils import find_which, chdir, find_unused_ports, DEVZERO, DEVNULL, \
+from .utils import find_which, find_unused_ports, DEVZERO, DEVNULL, \
     message, warning, error, debug
-from . import logger
+from . import logger, profiler
+
+# seconds to wait for a helper to come up before giving up on it. Nothing blocks on this: helpers are
+# watched in the background, so the Jupyter server can start while they are coming up
+HELPER_WAIT = 60
 
 _child_processes = []
 
 _child_resources = []
 
+# child processes meant to outlive us (see detach_process)
+_detached_pids = set()
+
 
 def init_helpers(radiopadre_base, verbose=False, run_http=True, interactive=True, certificate=None):
-    """Starts up helper processes, if they are not already running"""
+    """
+    Starts up helper processes, if they are not already running. Helpers are launched concurrently,
+    and their readiness is monitored (and reported) in the background.
+    """
     # set ports, else allocate ports
     selected_ports = os.environ.get('RADIOPADRE_SELECTED_PORTS')
     if selected_ports:
@@ -103,100 +113,158 @@ def init_helpers(radiopadre_base, verbose=False, run_http=True, interactive=True
     #     else:
     #         debug("wetty should be running (pid {})".format(os.environ["RADIOPADRE_WETTY_PID"]))
 
+    # collect helpers that need to be started, as (name, pid_envvar, port, use_ssl, startup_function) tuples
+    startups = []
+
     # run JS9 helper
     if interactive and iglesia.JS9_DIR:
         if 'RADIOPADRE_JS9HELPER_PID' not in os.environ:
-            try:
-                js9helper = iglesia.JS9_DIR + "/js9Helper.js"
-
-                if not os.path.exists(iglesia.JS9_DIR):
-                    raise PadreError(f"{iglesia.JS9_DIR} does not exist")
-                if not os.path.exists(js9helper):
-                    raise PadreError(f"{js9helper} does not exist")
-
-                js9prefs = iglesia.SESSION_DIR + "/js9prefs.js"
-                if not in_container:
-                    # create JS9 settings file (in container mode, this is created and mounted inside container already)
-                    open(js9prefs, "w").write(f"JS9Prefs.globalOpts.helperPort = {iglesia.JS9HELPER_PORT};\n")
-                    debug(f"  writing {js9prefs} with helperPort={iglesia.JS9HELPER_PORT}")
-
-                # message(f"Starting {js9helper} on port {helper_port} in {iglesia.SHADOW_ROOTDIR}")
-                nodejs = find_which("nodejs") or find_which("node")
-                if not nodejs:
-                    raise PadreError("unable to find nodejs or node -- can't run js9helper.")
-                try:
-                    js9_opts = [nodejs.strip(), js9helper,
-                                f'{{"helperPort": {helper_port}, "debug": {iglesia.VERBOSE}, ' +
-                                f'"fileTranslate": ["^(http://localhost:[0-9]+/[0-9a-f]+{iglesia.ABSROOTDIR}|/static/)", ""] }}']
-                    message(f"Starting in {iglesia.SHADOW_ROOTDIR}: {' '.join(js9_opts)}")
-                    with chdir(iglesia.SHADOW_ROOTDIR):
-                        _child_processes.append(subprocess.Popen(js9_opts, 
-                                                stdin=DEVZERO, stdout=stdout, stderr=stderr))
-                        os.environ['RADIOPADRE_JS9HELPER_PID'] = str(_child_processes[-1].pid)
-                        message("  started as PID {}".format(_child_processes[-1].pid))
-                except Exception as exc:
-                    error(f"error running {nodejs} {js9helper}: {exc}")
-            except PadreError:
-                pass
+            startups.append(("JS9 helper", 'RADIOPADRE_JS9HELPER_PID', helper_port, False,
+                             lambda: _start_js9helper(helper_port, in_container, stdout, stderr)))
         else:
             debug("JS9 helper should be running (pid {})".format(os.environ["RADIOPADRE_JS9HELPER_PID"]))
 
     if run_http:
         if 'RADIOPADRE_HTTPSERVER_PID' not in os.environ:
-            message(f"Starting HTTP server process in {iglesia.SHADOW_HOME} on port {http_port}")
-            server = find_which("radiopadre-http-server.py")
-            if server:
-                server_opts = [server, str(http_port)] + http_rewrites
-                if certificate:
-                    server_opts.append(certificate)
-                if in_docker:
-                    server_opts.append("0.0.0.0")
-                message(f"Starting in {iglesia.SHADOW_HOME}: {' '.join(server_opts)}")
-                with chdir(iglesia.SHADOW_HOME):
-                    _child_processes.append(subprocess.Popen(server_opts, stdin=DEVZERO)) #,  stdout=stdout, stderr=stderr))
-                    os.environ['RADIOPADRE_HTTPSERVER_PID'] = str(_child_processes[-1].pid)
-                    message("  started as PID {}".format(_child_processes[-1].pid))
-            else:
-                error("HTTP server script radiopadre-http-server.py not found, functionality will be restricted")
+            startups.append(("HTTP server", 'RADIOPADRE_HTTPSERVER_PID', http_port, bool(certificate),
+                             lambda: _start_http_server(http_port, http_rewrites, certificate, in_docker)))
         else:
             debug("HTTP server should be running (pid {})".format(os.environ["RADIOPADRE_HTTPSERVER_PID"]))
 
     if interactive:
         if 'RADIOPADRE_CARTA_PID' not in os.environ:
-            # find CARTA backend or CARTA app
-            carta_exec = find_which('carta_backend')
-
-            if not carta_exec or not os.path.exists(carta_exec):
-                warning(f"CARTA backend not found, omitting")
-            else:
-                # assume 2.x or higher (i.e. carta_backend is in use)
-                iglesia.CARTA_VERSION = ">=2"
-
-                carta_dir = os.environ.get('RADIOPADRE_CARTA_DIR') or os.path.dirname(os.path.dirname(carta_exec))
-                message(f"Running CARTA {iglesia.CARTA_VERSION} backend {carta_exec} (in dir {carta_dir})")
-                carta_env = None
-
-                carta_dir = iglesia.ABSROOTDIR
-                cmdline = [carta_exec, f"--port={carta_port}", "--no_browser", # "--debug_no_auth",
-                            f"--top_level_folder={iglesia.ABSROOTDIR}" ]
-                # explicit frontend for packaged versions
-                if not carta_exec.endswith("appimage"): 
-                    cmdline.append(f"--frontend_folder=/usr/share/carta/frontend")
-                carta_stdout, carta_stderr = sys.stdout, sys.stderr
-                # use our session ID as the auth token for CARTA
-                carta_env = os.environ.copy()
-                carta_env['CARTA_AUTH_TOKEN'] = str(uuid.UUID(session_id))
-
-                message(f"Starting: {' '.join(cmdline)}")
-                with chdir(carta_dir):
-                    _child_processes.append(subprocess.Popen(cmdline, stdin=subprocess.PIPE,  stdout=carta_stdout, stderr=carta_stderr, shell=False, env=carta_env))
-                    os.environ['RADIOPADRE_CARTA_PID'] = str(_child_processes[-1].pid)
-                    ## doesn't exit cleanly, let it be eaten rather
-                    # atexit.register(_exit_carta, _child_processes[-1])
-                    message("  started as PID {}".format(_child_processes[-1].pid))
+            startups.append(("CARTA backend", 'RADIOPADRE_CARTA_PID', carta_port, False,
+                             lambda: _start_carta(carta_port, session_id)))
         else:
             debug("CARTA backend should be running (pid {})".format(os.environ["RADIOPADRE_CARTA_PID"]))
 
+    _launch_helpers(startups)
+
+
+def _launch_helpers(startups):
+    """
+    Runs helper startup functions concurrently, so that slow lookups and launches do not serialize behind
+    each other. Each helper that is launched gets a background thread watching for it to come up.
+    """
+    if not startups:
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    t0 = time.time()
+    with ThreadPoolExecutor(len(startups)) as executor:
+        futures = [executor.submit(startup) for _, _, _, _, startup in startups]
+
+    for (name, envvar, port, use_ssl, _), future in zip(startups, futures):
+        try:
+            proc = future.result()
+        except Exception as exc:
+            error(f"error starting {name}: {exc}")
+            proc = None
+        if proc is None:
+            continue
+        _child_processes.append(proc)
+        os.environ[envvar] = str(proc.pid)
+        message(f"  {name} started as PID {proc.pid}")
+        threading.Thread(target=_watch_helper, args=(name, proc, port, use_ssl, t0), daemon=True).start()
+
+
+def _watch_helper(name, proc, port, use_ssl, t0):
+    """Waits for a helper to start responding on its port, and reports its startup latency"""
+    from .readiness import ServerProbe, await_servers
+    probe = ServerProbe(name, port, use_ssl=use_ssl)
+    await_servers([probe], process=proc, wait=HELPER_WAIT)
+    if probe.ready is not None:
+        profiler.record(f"helper: {name}", t0)
+        message(f"  {name} is up on port {port} ({time.time() - t0:.2f} secs after launch)")
+    elif proc.poll() is not None:
+        warning(f"{name} exited with code {proc.returncode} before coming up")
+    else:
+        warning(f"{name} is not responding on port {port} after {HELPER_WAIT} secs, carrying on without it")
+
+
+def _start_js9helper(helper_port, in_container, stdout, stderr):
+    """Starts the JS9 helper. Returns Popen object, or None if not started"""
+    try:
+        js9helper = iglesia.JS9_DIR + "/js9Helper.js"
+
+        if not os.path.exists(iglesia.JS9_DIR):
+            raise PadreError(f"{iglesia.JS9_DIR} does not exist")
+        if not os.path.exists(js9helper):
+            raise PadreError(f"{js9helper} does not exist")
+
+        js9prefs = iglesia.SESSION_DIR + "/js9prefs.js"
+        if not in_container:
+            # create JS9 settings file (in container mode, this is created and mounted inside container already)
+            open(js9prefs, "w").write(f"JS9Prefs.globalOpts.helperPort = {iglesia.JS9HELPER_PORT};\n")
+            debug(f"  writing {js9prefs} with helperPort={iglesia.JS9HELPER_PORT}")
+
+        # message(f"Starting {js9helper} on port {helper_port} in {iglesia.SHADOW_ROOTDIR}")
+        nodejs = find_which("nodejs") or find_which("node")
+        if not nodejs:
+            raise PadreError("unable to find nodejs or node -- can't run js9helper.")
+        try:
+            js9_opts = [nodejs.strip(), js9helper,
+                        f'{{"helperPort": {helper_port}, "debug": {iglesia.VERBOSE}, ' +
+                        f'"fileTranslate": ["^(http://localhost:[0-9]+/[0-9a-f]+{iglesia.ABSROOTDIR}|/static/)", ""] }}']
+            message(f"Starting in {iglesia.SHADOW_ROOTDIR}: {' '.join(js9_opts)}")
+            # note that cwd= is used rather than chdir(), since other helpers are being started concurrently
+            return subprocess.Popen(js9_opts, cwd=iglesia.SHADOW_ROOTDIR,
+                                    stdin=DEVZERO, stdout=stdout, stderr=stderr)
+        except Exception as exc:
+            error(f"error running {nodejs} {js9helper}: {exc}")
+    except PadreError:
+        pass
+    return None
+
+
+def _start_http_server(http_port, http_rewrites, certificate, in_docker):
+    """Starts the HTTP server. Returns Popen object, or None if not started"""
+    message(f"Starting HTTP server process in {iglesia.SHADOW_HOME} on port {http_port}")
+    server = find_which("radiopadre-http-server.py")
+    if not server:
+        error("HTTP server script radiopadre-http-server.py not found, functionality will be restricted")
+        return None
+    server_opts = [server, str(http_port)] + http_rewrites
+    if certificate:
+        server_opts.append(certificate)
+    if in_docker:
+        server_opts.append("0.0.0.0")
+    message(f"Starting in {iglesia.SHADOW_HOME}: {' '.join(server_opts)}")
+    return subprocess.Popen(server_opts, cwd=iglesia.SHADOW_HOME, stdin=DEVZERO) #,  stdout=stdout, stderr=stderr)
+
+
+def _start_carta(carta_port, session_id):
+    """Starts the CARTA backend. Returns Popen object, or None if not started"""
+    # find CARTA backend or CARTA app
+    carta_exec = find_which('carta_backend')
+
+    if not carta_exec or not os.path.exists(carta_exec):
+        warning(f"CARTA backend not found, omitting")
+        return None
+
+    # assume 2.x or higher (i.e. carta_backend is in use)
+    iglesia.CARTA_VERSION = ">=2"
+
+    carta_dir = os.environ.get('RADIOPADRE_CARTA_DIR') or os.path.dirname(os.path.dirname(carta_exec))
+    message(f"Running CARTA {iglesia.CARTA_VERSION} backend {carta_exec} (in dir {carta_dir})")
+    carta_env = None
+
+    carta_dir = iglesia.ABSROOTDIR
+    cmdline = [carta_exec, f"--port={carta_port}", "--no_browser", # "--debug_no_auth",
+                f"--top_level_folder={iglesia.ABSROOTDIR}" ]
+    # explicit frontend for packaged versions
+    if not carta_exec.endswith("appimage"):
+        cmdline.append(f"--frontend_folder=/usr/share/carta/frontend")
+    carta_stdout, carta_stderr = sys.stdout, sys.stderr
+    # use our session ID as the auth token for CARTA
+    carta_env = os.environ.copy()
+    carta_env['CARTA_AUTH_TOKEN'] = str(uuid.UUID(session_id))
+
+    message(f"Starting: {' '.join(cmdline)}")
+    ## doesn't exit cleanly, let it be eaten rather
+    # atexit.register(_exit_carta, proc)
+    return subprocess.Popen(cmdline, cwd=carta_dir, stdin=subprocess.PIPE, stdout=carta_stdout, stderr=carta_stderr,
+                            shell=False, env=carta_env)
+
 
 def _exit_carta(proc):
     try:
@@ -242,9 +310,24 @@ def kill_helpers():
 ## This was not brutal enough
 # atexit.register(kill_helpers)
 
+def detach_process(pid):
+    """Marks a child process as detached, so that it (and its descendants) are left running when we exit"""
+    _detached_pids.add(pid)
+
+def _is_detached(proc):
+    import psutil
+    try:
+        return any(p.pid in _detached_pids for p in [proc] + proc.parents())
+    except psutil.NoSuchProcess:
+        return False
+
 def eat_children():
+    # imported here rather than at the top, since this is only needed at exit
+    import psutil
     # ask children to terminate
     procs = psutil.Process().children(recursive=True)
+    if _detached_pids:
+        procs = [p for p in procs if not _is_detached(p)]
     if not procs:
         return
 
@@ -1,4 +1,4 @@
-import sys, os.path, logging, time, atexit, glob
+import sys, os.path, logging, logging.handlers, time, atexit, glob, queue, threading, copy
 
 logger = None
 logfile = sys.stderr
@@ -6,6 +6,18 @@ logfile_handler = None
 
 NUM_RECENT_LOGS = 5
 
+# Log file records are handed off to a background thread, which does the formatting and file I/O, so that a slow
+# (e.g. NFS-backed) log file does not hold up the caller (e.g. the asyncio loop relaying remote output). Console
+# output stays synchronous, since other code (print(), subprocesses) writes to the same stdout/stderr. QUEUE_SIZE
+# bounds the number of records in flight: past this, the caller waits for the background thread to catch up.
+QUEUE_SIZE = 10000
+
+# how long flush() waits for the background thread to write out queued records
+FLUSH_TIMEOUT = 10
+
+_threaded = True
+_queue = _queue_handler = _listener = None
+
 try:
     PipeError = BrokenPipeError
 except NameError:  # for py2
@@ -26,6 +38,23 @@ class TimestampFilter(logging.Filter):
             record.severity = ""
         return True
 
+class StreamHandler(logging.StreamHandler):
+    """
+    StreamHandler that flushes after every record only if autoflush is set. The background thread clears it,
+    and flushes whenever it runs out of queued records instead.
+    """
+    autoflush = True
+
+    def emit(self, record):
+        if self.autoflush:
+            return super(StreamHandler, self).emit(record)
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
 class MultiplexingHandler(logging.Handler):
     def __init__(self, info_stream=sys.stdout, err_stream=sys.stderr):
         super(MultiplexingHandler, self).__init__()
@@ -87,8 +116,54 @@ _boring_formatter = logging.Formatter(_default_format_boring)
 _colorful_formatter = ColorizingFormatter(_default_format)
 _default_console_handler = MultiplexingHandler()
 
-def init(appname, timestamps=True, boring=False):
-    global logger
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Hands records off to the background thread"""
+    def prepare(self, record):
+        # merge the arguments now, since they could change by the time the record is written out. Everything
+        # else (including the formatting proper) is left to the background thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        # a SimpleQueue is reentrant (so safe to log to from signal handlers), but unbounded, so we bound it here
+        while self.queue.qsize() >= QUEUE_SIZE:
+            time.sleep(0.001)
+        self.queue.put(record)
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """Background thread writing out queued records"""
+    def handle(self, record):
+        # flush() queues an Event, which is set once everything queued before it has been written out
+        if isinstance(record, threading.Event):
+            self.flush()
+            record.set()
+            return
+        for handler in self.handlers:
+            handler.handle(record)
+        if self.queue.empty():
+            self.flush()
+
+    def flush(self):
+        # ignore broken pipes, this often happens when cleaning up and exiting
+        for handler in self.handlers:
+            try:
+                handler.flush()
+            except PipeError:
+                pass
+
+
+def init(appname, timestamps=True, boring=False, threaded=True):
+    """
+    Initializes logger
+
+    :param threaded:    if True, the log file (see enable_logfile()) is written out by a background thread.
+                        If False, it is written out by the calling thread, as each record comes in.
+    """
+    global logger, _threaded
     global _default_formatter
     logging.basicConfig()
     logger = logging.getLogger(appname)
@@ -98,8 +173,24 @@ def init(appname, timestamps=True, boring=False):
     logger.addHandler(_default_console_handler)
     logger.setLevel(logging.INFO)
     logger.propagate = False
+    _threaded = threaded
     return logger
 
+def _add_file_handler(handler):
+    """Adds log file handler, via the background thread if enabled"""
+    global _queue, _queue_handler, _listener
+    if not _threaded:
+        logger.addHandler(handler)
+        return
+    if _listener is None:
+        _queue = queue.SimpleQueue()
+        _queue_handler = _QueueHandler(_queue)
+        _listener = _QueueListener(_queue)
+        _listener.start()
+    handler.autoflush = False
+    _listener.handlers += (handler,)
+    logger.addHandler(_queue_handler)
+
 def errors_to_stdout(enable=True):
     _default_console_handler.multiplex = not enable
 
@@ -118,11 +209,11 @@ def enable_logfile(logtype, verbose=False):
     datetime = time.strftime("%Y%m%d%H%M%S")
     logname = os.path.expanduser(f"{radiopadre_dir}/logs/log-{logtype}-{datetime}.txt")
     logfile = open(logname, 'wt')
-    logfile_handler = logging.StreamHandler(logfile)
+    logfile_handler = StreamHandler(logfile)
     logfile_handler.setFormatter(logging.Formatter(
                 "%(asctime)s: " + _default_format_boring,
                 "%Y-%m-%d %H:%M:%S"))
-    logger.addHandler(logfile_handler)
+    _add_file_handler(logfile_handler)
     atexit.register(flush)
 
     if verbose:
@@ -143,6 +234,12 @@ def enable_logfile(logtype, verbose=False):
 
     return logfile, logname
 
-def flush():
-    if logfile_handler:
+def flush(timeout=FLUSH_TIMEOUT):
+    """Flushes the output streams, waiting (up to timeout seconds) for queued log file records to be written out"""
+    _default_console_handler.flush()
+    if _listener is not None:
+        done = threading.Event()
+        _queue.put(done)
+        done.wait(timeout)
+    elif logfile_handler:
         logfile_handler.flush()
@@ -0,0 +1,144 @@
+"""
+Port block allocator.
+
+Allocates a contiguous block of ports in one pass. The block is held (bound and listening) until it is handed
+off to whatever will actually serve on those ports, so that other processes can't grab them in the meantime.
+Concurrent radiopadre sessions on the same host coordinate through a lockfile and a reservations file in
+RADIOPADRE_DIR, so that a block released for hand-off is not reallocated before its consumer has bound it.
+
+Each (user, key) pair (where the key is normally the directory being served) has a preferred block derived
+from a hash, so that reconnecting to the same directory usually gets the same ports (and the same browser origin,
+which keeps the browser cache warm).
+"""
+import os, os.path, socket, time, json, getpass, hashlib
+
+import iglesia
+from .utils import debug, warning, FileLock, pid_alive
+
+PORT_RANGE = (10000, 60000)     # range within which port blocks are allocated
+RESERVATION_TIMEOUT = 60        # seconds for which a released block stays reserved, giving its consumer time to bind
+
+
+def _state_files():
+    """Returns names of lockfile and reservations file. These are per-host, since RADIOPADRE_DIR may be shared"""
+    base = os.path.join(iglesia.RADIOPADRE_DIR, f"ports-{socket.gethostname()}")
+    return base + ".lock", base + ".json"
+
+
+def _lock():
+    """Returns context manager holding an exclusive lock on the port lockfile"""
+    return FileLock(_state_files()[0])
+
+
+def _load_reservations():
+    """Loads reservations file, returns dict of port -> (pid, expiry), with expired and orphaned entries dropped"""
+    _, filename = _state_files()
+    reservations = {}
+    if os.path.exists(filename):
+        try:
+            reservations = {int(port): tuple(entry) for port, entry in json.load(open(filename, "rt")).items()}
+        except Exception as exc:
+            warning(f"error reading {filename}: {exc}, ignoring")
+    now = time.time()
+    # expiry is None while the owner still holds the sockets
+    return {port: (pid, expiry) for port, (pid, expiry) in reservations.items()
+            if pid_alive(pid) and (expiry is None or expiry > now)}
+
+
+def _save_reservations(reservations):
+    _, filename = _state_files()
+    try:
+        with open(filename + ".new", "wt") as resfile:
+            json.dump({str(port): list(entry) for port, entry in reservations.items()}, resfile)
+        os.rename(filename + ".new", filename)
+    except Exception as exc:
+        warning(f"error writing {filename}: {exc}")
+
+
+def _hold_port(port):
+    """Binds and listens on port. Returns socket, or None if port is not available"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # SO_REUSEADDR lets us take over ports left in TIME_WAIT by a previous session (as the servers themselves
+    # would). Listening then makes the hold exclusive.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind(("", port))
+        sock.listen(1)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def preferred_base(num, key):
+    """Returns the preferred first port of a block of num ports for this user and key"""
+    digest = hashlib.sha1(f"{getpass.getuser()}:{key}".encode()).digest()
+    num_blocks = (PORT_RANGE[1] - PORT_RANGE[0]) // num
+    return PORT_RANGE[0] + int.from_bytes(digest[:4], "big") % num_blocks * num
+
+
+class PortBlock(object):
+    """
+    A block of reserved ports. The ports are held until release() is called, which should be done just before
+    handing them off to the processes that will serve on them.
+    """
+    def __init__(self, ports, sockets):
+        self.ports = ports
+        self._sockets = sockets
+
+    def __repr__(self):
+        return ":".join(map(str, self.ports))
+
+    def release(self):
+        """Releases the ports for hand-off. They stay reserved for RESERVATION_TIMEOUT seconds. Safe to call twice"""
+        if not self._sockets:
+            return
+        for sock in self._sockets:
+            sock.close()
+        self._sockets = []
+        with _lock():
+            reservations = _load_reservations()
+            expiry = time.time() + RESERVATION_TIMEOUT
+            for port in self.ports:
+                reservations[port] = (os.getpid(), expiry)
+            _save_reservations(reservations)
+        debug(f"released ports {self} for hand-off")
+
+
+def reserve_ports(num, key=None):
+    """
+    Reserves a contiguous block of num free ports, trying the preferred block for (user, key) first.
+
+    :param num:     number of ports
+    :param key:     key for the preferred block, e.g. the directory being served. Default is the current directory.
+    :return:        PortBlock object
+    """
+    if key is None:
+        key = os.getcwd()
+    base0 = preferred_base(num, key)
+    num_blocks = (PORT_RANGE[1] - PORT_RANGE[0]) // num
+
+    with _lock():
+        reservations = _load_reservations()
+        for i in range(num_blocks):
+            base = PORT_RANGE[0] + (base0 - PORT_RANGE[0] + i * num) % (num_blocks * num)
+            ports = list(range(base, base + num))
+            if any(port in reservations for port in ports):
+                continue
+            sockets = []
+            for port in ports:
+                sock = _hold_port(port)
+                if sock is None:
+                    break
+                sockets.append(sock)
+            if len(sockets) < num:
+                for sock in sockets:
+                    sock.close()
+                continue
+            for port in ports:
+                reservations[port] = (os.getpid(), None)
+            _save_reservations(reservations)
+            debug(f"reserved ports {ports[0]}-{ports[-1]}" + (" (preferred block)" if i == 0 else ""))
+            return PortBlock(ports, sockets)
+
+    raise RuntimeError(f"unable to find a block of {num} free ports")
@@ -0,0 +1,84 @@
+"""
+Startup phase profiler.
+
+Times the named phases of a radiopadre launch (argument parsing, backend probing, installation
+updates, port allocation, helper startup, etc.), writes a JSON trace to {RADIOPADRE_DIR}/logs,
+and prints a summary table once startup is complete. Disabled (and nearly free) unless enable()
+is called, which run-radiopadre does when --profile-startup is given.
+"""
+import os, os.path, time, json, glob, socket, atexit
+from contextlib import contextmanager
+
+from . import logger
+
+NUM_RECENT_TRACES = 5
+
+enabled = False
+_logtype = None
+_phases = []
+_reported = False
+
+def _time0():
+    # use the same reference time as the "-t" log timestamps, so that the two can be correlated
+    return logger.TimestampFilter.time0
+
+def enable(logtype):
+    """Enables profiling. logtype is "local", "remote" or "container", and is used to name the trace file"""
+    global enabled, _logtype
+    enabled = True
+    _logtype = logtype
+    atexit.register(report)
+
+def record(name, start, end=None):
+    """Records a phase that ran from start to end (both time.time() values, end defaults to now)"""
+    if enabled:
+        end = time.time() if end is None else end
+        _phases.append(dict(name=name, start=round(start - _time0(), 4), duration=round(end - start, 4)))
+
+@contextmanager
+def phase(name):
+    """Context manager timing the enclosed block as a named phase"""
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        record(name, t0)
+
+def report():
+    """Writes the JSON trace and prints a summary table. Only the first call does anything."""
+    global _reported
+    if not enabled or _reported:
+        return
+    _reported = True
+
+    from .utils import message, warning, make_dir, make_radiopadre_dir
+
+    total = time.time() - _time0()
+    trace = dict(logtype=_logtype, pid=os.getpid(), host=socket.gethostname(),
+                 time0=time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(_time0())),
+                 total=round(total, 4), phases=_phases)
+
+    logdir = make_dir(f"{make_radiopadre_dir()}/logs")
+    tracename = f"{logdir}/startup-{_logtype}-{time.strftime('%Y%m%d%H%M%S')}.json"
+    try:
+        with open(tracename, "wt") as tracefile:
+            json.dump(trace, tracefile, indent=2)
+    except Exception as exc:
+        warning(f"failed to write startup trace {tracename}: {exc}")
+        tracename = None
+
+    width = max([len(ph['name']) for ph in _phases] + [5])
+    message(f"Startup profile ({_logtype} session, {total:.2f}s since launch):")
+    message(f"  {'phase':{width}}    start  duration")
+    for ph in _phases:
+        message(f"  {ph['name']:{width}} {ph['start']:7.2f}s  {ph['duration']:7.2f}s")
+    if tracename:
+        message(f"  startup trace written to {tracename}")
+
+    # clear older traces
+    recent = sorted(glob.glob(f"{logdir}/startup-{_logtype}-*.json"))
+    for oldtrace in recent[:-NUM_RECENT_TRACES]:
+        try:
+            os.unlink(oldtrace)
+        except Exception:
+            pass
@@ -0,0 +1,175 @@
+"""
+Server readiness detection.
+
+Waits for one or more servers (Jupyter, the HTTP server, the JS9 helper, CARTA) to come up. Each server
+is polled with non-blocking connects (with exponential backoff, and a fresh socket per attempt), and once
+a connection is established, with an HTTP HEAD request. A server is considered ready only when it answers with
+an HTTP status line -- a bare connect is not enough, since e.g. docker's port proxy accepts connections
+long before anything is listening inside the container. Servers running with SSL certificates are probed
+with a (non-verifying) TLS handshake first.
+"""
+import socket, selectors, errno, time
+
+MIN_BACKOFF = 0.02
+MAX_BACKOFF = 0.5
+
+def _ssl():
+    """Imports the ssl module on first use, since most sessions run without SSL"""
+    import ssl
+    return ssl
+
+class ServerProbe(object):
+    """Describes a server to be waited on, and tracks its state"""
+    def __init__(self, name, port, path="/", host="localhost", required=True, use_ssl=False):
+        self.name, self.port, self.path, self.host, self.required = name, port, path, host, required
+        self.use_ssl = use_ssl
+        self.sock = None
+        self._handshaking = False
+        self.ready = None           # set to time elapsed when server is ready
+        self.attempts = 0
+        self._backoff = MIN_BACKOFF
+        self._next_attempt = 0
+        self._request = f"HEAD {path} HTTP/1.0\r\nHost: {host}:{port}\r\n\r\n".encode()
+
+    def __repr__(self):
+        return f"{self.name} (port {self.port})"
+
+    def _close(self, sel, now):
+        if self.sock is not None:
+            sel.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
+        self._next_attempt = now + self._backoff
+        self._backoff = min(self._backoff * 2, MAX_BACKOFF)
+
+    def _connect(self, sel, now):
+        self.attempts += 1
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        err = self.sock.connect_ex((self.host, self.port))
+        if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            sel.register(self.sock, selectors.EVENT_WRITE, self)
+        else:
+            self.sock.close()
+            self.sock = None
+            self._close(sel, now)
+
+    def _start_ssl(self, sel):
+        """Wraps connected socket for SSL. Certificates are not verified, since we only probe for liveness"""
+        ssl = _ssl()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        sel.unregister(self.sock)
+        self.sock = context.wrap_socket(self.sock, do_handshake_on_connect=False)
+        sel.register(self.sock, selectors.EVENT_WRITE, self)
+        self._handshaking = True
+
+    def _handshake(self, sel, now):
+        """Advances the SSL handshake. Returns True when complete"""
+        ssl = _ssl()
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            sel.modify(self.sock, selectors.EVENT_READ, self)
+            return False
+        except ssl.SSLWantWriteError:
+            sel.modify(self.sock, selectors.EVENT_WRITE, self)
+            return False
+        except OSError:
+            self._close(sel, now)
+            return False
+        self._handshaking = False
+        return True
+
+    def _handle(self, sel, events, now, t0):
+        """Handles socket event. Returns True if server is now ready"""
+        if self._handshaking:
+            if not self._handshake(sel, now):
+                return False
+            events = selectors.EVENT_WRITE
+        elif events & selectors.EVENT_WRITE:
+            # connect has completed (or failed) -- check status, and send request
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._close(sel, now)
+                return False
+            if self.use_ssl:
+                self._start_ssl(sel)
+                return False
+        if events & selectors.EVENT_WRITE:
+            try:
+                self.sock.send(self._request)
+            except OSError:
+                self._close(sel, now)
+                return False
+            sel.modify(self.sock, selectors.EVENT_READ, self)
+            return False
+        # else readable: look for HTTP status line. An empty read means the connection was dropped
+        try:
+            data = self.sock.recv(64)
+        except OSError as exc:
+            # an SSL socket may not have received a complete record yet
+            if self.use_ssl and isinstance(exc, _ssl().SSLWantReadError):
+                return False
+            data = b""
+        if data.startswith(b"HTTP/"):
+            self.ready = now - t0
+            sel.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
+            return True
+        self._close(sel, now)
+        return False
+
+
+def await_servers(servers, process=None, wait=60, on_ready=None, on_first_failure=None):
+    """
+    Waits for servers to come up. Returns when all required servers are ready, or when the wait times out,
+    or when the process (if given) exits. Optional servers are polled concurrently, and marked as ready if they
+    come up in the meantime.
+
+    :param servers:             list of ServerProbe objects
+    :param process:             if not None, a subprocess.Popen object. If it exits, we stop waiting.
+    :param wait:                total number of seconds to wait before giving up
+    :param on_ready:            if not None, called as on_ready(probe) when a server comes up
+    :param on_first_failure:    if not None, called once if the first connection attempts are unsuccessful
+    :return:                    dict of name -> seconds elapsed before server was ready, or None if not ready
+    """
+    t0 = time.time()
+    deadline = t0 + wait
+    pending = list(servers)
+    reported_failure = False
+    sel = selectors.DefaultSelector()
+    try:
+        while any(probe.required for probe in pending):
+            now = time.time()
+            if now >= deadline:
+                break
+            if process is not None and process.poll() is not None:
+                break
+            # start connection attempts for servers that are due one
+            for probe in pending:
+                if probe.sock is None and now >= probe._next_attempt:
+                    probe._connect(sel, now)
+            # wait for events, but not beyond the next scheduled connection attempt
+            timeout = min([probe._next_attempt - now for probe in pending if probe.sock is None] + [MAX_BACKOFF])
+            for key, events in sel.select(max(timeout, 0)):
+                probe = key.data
+                if probe._handle(sel, events, time.time(), t0):
+                    pending.remove(probe)
+                    if on_ready is not None:
+                        on_ready(probe)
+            if not reported_failure and on_first_failure is not None and \
+                    any(probe.required and probe.attempts > 1 for probe in pending):
+                on_first_failure()
+                reported_failure = True
+    finally:
+        for probe in pending:
+            if probe.sock is not None:
+                sel.unregister(probe.sock)
+                probe.sock.close()
+                probe.sock = None
+        sel.close()
+
+    return {probe.name: probe.ready for probe in servers}
@@ -1,5 +1,5 @@
 from __future__ import print_function
-import os.path, select, socket, subprocess, sys, logging, errno, traceback
+import os.path, select, socket, subprocess, sys, logging, errno, traceback, shutil, json, threading, fcntl
 
 import iglesia
 from iglesia import logger
@@ -79,11 +79,80 @@ def make_link(src, dest, rm_fr=False):
     os.symlink(os.path.abspath(src), dest)
 
 
+# memo of find_which() results, keyed by (PATH, command)
+_which_cache = {}
+# on-disk caches of find_which() results, used inside containers: cache filename -> {command: path}
+_which_disk_caches = {}
+_which_disk_lock = threading.Lock()     # find_which() may be called from concurrent helper startup threads
+
+def _which_disk_cache_file(path):
+    """
+    Returns name of on-disk cache file for find_which() results, or None if not in a container session.
+    Inside a container, PATH is fixed by the image, so results can be reused across sessions: the cache
+    is keyed by a hash of PATH plus the image identity, which the backends pass in via RADIOPADRE_CONTAINER_IMAGE
+    (a docker image ID, or a singularity image path plus mtime), so that an updated image under the same name
+    does not reuse stale results.
+    """
+    image = os.environ.get('RADIOPADRE_CONTAINER_IMAGE')
+    if not image or not os.environ.get('RADIOPADRE_CONTAINER_NAME'):
+        return None
+    import hashlib
+    key = hashlib.sha1(f"{image}\n{path}".encode()).hexdigest()[:16]
+    return os.path.join(iglesia.RADIOPADRE_DIR, "which-cache", f"{key}.json")
+
+def _load_which_disk_cache(filename):
+    if filename not in _which_disk_caches:
+        cache = {}
+        if os.path.exists(filename):
+            try:
+                cache = json.load(open(filename, "rt"))
+            except Exception as exc:
+                debug(f"error reading {filename}: {exc}, ignoring")
+        _which_disk_caches[filename] = cache
+    return _which_disk_caches[filename]
+
+def _save_which_disk_cache(filename, cache):
+    tmpname = f"{filename}.{os.getpid()}"
+    with _which_disk_lock:
+        try:
+            if not os.path.exists(os.path.dirname(filename)):
+                os.mkdir(os.path.dirname(filename))
+            with open(tmpname, "wt") as cachefile:
+                json.dump(cache, cachefile)
+            os.rename(tmpname, filename)
+        except Exception as exc:
+            debug(f"error writing {filename}: {exc}, ignoring")
+
 def find_which(command):
     """
-    Returns the equivalent of `which command`, or None is command is not found
+    Returns the equivalent of `which command`, or None is command is not found.
+
+    The PATH is searched in-process, and results are memoized per PATH. Inside containers, successful lookups
+    are also cached on disk. Paths from the disk cache are rechecked for executability before being returned.
     """
-    return check_output("which " + command, fail_retcode=1)
+    path = os.environ.get("PATH", os.defpath)
+    key = (path, command)
+    if key in _which_cache:
+        return _which_cache[key]
+
+    cachefile = _which_disk_cache_file(path)
+    disk_cache = _load_which_disk_cache(cachefile) if cachefile else {}
+    result = disk_cache.get(command)
+    if result is not None and not (os.path.isfile(result) and os.access(result, os.X_OK)):
+        result = None
+    if result is None:
+        result = shutil.which(command, path=path)
+        # only positive results go on disk, so that e.g. a helper added to the image later is still picked up
+        if result is not None and cachefile:
+            disk_cache[command] = result
+            _save_which_disk_cache(cachefile, disk_cache)
+
+    _which_cache[key] = result
+    return result
+
+def clear_which_cache():
+    """Clears the find_which() memo, e.g. after something has been installed"""
+    _which_cache.clear()
 
 
 def find_unused_port(base=1025, maxtries=10000):
@@ -101,12 +170,20 @@ def find_unused_port(base=1025, maxtries=10000):
             continue
     raise RuntimeError("unable to find free socket port")
 
-def find_unused_ports(num=1, base=1025):
-    """Helper function. Finds N unused ports, returns list"""
-    ports = []
-    for _ in range(num):
-        ports.append(find_unused_port(ports[-1]+1 if ports else base))
-    return ports
+def find_unused_ports(num=1, base=None):
+    """
+    Helper function. Finds a block of N unused ports (see iglesia.ports), returns list. If base is given,
+    looks for N unused ports upwards of base instead, as this function used to.
+    """
+    if base is not None:
+        ports = []
+        for _ in range(num):
+            ports.append(find_unused_port(ports[-1]+1 if ports else base))
+        return ports
+    from .ports import reserve_ports
+    block = reserve_ports(num)
+    block.release()
+    return block.ports
 
 
 class Poller(object):
@@ -165,4 +242,38 @@ class chdir(object):
         os.chdir(self.newPath)
 
     def __exit__(self, etype, value, traceback):
-        os.chdir(self.savedPath)
\ No newline at end of file
+        os.chdir(self.savedPath)
+
+
+class FileLock(object):
+    """
+    Context manager holding an exclusive lock on the given lockfile. If locking is not available (e.g. on
+    some NFS setups), proceeds without.
+    """
+    def __init__(self, lockname):
+        self.lockname = lockname
+        self.lockfile = None
+
+    def __enter__(self):
+        try:
+            self.lockfile = open(self.lockname, "a")
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        except OSError as exc:
+            debug(f"unable to lock {self.lockname} ({exc}), proceeding without locking")
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        if self.lockfile is not None:
+            self.lockfile.close()   # this releases the lock
+            self.lockfile = None
+
+
+def pid_alive(pid):
+    """Returns True if a process with the given PID exists (on this host)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
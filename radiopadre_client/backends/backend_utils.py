@@ -1,6 +1,8 @@
-import socket, time, os, os.path
+import time, os, os.path, signal
 
 import iglesia
+from iglesia import profiler
+from iglesia.readiness import ServerProbe, await_servers
 from iglesia.utils import message, bye, shell
 from radiopadre_client import config
 
@@ -20,37 +22,64 @@ def update_server_from_repository():
             bye("update failed")
 
 
-def await_server_startup(port, process=None, server_name="jupyter notebook server", init_wait=2, wait=60):
+def await_server_startup(port, process=None, server_name="jupyter notebook server", init_wait=0, wait=60,
+                         http_path="/api/status", extra_servers=(), use_ssl=None):
     """
-    Waits for a server process to start up, tries to connect to the specified port,
+    Waits for a server process to start up and respond to HTTP requests on the specified port,
     returns when successful
 
-    :param port:        port number
-    :param process:     if not None, waits on the process and checks its return code
-    :param init_wait:   number of second to wait before trying to connect
-    :param wait:        total number of seconds to wait before giving up
-    :return:            number of seconds elapsed before connection, or None if failed
+    :param port:            port number
+    :param process:         if not None, waits on the process and checks its return code
+    :param init_wait:       number of second to wait before trying to connect (not normally needed)
+    :param wait:            total number of seconds to wait before giving up
+    :param http_path:       path to probe via HTTP (Jupyter's /api/status by default)
+    :param extra_servers:   list of (name, port, use_ssl) tuples giving optional helper servers to be polled
+                            concurrently. Their status is reported, but not waited on once the main server is up.
+    :param use_ssl:         if True, probe server via SSL. Default is to follow the --ssl setting.
+    :return:                number of seconds elapsed before connection, or None if failed
     """
-    # pause to let the Jupyter server spin up
-    t0 = time.time()
-    time.sleep(init_wait)
-    # then try to connect to it
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    for retry in range(int(wait/.1)):
-        # try to connect
-        try:
-            sock.connect(("localhost", port))
-            del sock
-            return time.time() - t0
-        except socket.error:
-            pass
-        if not retry:
+    with profiler.phase("await_server_startup"):
+        if init_wait:
+            time.sleep(init_wait)
+        if use_ssl is None:
+            use_ssl = bool(config.SSL)
+        probes = [ServerProbe(server_name, port, path=http_path, use_ssl=use_ssl)] + \
+                 [ServerProbe(name, extra_port, required=False, use_ssl=extra_ssl)
+                  for name, extra_port, extra_ssl in extra_servers]
+
+        def on_first_failure():
             message(f"Waiting for up to {wait} secs for the {server_name} to come up")
-        # sleep, check process
-        if process is not None:
-            process.poll()
-            if process.returncode is not None:
-                return None
-        time.sleep(.1)
-    return None
 
+        def on_ready(probe):
+            if not probe.required:
+                message(f"  {probe.name} is up on port {probe.port} (after {probe.ready:.2f} secs)")
+
+        ready = await_servers(probes, process=process, wait=wait, on_ready=on_ready, on_first_failure=on_first_failure)
+
+        for probe in probes[1:]:
+            if probe.ready is None:
+                message(f"  {probe.name} is not yet up on port {probe.port}")
+
+        elapsed = ready[server_name]
+        return None if elapsed is None else elapsed + init_wait
+
+
+def signal_session_processes(entries, signum=None):
+    """
+    Kills sessions that are run directly by their owning client process (virtualenv and singularity sessions),
+    by sending each process a SIGHUP, which makes the client shut down its session cleanly.
+
+    :param entries: list of session registry entries
+    :param signum:  signal to send, default is SIGHUP
+    """
+    for entry in entries:
+        pid = entry['pid']
+        if pid and pid != os.getpid():
+            try:
+                os.kill(pid, signal.SIGHUP if signum is None else signum)
+            except ProcessLookupError:
+                continue
+            except PermissionError as exc:
+                message(f"    unable to kill pid {pid}: {exc}")
+                continue
+            message(f"    killed session {entry['session_id']} (pid {pid})")
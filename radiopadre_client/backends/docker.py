@@ -1,17 +1,23 @@
-import subprocess, glob, os, os.path, re, sys, time, signal, atexit
-from collections import OrderedDict
+import subprocess, os, os.path, sys, signal, atexit, json, uuid, threading
 
 import iglesia
-from iglesia.utils import message, warning, make_dir, make_radiopadre_dir, bye, shell, DEVNULL, INPUT, check_output
-from radiopadre_client import config
+from iglesia import profiler
+from iglesia.utils import message, warning, debug, make_dir, make_radiopadre_dir, bye, shell, DEVNULL, INPUT, \
+    check_output, find_which
+from radiopadre_client import config, registry
 from radiopadre_client.config import USER, CONTAINER_PORTS, SERVER_INSTALL_PATH, CLIENT_INSTALL_PATH
 from radiopadre_client.server import run_browser as browser_runner
 
 from .backend_utils import await_server_startup, update_server_from_repository
+from . import image_updater
 
 docker = None
 SESSION_INFO_DIR = '.'
 running_container = None
+docker_image_id = docker_image_entrypoint = None
+
+# idle pre-warmed containers (see --prewarm) are named with this prefix, and renamed when taken over by a session
+POOL_PREFIX = "radiopadre-pool-"
 
 def init(binary):
     global docker
@@ -24,101 +30,32 @@ def _init_session_dir():
     SESSION_INFO_DIR = f"{radiopadre_dir}/sessions"
     make_dir(SESSION_INFO_DIR)
 
-def _ps_containers():
-    """Returns OrderedDict (ordered by uptime) of containers returned by docker ps.
-    Dict is name -> [id, path, uptime, None, None]"""
-    lines = subprocess.check_output([docker, "ps", "--filter", "label=radiopadre.user={}".format(USER),
-                "--format", """{{.CreatedAt}}:::{{.ID}}:::{{.Names}}:::{{.Label "radiopadre.dir"}}"""]).decode().strip()
-    container_list = sorted([line.split(":::") for line in lines.split("\n") if len(line.split(":::")) == 4], reverse=True)
-    return OrderedDict([(name, [id_, path, time, None, None]) for time, id_, name, path in container_list])
-
-
 def get_session_info_dir(container_name):
     return os.path.join(SESSION_INFO_DIR, container_name)
 
 
-def read_session_info(container_name):
-    """Reads the given session ID file. Returns session_id, ports, or else throws a ValueError"""
-    dirname = get_session_info_dir(container_name)
-    session_file = f"{dirname}/info"
-
-    if not os.path.exists(session_file):
-        raise ValueError(f"invalid session dir {dirname}")
-
-    comps = open(session_file, "rt").read().strip().split(" ")
-    if len(comps) != 11:
-        raise ValueError(f"invalid session dir {dirname}")
-    session_id = comps[0]
-    try:
-        ports = map(int, comps[1:])
-    except:
-        raise ValueError(f"invalid session dir {dirname}")
-    return session_id, ports
-
-
 def save_session_info(container_name, selected_ports, userside_ports):
-    session_info_dir = "{}/{}".format(SESSION_INFO_DIR, container_name)
-    make_dir(session_info_dir)
-    session_info_file = session_info_dir + "/info"
-    open(session_info_file, "wt").write(" ".join(map(str, [config.SESSION_ID] + selected_ports + userside_ports)))
-    os.chmod(session_info_file, 0o600)
+    session_info_dir = make_dir(get_session_info_dir(container_name))
     userside_helper_port = userside_ports[1]
     open(session_info_dir + "/js9prefs.js", "w").write(
         "JS9Prefs.globalOpts.helperPort = {};\n".format(userside_helper_port))
 
 
-def list_sessions():
-    """Returns OrderedDict (ordered by uptime) of running containers with their session IDs. Clears up dead sessions.
-    Dict is id -> [name, path, uptime, session_id, ports]"""
-    container_dict = _ps_containers()
-    # match session files to containers
-    for session_dir in glob.glob(SESSION_INFO_DIR + "/radiopadre-*"):
-        name = os.path.basename(session_dir)
-        if name not in container_dict:
-            message("    container {} is no longer running, clearing up session dir".format(name))
-            subprocess.call(["rm", "-fr", session_dir])
-            continue
-        try:
-            container_dict[name][3], container_dict[name][4] = read_session_info(session_dir)
-        except ValueError:
-            message(f"    invalid session dir {session_dir}")
-            continue
-    output = OrderedDict()
-
-    # check for containers without session info and form up output dict
-    for name, (id_, path, time, session_id, ports) in container_dict.items():
-        if session_id is None:
-            message("    container {} has no session dir -- killing it".format(name))
-            subprocess.call([docker, "kill", id_])
-        else:
-            output[id_] = [name, path, time, session_id, ports]
-
-    return output
-
-
-def identify_session(session_dict, arg):
-    """Returns ID of container corresponding to ID or ordinal number. Throws errors on mismatch."""
-    if len(arg) <= 4 and re.match('^\d+$', arg):
-        arg = int(arg)
-        if arg >= len(session_dict):
-            bye("invalid session #{}, we only have {} running".format(arg, len(session_dict)))
-        return session_dict.keys()[arg]
-    elif arg not in session_dict:
-        bye("invalid container ID {}".format(arg))
-    return arg
-
-
-def kill_sessions(session_dict, session_ids, ignore_fail=False):
-    kill_cont = " ".join(session_ids)
-    message("    killing containers: {}".format(kill_cont))
-    for cont in session_ids:
-        if cont not in session_dict:
-            bye("no such radiopadre container: {}".format(cont))
-        name, path, _, _, _ = session_dict[cont]
-        session_id_file = "{}/{}".format(SESSION_INFO_DIR, name)
-        if os.path.exists(session_id_file):
-            subprocess.call(["rm", "-fr", session_id_file])
-    shell(f"{docker} kill {kill_cont}", ignore_fail=True)
+def kill_sessions(entries, wait=True):
+    """Kills the containers of the given sessions (registry entries) with a single docker kill"""
+    global docker
+    if docker is None:
+        docker = find_which("docker")
+        if not docker:
+            warning("docker binary not found, unable to kill container sessions")
+            return
+    names = [entry['name'] for entry in entries]
+    message("    killing containers: {}".format(" ".join(names)))
+    for name in names:
+        subprocess.call(["rm", "-fr", get_session_info_dir(name)])
+    proc = subprocess.Popen([docker, "kill"] + names, stdout=DEVNULL, stderr=DEVNULL)
+    if wait:
+        proc.wait()
 
 
 def update_installation(enable_pull=False):
@@ -127,12 +64,20 @@ def update_installation(enable_pull=False):
     if config.CONTAINER_DEV:
         update_server_from_repository()
     docker_image = config.DOCKER_IMAGE
-    if check_output(f"docker image inspect {docker_image}") is None:
+    _inspect_image()
+    if docker_image_id is None:
         if not enable_pull:
             bye(f"  Radiopadre docker image {docker_image} not found. Re-run with --update or --auto-init perhaps?")
         message(f"  Radiopadre docker image {docker_image} not found locally")
     else:
         message(f"  Using radiopadre docker image {docker_image}")
+        # in background update mode, a newer image (if any) is pulled while the session runs
+        if image_updater.enabled():
+            image_updater.report_status(docker_image)
+            proc = image_updater.start_update(docker_image, docker=docker)
+            if proc:
+                image_updater.watch_update(docker_image, proc)
+            return
     if enable_pull:
         warning(f"Calling docker pull {docker_image}")
         warning("  (This may take a few minutes if the image is not up to date...)")
@@ -143,6 +88,23 @@ def update_installation(enable_pull=False):
                 warning("docker pull failed, but --ignore-update-errors is set, proceeding anyway")
                 return
             raise exc
+        # image may have changed
+        _inspect_image()
+
+
+def _inspect_image():
+    """Sets docker_image_id and docker_image_entrypoint from docker image inspect (or None if no image)"""
+    global docker_image_id, docker_image_entrypoint
+    docker_image_id = docker_image_entrypoint = None
+    output = check_output(f"{docker} image inspect {docker_image}")
+    if output:
+        try:
+            info = json.loads(output)[0]
+            docker_image_id = info["Id"]
+            docker_image_entrypoint = info["Config"].get("Entrypoint")
+        except Exception as exc:
+            warning(f"unable to parse output of docker image inspect {docker_image}: {exc}")
+            docker_image_id = docker_image
 
 
 def _collect_runscript_arguments(ports):
@@ -159,7 +121,8 @@ def _collect_runscript_arguments(ports):
     # some keys shouldn't be passed to the in=-container script at all
     for key in ("CLIENT_INSTALL_PATH", "SERVER_INSTALL_PATH", "SINGULARITY_IMAGE_DIR",
                 "AUTO_INIT", "SINGULARITY_REBUILD", "SINGULARITY_AUTO_BUILD", "SINGULARITY_OPTIONS",
-                "REMOTE_RADIOPADRE_DIR", "REMOTE_HOP", "REMOTE_LOGIN_SHELL", "REMOTE_PYTHON"):
+                "REMOTE_RADIOPADRE_DIR", "REMOTE_HOP", "REMOTE_LOGIN_SHELL", "REMOTE_PYTHON", "PREWARM",
+                "BACKGROUND_UPDATE", "NOTEBOOK_SYNC"):
         if key in run_config:
             del run_config[key]
 
@@ -168,7 +131,6 @@ def _collect_runscript_arguments(ports):
 
 
 def start_session(container_name, selected_ports, userside_ports, notebook_path, browser_urls, run_browser=False):
-    from iglesia import ABSROOTDIR, SHADOW_SESSION_DIR, SNOOP_MODE
     radiopadre_dir = make_radiopadre_dir()
     docker_local = make_dir(radiopadre_dir + "/.docker-local")
     js9_tmp = make_dir(radiopadre_dir + "/.js9-tmp")
@@ -176,6 +138,62 @@ def start_session(container_name, selected_ports, userside_ports, notebook_path,
 
     message(f"Container name: {container_name}")  # remote script will parse it
 
+    if not _start_pooled_session(container_name, selected_ports, userside_ports, notebook_path,
+                                 browser_urls, run_browser):
+        _start_new_container(container_name, selected_ports, userside_ports, notebook_path, browser_urls, run_browser,
+                             radiopadre_dir, docker_local, js9_tmp, session_info_dir)
+
+    if config.NBCONVERT:
+        return
+
+    global running_container
+    running_container = container_name
+    atexit.register(reap_running_container)
+    if config.CONTAINER_PERSIST:
+        registry.update(config.SESSION_ID, persist=True)
+
+    # top up the pool of pre-warmed containers for the next session
+    if config.PREWARM:
+        fill_pool()
+
+    if config.CONTAINER_PERSIST and config.CONTAINER_DETACH:
+        message("exiting: container session will remain running.")
+        running_container = None # to avoid reaping
+        registry.update(config.SESSION_ID, pid=None)
+        sys.exit(0)
+    else:
+        if config.CONTAINER_PERSIST:
+            prompt = "Type 'exit' to kill the container session, or 'D' to detach: "
+        else:
+            prompt = "Type 'exit' to kill the container session: "
+        try:
+            while True:
+                a = INPUT(prompt)
+                if a.lower() == 'exit':
+                    sys.exit(0)
+                if a.upper() == 'D' and config.CONTAINER_PERSIST and container_name:
+                    running_container = None  # to avoid reaping
+                    registry.update(config.SESSION_ID, pid=None)
+                    sys.exit(0)
+        except BaseException as exc:
+            if type(exc) is KeyboardInterrupt:
+                message("Caught Ctrl+C")
+                status = 1
+            elif type(exc) is SystemExit:
+                status = getattr(exc, 'code', 0)
+                message("Exiting with status {}".format(status))
+            else:
+                message("Caught exception {} ({})".format(exc, type(exc)))
+                status = 1
+            # if not status:
+            #     running_container = None  # to avoid reaping
+            sys.exit(status)
+
+def _start_new_container(container_name, selected_ports, userside_ports, notebook_path, browser_urls, run_browser,
+                         radiopadre_dir, docker_local, js9_tmp, session_info_dir):
+    """Starts a session in a new container (the "cold" path)"""
+    from iglesia import ABSROOTDIR, SHADOW_SESSION_DIR, SNOOP_MODE
+
     docker_opts = [ docker, "run", "--rm", "--name", container_name, 
                         "--cap-add=SYS_ADMIN",
                         "-w", ABSROOTDIR,
@@ -186,6 +204,7 @@ def start_session(container_name, selected_ports, userside_ports, notebook_path,
                         "-e", f"RADIOPADRE_CONTAINER_NAME={container_name}",
                         "-e", f"RADIOPADRE_SESSION_ID={config.SESSION_ID}",
                         "-e", "RADIOPADRE_DOCKER=True",
+                        "-e", f"RADIOPADRE_CONTAINER_IMAGE={docker_image_id or docker_image}",
                     ]
     # enable detached mode if not debugging, and also if not doing conversion non-interactively
     if not config.CONTAINER_DEBUG and not config.NBCONVERT:
@@ -224,47 +243,124 @@ def start_session(container_name, selected_ports, userside_ports, notebook_path,
         docker_opts.append(notebook_path)
 
     _run_container(container_name, docker_opts, jupyter_port=selected_ports[0], 
-                    browser_urls=browser_urls, run_browser=run_browser)
+                    browser_urls=browser_urls, run_browser=run_browser, helper_ports=selected_ports[1:4],
+                    detached="-d" in docker_opts)
 
-    if config.NBCONVERT:
+
+def _list_pool():
+    """Returns list of idle pool containers (for this user and image) as (name, image_id) tuples, oldest first"""
+    lines = subprocess.check_output([docker, "ps", "--filter", f"label=radiopadre.user={USER}",
+                                     "--filter", f"label=radiopadre.pool={docker_image}",
+                                     "--format", """{{.CreatedAt}}:::{{.Names}}:::{{.Label "radiopadre.image_id"}}"""]
+                                    ).decode().strip()
+    entries = sorted([line.split(":::") for line in lines.split("\n") if len(line.split(":::")) == 3])
+    return [(name, image_id) for _, name, image_id in entries if name.startswith(POOL_PREFIX)]
+
+
+def _pool_container_opts(name):
+    """Returns docker run command for an idle pool container. This has the common mounts, and idles until taken over"""
+    radiopadre_dir = make_radiopadre_dir()
+    homedir = os.path.expanduser("~")
+    return [docker, "run", "-d", "--rm", "--name", name,
+            "--cap-add=SYS_ADMIN",
+            # host networking, since port mappings can't be added to a running container
+            "--network", "host",
+            "--user", "{}:{}".format(os.getuid(), os.getgid()),
+            "-e", "USER={}".format(os.environ["USER"]),
+            "-e", "HOME={}".format(os.environ["HOME"]),
+            "-e", "RADIOPADRE_DIR={}".format(radiopadre_dir),
+            "-e", "RADIOPADRE_DOCKER=True",
+            "-e", f"RADIOPADRE_CONTAINER_IMAGE={docker_image_id or docker_image}",
+            "-v", "{}:{}".format(homedir, homedir),
+            "-v", "{}:{}".format(radiopadre_dir, radiopadre_dir),
+            "-v", "{}:{}/.local".format(make_dir(radiopadre_dir + "/.docker-local"), homedir),
+            "-v", "{}:/.radiopadre/venv/js9-www/tmp".format(make_dir(radiopadre_dir + "/.js9-tmp")),
+            "--label", "radiopadre.user={}".format(USER),
+            "--label", "radiopadre.pool={}".format(docker_image),
+            "--label", "radiopadre.image_id={}".format(docker_image_id),
+            "--entrypoint", "sleep", docker_image, "infinity"]
+
+
+def fill_pool(wait=False):
+    """
+    Tops up the pool of idle pre-warmed containers to config.PREWARM, and removes any that were made from an
+    outdated image. By default, this is done in a background thread.
+    """
+    if not docker_image_entrypoint:
+        warning(f"image {docker_image} does not define an entrypoint, so it can't be used with --prewarm")
         return
 
-    global running_container
-    running_container = container_name
-    atexit.register(reap_running_container)
+    def filler():
+        pool = _list_pool()
+        stale = [name for name, image_id in pool if image_id != docker_image_id]
+        if stale:
+            debug(f"removing outdated pool containers {' '.join(stale)}")
+            subprocess.call([docker, "kill"] + stale, stdout=DEVNULL, stderr=DEVNULL)
+        num_new = config.PREWARM - (len(pool) - len(stale))
+        for _ in range(num_new):
+            name = f"{POOL_PREFIX}{USER}-{uuid.uuid4().hex[:8]}"
+            debug(f"starting pre-warmed container {name}")
+            if subprocess.call(_pool_container_opts(name), stdout=DEVNULL, stderr=DEVNULL):
+                warning(f"failed to start pre-warmed container {name}")
+                break
+        return num_new
+
+    if wait:
+        num_new = filler()
+        message(f"{config.PREWARM} pre-warmed container(s) available ({max(num_new, 0)} started)")
+    else:
+        threading.Thread(target=filler, daemon=True).start()
 
-    if config.CONTAINER_PERSIST and config.CONTAINER_DETACH:
-        message("exiting: container session will remain running.")
-        running_container = None # to avoid reaping
-        sys.exit(0)
+
+def _start_pooled_session(container_name, selected_ports, userside_ports, notebook_path, browser_urls, run_browser):
+    """
+    Tries to start the session in an idle pre-warmed container. Returns False if this is not possible
+    (no idle containers, or the session needs a container with specific mounts or settings)
+    """
+    from iglesia import ABSROOTDIR, SESSION_DIR, SNOOP_MODE
+    homedir = os.path.expanduser("~")
+    if not config.PREWARM or not docker_image_entrypoint or config.CONTAINER_DEBUG or config.CONTAINER_DEV \
+            or config.NBCONVERT or SNOOP_MODE or not ABSROOTDIR.startswith(homedir + "/"):
+        return False
+
+    for pool_name, image_id in _list_pool():
+        if image_id != docker_image_id:
+            continue
+        # another session may be taking over the same container, in which case the rename fails
+        if subprocess.call([docker, "rename", pool_name, container_name], stdout=DEVNULL, stderr=DEVNULL) == 0:
+            break
     else:
-        if config.CONTAINER_PERSIST:
-            prompt = "Type 'exit' to kill the container session, or 'D' to detach: "
-        else:
-            prompt = "Type 'exit' to kill the container session: "
-        try:
-            while True:
-                a = INPUT(prompt)
-                if a.lower() == 'exit':
-                    sys.exit(0)
-                if a.upper() == 'D' and config.CONTAINER_PERSIST and container_name:
-                    running_container = None  # to avoid reaping
-                    sys.exit(0)
-        except BaseException as exc:
-            if type(exc) is KeyboardInterrupt:
-                message("Caught Ctrl+C")
-                status = 1
-            elif type(exc) is SystemExit:
-                status = getattr(exc, 'code', 0)
-                message("Exiting with status {}".format(status))
-            else:
-                message("Caught exception {} ({})".format(exc, type(exc)))
-                status = 1
-            # if not status:
-            #     running_container = None  # to avoid reaping
-            sys.exit(status)
+        message("No pre-warmed containers available, starting a new one")
+        return False
+    message(f"Taking over pre-warmed container {pool_name}")
+
+    # pool containers don't have the per-session mount, but the session dir is visible in the container
+    # via the home or radiopadre dir mounts
+    open(SESSION_DIR + "/js9prefs.js", "w").write(f"JS9Prefs.globalOpts.helperPort = {userside_ports[1]};\n")
+
+    # with host networking, the container ports are the selected ports
+    docker_opts = [docker, "exec", "-d", "-w", ABSROOTDIR,
+                   "-e", f"RADIOPADRE_CONTAINER_NAME={container_name}",
+                   "-e", f"RADIOPADRE_SESSION_ID={config.SESSION_ID}",
+                   container_name] + list(docker_image_entrypoint) + \
+                  _collect_runscript_arguments(list(selected_ports) + list(userside_ports))
+    if notebook_path:
+        docker_opts.append(notebook_path)
 
-def _run_container(container_name, docker_opts, jupyter_port, browser_urls, run_browser=False, singularity=False):
+    _run_container(container_name, docker_opts, jupyter_port=selected_ports[0],
+                   browser_urls=browser_urls, run_browser=run_browser, helper_ports=selected_ports[1:4],
+                   detached=True)
+    return True
+
+
+def _run_container(container_name, docker_opts, jupyter_port, browser_urls, run_browser=False, singularity=False,
+                   helper_ports=(), detached=False, logfile=None):
+    """
+    Runs container command, and waits for the servers to come up.
+
+    If logfile is given, the command is run in a new session with its output going to that file, so that it
+    can keep running after we exit.
+    """
 
     # add CARTA URL if asked to, since with a container image we already know the CARTA version
     if type(browser_urls) is list:
@@ -279,11 +375,16 @@ def _run_container(container_name, docker_opts, jupyter_port, browser_urls, run_
         message(
             "  (When using singularity and the image is not yet available locally, this can take a few minutes the first time you run.)")
 
-    if config.CONTAINER_DEBUG:
-        docker_process = subprocess.Popen(docker_opts, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr)
-    else:
-        docker_process = subprocess.Popen(docker_opts, stdout=DEVNULL,
-                                           stderr=DEVNULL if config.NON_INTERACTIVE else sys.stderr)
+    with profiler.phase("container start"):
+        if config.CONTAINER_DEBUG:
+            docker_process = subprocess.Popen(docker_opts, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr)
+        elif logfile:
+            docker_process = subprocess.Popen(docker_opts, stdin=DEVNULL, stdout=open(logfile, "wt"),
+                                              stderr=subprocess.STDOUT, start_new_session=True)
+            iglesia.detach_process(docker_process.pid)
+        else:
+            docker_process = subprocess.Popen(docker_opts, stdout=DEVNULL,
+                                               stderr=DEVNULL if config.NON_INTERACTIVE else sys.stderr)
                                       #stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr,
                                       #env=os.environ)
 
@@ -294,11 +395,22 @@ def _run_container(container_name, docker_opts, jupyter_port, browser_urls, run_
 
     else:
 
-        # pause to let the Jupyter server spin up
-        wait = await_server_startup(jupyter_port, process=docker_process, init_wait=1, server_name="notebook container")
+        # in detached mode, "docker run" exits once the container has started up
+        if detached:
+            retcode = docker_process.wait()
+            if retcode:
+                bye(f"docker run failed with return code {retcode}")
+            docker_process = None
+
+        # wait for the Jupyter server (and the helpers, if ports are given) to spin up
+        # only the HTTP server uses our SSL certificate
+        helpers = list(zip(["JS9 helper", "HTTP server", "CARTA backend"], helper_ports,
+                           [False, bool(config.SSL), False]))
+        wait = await_server_startup(jupyter_port, process=docker_process, server_name="notebook container",
+                                    extra_servers=helpers)
 
         if wait is None:
-            if docker_process.returncode is not None:
+            if docker_process is not None and docker_process.returncode is not None:
                 bye(f"container unexpectedly exited with return code {docker_process.returncode}")
             bye(f"unable to connect to jupyter notebook server on port {jupyter_port}")
 
@@ -306,9 +418,9 @@ def _run_container(container_name, docker_opts, jupyter_port, browser_urls, run_
             f"Container started. The jupyter notebook server is running on port {jupyter_port} (after {wait:.2f} secs)")
 
         if run_browser and browser_urls:
-            time.sleep(1)
             iglesia.register_helpers(*browser_runner(*browser_urls))
-            # give things a second (to let the browser command print its stuff, if it wants to)
+
+        profiler.report()
 
     return docker_process
 
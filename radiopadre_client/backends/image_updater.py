@@ -0,0 +1,197 @@
+"""
+Background image updates (see --background-update).
+
+Instead of pulling or rebuilding images before the session starts, the client starts the session with the locally
+available image, and launches this module as a detached worker process. The worker checks the digest of the
+docker image, and if it has changed, pulls it (docker) or builds it into a staging file which is then renamed
+over the old image (singularity). Either way, running sessions are unaffected, and the next launch picks up the
+new image.
+
+Workers coordinate through a lockfile per image (so that only one update runs at a time), and record their
+outcome in a status file, which the client reports on at the next launch.
+"""
+import os, os.path, sys, re, time, json, fcntl, subprocess, argparse
+
+import iglesia
+from iglesia.utils import message, warning, make_dir, DEVNULL
+from . import image_utils
+
+
+def enabled():
+    """True if updates should be done in the background. Explicit pull requests are always done in the foreground"""
+    from radiopadre_client import config
+    return bool(config.BACKGROUND_UPDATE) and not config.PULL_DOCKER and not config.PULL_SINGULARITY
+
+
+def _state_files(image):
+    """Returns names of lockfile, status file and log file for updates of the given image"""
+    dirname = make_dir(os.path.join(iglesia.RADIOPADRE_DIR, "image-updates"))
+    base = os.path.join(dirname, re.sub(r"[^\w.-]", "_", image))
+    return base + ".lock", base + ".json", base + ".log"
+
+
+def _try_lock(image):
+    """Tries to take the update lock for image. Returns open lockfile if successful, or None if an update is running"""
+    lockname, _, _ = _state_files(image)
+    lockfile = open(lockname, "a")
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lockfile.close()
+        return None
+    return lockfile
+
+
+def read_status(image):
+    _, filename, _ = _state_files(image)
+    try:
+        return json.load(open(filename, "rt"))
+    except Exception:
+        return {}
+
+
+def _write_status(image, **status):
+    _, filename, _ = _state_files(image)
+    status['time'] = time.time()
+    with open(filename + ".new", "wt") as statfile:
+        json.dump(status, statfile)
+    os.rename(filename + ".new", filename)
+
+
+def report_status(image, session_running=False):
+    """
+    Reports on the outcome of a previous background update of image (once)
+
+    :param session_running: True if reporting while the session is already running (on a different image), in
+                            which case the staged image will only be used at the next launch
+    """
+    status = read_status(image)
+    if status.get('reported', True):
+        return
+    when = time.strftime("%Y-%m-%d %H:%M", time.localtime(status['time']))
+    if status['state'] == "ready":
+        message(f"A newer image {image} ({status['digest']}) was staged in the background at {when},", color="GREEN")
+        message("  and will be used at the next launch" if session_running else "  and will be used for this session")
+    elif status['state'] == "failed":
+        warning(f"background update of {image} failed at {when}: {status.get('error')}")
+        warning(f"  (see {_state_files(image)[2]} for details)")
+    status['reported'] = True
+    _write_status(image, **status)
+
+
+def start_update(image, docker=None, singularity=None, singularity_image=None):
+    """
+    Starts a background update of image, unless one is already running.
+
+    :param image:               docker image name
+    :param docker:              docker binary. If given, the docker image is updated.
+    :param singularity:         singularity binary. If given, singularity_image is (re)built from the docker image.
+    :param singularity_image:   path to singularity image
+    :return:                    subprocess.Popen object for the worker process, or None if an update is running
+    """
+    lockfile = _try_lock(image)
+    if lockfile is None:
+        message(f"  A background update of {image} is already running")
+        return None
+    lockfile.close()   # the worker takes the lock itself
+
+    cmd = [sys.executable, "-m", "radiopadre_client.backends.image_updater", image]
+    if docker:
+        cmd += ["--docker", docker]
+    if singularity:
+        cmd += ["--singularity", singularity, "--singularity-image", singularity_image]
+    # make sure the worker imports the same radiopadre_client as us
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.dirname(
+                                        os.path.abspath(__file__)))), env.get("PYTHONPATH")]))
+    env["RADIOPADRE_DIR"] = iglesia.RADIOPADRE_DIR
+    _, _, logname = _state_files(image)
+    message(f"  Checking for updates of {image} in the background (log in {logname})")
+    proc = subprocess.Popen(cmd, stdin=DEVNULL, stdout=open(logname, "wt"), stderr=subprocess.STDOUT,
+                            env=env, start_new_session=True)
+    # the update should complete even if we exit in the meantime
+    iglesia.detach_process(proc.pid)
+    return proc
+
+
+def watch_update(image, proc):
+    """Reports in the background when the worker process completes, if we're still running by then"""
+    import threading
+
+    def watcher():
+        proc.wait()
+        if read_status(image).get('state') in ("ready", "failed"):
+            report_status(image, session_running=True)
+
+    threading.Thread(target=watcher, daemon=True).start()
+
+
+def _update_docker(image, docker):
+    digest = image_utils.get_docker_digest(docker, image)
+    latest, _ = image_utils.get_registry_digest(image)
+    if digest and digest == latest:
+        return None
+    print(f"local digest {digest}, registry digest {latest}: pulling {image}", flush=True)
+    # docker pull only retags the image when the download is complete, so this is already atomic
+    subprocess.check_call([docker, "pull", image])
+    new_digest = image_utils.get_docker_digest(docker, image)
+    return new_digest if new_digest != digest else None
+
+
+def _update_singularity(image, singularity, singularity_image, docker=None):
+    digest, layers = image_utils.get_image_digest(image, docker=docker)
+    if digest is None:
+        raise RuntimeError(f"unable to determine the digest of {image}")
+    sidecar = image_utils.read_sidecar(singularity_image) or {}
+    if sidecar.get("digest") == digest:
+        return None
+    source = f"docker://{image_utils.pinned_reference(image, digest)}"
+    staging_image = os.path.splitext(singularity_image)[0] + ".staging.simg"
+    if os.path.exists(staging_image):
+        os.unlink(staging_image)
+    print(f"building {staging_image} from {source}", flush=True)
+    subprocess.check_call([singularity, "build", staging_image, source],
+                          env=image_utils.singularity_build_environment())
+    # swap in the new image. Running sessions keep the old one open, so this is safe
+    os.rename(staging_image, singularity_image)
+    image_utils.write_sidecar(singularity_image, source, digest, layers)
+    return digest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Background updater for radiopadre images")
+    parser.add_argument("image")
+    parser.add_argument("--docker")
+    parser.add_argument("--singularity")
+    parser.add_argument("--singularity-image")
+    options = parser.parse_args()
+
+    lockfile = _try_lock(options.image)
+    if lockfile is None:
+        print("another update is running, exiting")
+        return 0
+    with lockfile:
+        try:
+            digest = None
+            if options.docker:
+                digest = _update_docker(options.image, options.docker)
+            if options.singularity:
+                digest = _update_singularity(options.image, options.singularity, options.singularity_image,
+                                             docker=options.docker)
+        except Exception as exc:
+            print(f"update failed: {exc}", flush=True)
+            _write_status(options.image, state="failed", error=str(exc), reported=False)
+            return 1
+        if digest:
+            print(f"new image staged: {digest}", flush=True)
+            _write_status(options.image, state="ready", digest=digest, reported=False)
+        else:
+            print("image is up-to-date", flush=True)
+            # don't clobber an unreported update from an earlier run
+            if read_status(options.image).get('reported', True):
+                _write_status(options.image, state="current", reported=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
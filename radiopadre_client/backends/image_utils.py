@@ -0,0 +1,216 @@
+"""
+Container image metadata helpers.
+
+Used to decide whether a Singularity image needs to be rebuilt. Each Singularity image has a JSON sidecar
+file ({image}.json) recording the digest of the docker image it was built from, and, if known, its layers (as the
+compressed blob digests listed in the registry manifest). The digest of the current docker image is obtained from
+the local docker daemon if available, else from the registry itself (via the Docker Registry HTTP API v2, which only
+needs a couple of small HTTP requests). The daemon only knows the uncompressed layer (diff) IDs, which can't be
+compared with blob digests, so layers are recorded only when the digest comes from the registry.
+"""
+import os, os.path, json, time, subprocess, re
+
+from iglesia.utils import debug, warning, make_dir, make_radiopadre_dir
+
+DEFAULT_REGISTRY = "docker.io"
+REGISTRY_TIMEOUT = 10
+
+_MANIFEST_TYPES = ", ".join([
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json"])
+
+_PLATFORM_ARCH = dict(x86_64="amd64", aarch64="arm64", arm64="arm64")
+
+
+def parse_image_name(image):
+    """
+    Splits docker image name into registry, repository and tag (or digest)
+
+    :param image:   image name, e.g. "quay.io/osmirnov/radiopadre:1.2.4" or "ubuntu"
+    :return:        tuple of registry, repository, tag
+    """
+    name, tag = image, "latest"
+    if "@" in name:
+        name, tag = name.split("@", 1)
+    else:
+        # a colon after the last slash separates the tag (an earlier one would be a registry port)
+        match = re.match(r"^(.*?):([^/:]+)$", name)
+        if match:
+            name, tag = match.groups()
+    comps = name.split("/", 1)
+    if len(comps) > 1 and ("." in comps[0] or ":" in comps[0] or comps[0] == "localhost"):
+        registry, repository = comps
+    else:
+        registry, repository = DEFAULT_REGISTRY, name
+    if registry == DEFAULT_REGISTRY and "/" not in repository:
+        repository = "library/" + repository
+    return registry, repository, tag
+
+
+def pinned_reference(image, digest):
+    """Returns image reference pinned to the given digest, e.g. "quay.io/osmirnov/radiopadre@sha256:..." """
+    registry, repository, _ = parse_image_name(image)
+    return f"{registry}/{repository}@{digest}"
+
+
+def get_docker_digest(docker, image):
+    """
+    Gets digest of an image from the local docker daemon
+
+    :return:    digest, or None if the image is not available or was not pulled from a registry
+    """
+    try:
+        output = subprocess.check_output([docker, "image", "inspect", image, "--format", "{{json .RepoDigests}}"],
+                                         stderr=subprocess.DEVNULL).decode()
+        repo_digests = json.loads(output)
+    except (subprocess.CalledProcessError, ValueError) as exc:
+        debug(f"docker image inspect {image} failed: {exc}")
+        return None
+    _, repository, _ = parse_image_name(image)
+    for entry in repo_digests or []:
+        name, digest = entry.split("@", 1)
+        if name.endswith(repository.replace("library/", "", 1)):
+            return digest
+    return None
+
+
+def _registry_request(url, method="GET", token=None):
+    """Makes registry API request. Returns urllib response object. Obtains an anonymous token if needed."""
+    import urllib.request, urllib.error, urllib.parse
+    headers = {"Accept": _MANIFEST_TYPES}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    try:
+        return urllib.request.urlopen(urllib.request.Request(url, headers=headers, method=method),
+                                      timeout=REGISTRY_TIMEOUT)
+    except urllib.error.HTTPError as exc:
+        challenge = exc.headers.get("WWW-Authenticate", "")
+        if exc.code != 401 or token or not challenge.startswith("Bearer "):
+            raise
+    params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+    realm = params.pop("realm")
+    with urllib.request.urlopen(f"{realm}?{urllib.parse.urlencode(params)}", timeout=REGISTRY_TIMEOUT) as resp:
+        auth = json.load(resp)
+    return _registry_request(url, method, token=auth.get("token") or auth.get("access_token"))
+
+
+def _get_registry_manifest(image):
+    """
+    Gets image manifest from its registry. For multi-platform images, the manifest for our platform is returned.
+
+    :return:    tuple of digest, manifest, base URL of repository
+    """
+    registry, repository, tag = parse_image_name(image)
+    host = "registry-1.docker.io" if registry == DEFAULT_REGISTRY else registry
+    base_url = f"https://{host}/v2/{repository}/"
+    with _registry_request(base_url + "manifests/" + tag) as resp:
+        digest = resp.headers.get("Docker-Content-Digest")
+        manifest = json.load(resp)
+    # multi-platform image: descend into the manifest for our platform
+    if "manifests" in manifest:
+        arch = _PLATFORM_ARCH.get(os.uname().machine, os.uname().machine)
+        platforms = [entry for entry in manifest["manifests"]
+                     if entry.get("platform", {}).get("architecture") == arch] or manifest["manifests"]
+        with _registry_request(base_url + "manifests/" + platforms[0]["digest"]) as resp:
+            manifest = json.load(resp)
+    return digest, manifest, base_url
+
+
+def get_registry_digest(image):
+    """
+    Gets digest and layer list (compressed blob digests) of an image from its registry
+
+    :return:    tuple of digest, layers, or None, None if the registry can't be queried
+    """
+    try:
+        digest, manifest, _ = _get_registry_manifest(image)
+    except Exception as exc:
+        debug(f"registry query for {image} failed: {exc}")
+        return None, None
+    return digest, [layer["digest"] for layer in manifest.get("layers", [])]
+
+
+def get_image_entrypoint(image, docker=None):
+    """
+    Gets entrypoint of a docker image, from the local docker daemon if available, else from its registry.
+
+    :param image:   docker image name
+    :param docker:  docker binary, or None if docker is not available
+    :return:        entrypoint (list of strings), or None if it can't be determined
+    """
+    if docker:
+        try:
+            output = subprocess.check_output([docker, "image", "inspect", image, "--format",
+                                              "{{json .Config.Entrypoint}}"], stderr=subprocess.DEVNULL)
+            entrypoint = json.loads(output.decode())
+            if entrypoint:
+                return entrypoint
+        except (subprocess.CalledProcessError, ValueError) as exc:
+            debug(f"docker image inspect {image} failed: {exc}")
+    try:
+        _, manifest, base_url = _get_registry_manifest(image)
+        with _registry_request(base_url + "blobs/" + manifest["config"]["digest"]) as resp:
+            return json.load(resp).get("config", {}).get("Entrypoint") or None
+    except Exception as exc:
+        debug(f"registry query for {image} failed: {exc}")
+        return None
+
+
+def get_image_digest(image, docker=None):
+    """
+    Gets digest and layer list of a docker image, from the local docker daemon if available, else from its registry.
+
+    :param image:   docker image name
+    :param docker:  docker binary, or None if docker is not available
+    :return:        tuple of digest, layers (None if the digest comes from the docker daemon), or None, None if the
+                    digest can't be determined
+    """
+    if docker:
+        digest = get_docker_digest(docker, image)
+        if digest:
+            return digest, None
+    return get_registry_digest(image)
+
+
+def singularity_build_environment():
+    """
+    Returns environment for singularity build. Unless the user has configured one already, a layer cache in
+    RADIOPADRE_DIR is used, so that layers unchanged between image versions are not downloaded again
+    """
+    env = os.environ.copy()
+    if not env.get("SINGULARITY_CACHEDIR") and not env.get("APPTAINER_CACHEDIR"):
+        cachedir = make_dir(os.path.join(make_radiopadre_dir(), ".singularity-cache"))
+        env["SINGULARITY_CACHEDIR"] = env["APPTAINER_CACHEDIR"] = cachedir
+    return env
+
+
+def sidecar_name(image_path):
+    return image_path + ".json"
+
+
+def read_sidecar(image_path):
+    """Returns dict of image metadata from sidecar of given image, or None if missing or invalid"""
+    filename = sidecar_name(image_path)
+    if not os.path.exists(filename):
+        return None
+    try:
+        return json.load(open(filename, "rt"))
+    except Exception as exc:
+        warning(f"error reading {filename}: {exc}, ignoring")
+        return None
+
+
+def write_sidecar(image_path, source, digest, layers):
+    """Writes sidecar with image metadata for given image. Layers are omitted if None (i.e. not known)"""
+    filename = sidecar_name(image_path)
+    metadata = dict(source=source, digest=digest, built=time.time())
+    if layers is not None:
+        metadata['layers'] = layers
+    try:
+        with open(filename + ".new", "wt") as sidecar:
+            json.dump(metadata, sidecar, indent=1)
+        os.rename(filename + ".new", filename)
+    except Exception as exc:
+        warning(f"error writing {filename}: {exc}")
@@ -1,14 +1,17 @@
-import os, subprocess, sys, time, re, calendar
-import datetime, getpass
+import os, subprocess, sys, getpass, atexit, threading
 
-from iglesia.utils import message, warning, error, bye, make_dir, make_radiopadre_dir, shell, DEVNULL, INPUT, check_output
-from radiopadre_client import config
+from iglesia import profiler
+from iglesia.utils import message, warning, error, bye, make_dir, make_radiopadre_dir, shell, DEVNULL, INPUT, \
+    check_output, find_which
+from radiopadre_client import config, registry
 
 singularity = None
 has_docker = None
+running_instance = None
 
-from . import docker
+from . import docker, image_utils, image_updater
 from .docker import get_session_info_dir, save_session_info, _run_container, _init_session_dir, _collect_runscript_arguments
+from .backend_utils import signal_session_processes
 import iglesia
 
 def init(binary, docker_binary=None):
@@ -24,17 +27,36 @@ def init(binary, docker_binary=None):
             has_docker = docker_binary
             docker.init(docker_binary)
 
-def read_session_info(container_name):
-    raise NotImplementedError("not available in singularity mode")
+def _stop_instances(instances):
+    """Stops the given instances (concurrently, since "singularity instance stop" takes one name at a time)"""
+    procs = [(name, subprocess.Popen([singularity, "instance", "stop", name], stdout=DEVNULL, stderr=subprocess.PIPE))
+             for name in instances]
+    for name, proc in procs:
+        _, err = proc.communicate()
+        if proc.returncode:
+            warning(f"failed to stop singularity instance {name} (exit code {proc.returncode}): "
+                    f"{err.decode(errors='replace').strip()}")
 
-def list_sessions():
-    return {}
-
-def identify_session(session_dict, arg):
-    raise NotImplementedError("not available in singularity mode")
-
-def kill_sessions(session_dict, session_ids):
-    raise NotImplementedError("not available in singularity mode")
+def kill_sessions(entries, wait=True):
+    """
+    Kills the given sessions (registry entries). Attached sessions are shut down by their client process. Instances
+    of persistent sessions are stopped.
+    """
+    global singularity
+    signal_session_processes(entries)
+    # entries from before the persist field was recorded: detached ones must be persistent
+    instances = [entry['name'] for entry in entries if entry.get('persist', entry['pid'] is None)]
+    if instances:
+        singularity = singularity or find_which("singularity")
+        if not singularity:
+            warning("singularity binary not found, unable to stop instances")
+            return
+        message("    stopping instances: {}".format(" ".join(instances)))
+        if wait:
+            _stop_instances(instances)
+        else:
+            # not a daemon thread, so the stops still complete (and get checked) if we exit in the meantime
+            threading.Thread(target=_stop_instances, args=(instances,)).start()
 
 def get_singularity_image(docker_image):
     dir = config.SINGULARITY_IMAGE_DIR or os.environ.get('RADIOPADRE_SINGULARITY_IMAGE_DIR') or iglesia.RADIOPADRE_DIR
@@ -61,51 +83,58 @@ def update_installation(rebuild=False, docker_pull=True):
         config.SINGULARITY_AUTO_BUILD = build_image = True
         message(f"--singularity-rebuild specified, removing singularity image {singularity_image}")
 
+    # in background update mode, start with the existing image, and (re)build a newer one (if any)
+    # while the session runs
+    if not build_image and image_updater.enabled():
+        image_updater.report_status(docker_image)
+        proc = image_updater.start_update(docker_image, docker=has_docker, singularity=singularity,
+                                          singularity_image=singularity_image)
+        if proc:
+            image_updater.watch_update(docker_image, proc)
+        message(f"Using existing radiopadre singularity image {singularity_image}")
+        return
+
     # pull down docker image first
     if has_docker and docker_pull:
         message("Checking docker image (from which our singularity image is built)")
         docker.update_installation(enable_pull=True)
-    # if we're not forced to build yet, check for an update
+    # digest of the docker image, if known
+    digest = layers = None
+
+    # if we're not forced to build yet, check for an update, by comparing the digest of the docker image
+    # with the one recorded when the singularity image was built
     if config.UPDATE and not build_image:
-        if has_docker:
-            # check timestamp of docker image
-            docker_image_time = None
-            output = check_output(f"{has_docker} image inspect {docker_image} -f '{{{{ .Created }}}}'").strip()
-            message(f"  docker image timestamp is {output}")
-            # in Python 3.7 we have datetime.fromisoformat(date_string), but for now we muddle:
-            match = output and re.match("(^.*)[.](\d+)Z", output)
-            if match:
-                try:
-                    docker_image_time = calendar.timegm(time.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S"))
-                    docker_image_time = datetime.datetime.utcfromtimestamp(docker_image_time)
-                except ValueError:
-                    pass
-            sing_image_time = datetime.datetime.utcfromtimestamp(os.path.getmtime(singularity_image))
-            message("  singularity image timestamp is {}".format(sing_image_time.isoformat()))
-            if docker_image_time is None:
-                warning(f"can't parse docker image timestamp '{output}', rebuilding {singularity_image} just in case")
-                build_image = True
-            elif docker_image_time > sing_image_time:
-                warning(f"rebuilding outdated singularity image {singularity_image}")
-                build_image = True
-            else:
-                message(f"singularity image {singularity_image} is up-to-date")
-        else:
-            message(f"--update specified, will force-rebuild {singularity_image} from registry")
-            message(f"(If docker was available, we could check timestamps to see if this step is necessary. But we can't.)")
+        digest, layers = image_utils.get_image_digest(docker_image, docker=has_docker)
+        sidecar = image_utils.read_sidecar(singularity_image)
+        if digest is None:
+            warning(f"unable to determine the digest of {docker_image}, keeping the existing singularity image")
+            warning(f"  (use --singularity-rebuild to force a rebuild)")
+        elif sidecar is None or not sidecar.get("digest"):
+            warning(f"no digest recorded for {singularity_image}, rebuilding it")
+            build_image = True
+        elif sidecar["digest"] != digest:
+            message(f"  docker image digest is {digest}")
+            message(f"  singularity image was built from {sidecar['digest']}")
+            warning(f"rebuilding outdated singularity image {singularity_image}")
             build_image = True
+        else:
+            message(f"singularity image {singularity_image} is up-to-date ({digest})")
 
     # now build if needed
     if build_image:
-        warning(f"Rebuilding singularity image from docker://{docker_image}")
+        if digest is None:
+            digest, layers = image_utils.get_image_digest(docker_image, docker=has_docker)
+        # pin the build to the digest we checked, so that the sidecar describes what was actually built
+        source = f"docker://{image_utils.pinned_reference(docker_image, digest) if digest else docker_image}"
+        warning(f"Rebuilding singularity image from {source}")
         warning(f"  (This may take a few minutes....)")
         singularity_image_new = os.path.splitext(singularity_image)[0] + ".new.simg"
         if os.path.exists(singularity_image_new):
             os.unlink(singularity_image_new)
-        cmd = [singularity, "build", singularity_image_new, f"docker://{docker_image}"]
+        cmd = [singularity, "build", singularity_image_new, source]
         message("running " + " ".join(cmd))
         try:
-            subprocess.check_call(cmd)
+            subprocess.check_call(cmd, env=image_utils.singularity_build_environment())
         except subprocess.CalledProcessError as exc:
             if config.IGNORE_UPDATE_ERRORS:
                 if os.path.exists(singularity_image):
@@ -125,12 +154,13 @@ def update_installation(rebuild=False, docker_pull=True):
         else:
             message(f"Build successful, renaming to {singularity_image}")
             os.rename(singularity_image_new, singularity_image)
+            if digest:
+                image_utils.write_sidecar(singularity_image, source, digest, layers)
+            elif os.path.exists(image_utils.sidecar_name(singularity_image)):
+                os.unlink(image_utils.sidecar_name(singularity_image))
     else:
         message(f"Using existing radiopadre singularity image {singularity_image}")
 
-    # not supported with Singularity
-    config.CONTAINER_PERSIST = False
-
     # config.CONTAINER_DEBUG = False
 
 
@@ -173,15 +203,22 @@ def start_session(container_name, selected_ports, userside_ports, notebook_path,
         if os.path.isdir(config.SERVER_INSTALL_PATH):
             docker_opts += ["-B", "{}:/radiopadre".format(config.SERVER_INSTALL_PATH)]
 
-    # if not config.CONTAINER_DEBUG:
-    #     command = [singularity, "instance.start"] + docker_opts + \
-    #               [singularity_image, container_name]
-    #     message("running {}".format(" ".join(map(str, command))))
-    #     subprocess.call(command)
-    #     docker_opts = [singularity, "exec", "instance://{}".format(container_name)]
-    # else:
-    #     docker_opts = [singularity, "exec" ] + docker_opts + [singularity_image]
-    docker_opts = [singularity, "run" ] + docker_opts + [singularity_image]
+    # in persistent mode, start an instance with the mounts, and run the session inside it. The session is detached
+    # from our process, so that it keeps running (and can be reattached to) after we exit
+    persist = config.CONTAINER_PERSIST and not config.CONTAINER_DEBUG and not config.NBCONVERT
+    if persist:
+        command = [singularity, "instance", "start"] + docker_opts + [singularity_image, container_name]
+        message("Running {}".format(" ".join(map(str, command))))
+        with profiler.phase("singularity instance start"):
+            if subprocess.call(command, stdout=DEVNULL):
+                bye(f"failed to start singularity instance {container_name}")
+        global running_instance
+        running_instance = container_name
+        atexit.register(reap_running_instance)
+        registry.update(config.SESSION_ID, persist=True)
+        docker_opts = [singularity, "run", f"instance://{container_name}"]
+    else:
+        docker_opts = [singularity, "run" ] + docker_opts + [singularity_image]
     container_ports = selected_ports
 
     # build up command-line arguments
@@ -192,6 +229,8 @@ def start_session(container_name, selected_ports, userside_ports, notebook_path,
                     "--env", f"IPYTHONDIR=/tmp/{getpass.getuser()}-ipython",
                     "--env", f"XDG_RUNTIME_DIR="]
     os.environ["RADIOPADRE_CONTAINER_NAME"] = container_name
+    # image name plus build time identifies the image contents (used to key in-container caches)
+    os.environ["RADIOPADRE_CONTAINER_IMAGE"] = f"{singularity_image}:{int(os.path.getmtime(singularity_image))}"
     for name, value in os.environ.items():
         if name.startswith("RADIOPADRE_"):
             docker_opts += ["--env", f"{name}={value}"]
@@ -200,16 +239,30 @@ def start_session(container_name, selected_ports, userside_ports, notebook_path,
         docker_opts.append(notebook_path)
 
     _run_container(container_name, docker_opts, jupyter_port=selected_ports[0], 
-                    browser_urls=browser_urls, run_browser=run_browser, singularity=True)
+                    browser_urls=browser_urls, run_browser=run_browser, singularity=True,
+                    helper_ports=selected_ports[1:4],
+                    logfile=os.path.join(session_info_dir, "session.log") if persist else None)
 
     if config.NBCONVERT:
         return
 
+    if persist and config.CONTAINER_DETACH:
+        message("exiting: container session will remain running.")
+        _detach_instance()
+        sys.exit(0)
+
+    if persist:
+        prompt = "Type 'exit' to kill the container session, or 'D' to detach: "
+    else:
+        prompt = "Type 'exit' to kill the container session: "
     try:
         while True:
-            a = INPUT("Type 'exit' to kill the container session: ")
+            a = INPUT(prompt)
             if a.lower() == 'exit':
                 sys.exit(0)
+            if a.upper() == 'D' and persist:
+                _detach_instance()
+                sys.exit(0)
     except BaseException as exc:
         if type(exc) is KeyboardInterrupt:
             message("Caught Ctrl+C")
@@ -220,12 +273,24 @@ def start_session(container_name, selected_ports, userside_ports, notebook_path,
         else:
             message("Caught exception {} ({})".format(exc, type(exc)))
             status = 1
-        if status:
-            message("Killing the container")
-            subprocess.call([singularity, "instance.stop", singularity_image, container_name], stdout=DEVNULL)
         sys.exit(status)
 
 
+def _detach_instance():
+    """Leaves the running instance alive when we exit, and hands it over to the session registry"""
+    global running_instance
+    message(f"Session is detached, use 'run-radiopadre resume {config.SESSION_ID[:8]}' to reattach")
+    running_instance = None  # to avoid reaping
+    registry.update(config.SESSION_ID, pid=None)
+
+
 def kill_container(name):
-    singularity_image = get_singularity_image(config.DOCKER_IMAGE)
-    shell(f"{singularity} instance.stop {singularity_image} {name}")
+    message(f"Stopping singularity instance {name}")
+    shell(f"{singularity} instance stop {name}", ignore_fail=True)
+
+
+def reap_running_instance():
+    global running_instance
+    if running_instance:
+        kill_container(running_instance)
+    running_instance = None
@@ -1,10 +1,15 @@
 import sys, os, os.path, subprocess, time, getpass
-from iglesia.utils import message, warning, error, debug, shell, bye, INPUT, check_output, find_which
+from iglesia.utils import message, warning, error, debug, shell, bye, INPUT, check_output, find_which, \
+    clear_which_cache
 
 from radiopadre_client import config
 from radiopadre_client.server import run_browser
 import iglesia
-from .backend_utils import await_server_startup, update_server_from_repository
+from iglesia import profiler
+from .backend_utils import await_server_startup, update_server_from_repository, signal_session_processes
+from . import wheelhouse
+
+_wheelhouse = None
 
 def init():
     pass
@@ -12,14 +17,45 @@ def init():
 def save_session_info(container_name, selected_ports, userside_ports):
     pass
 
-def list_sessions():
-    raise NotImplementedError("not available in virtualenv mode")
-
-def identify_session(session_dict, arg):
-    raise NotImplementedError("not available in virtualenv mode")
-
-def kill_sessions(session_dict, session_ids):
-    raise NotImplementedError("not available in virtualenv mode")
+def kill_sessions(entries, wait=True):
+    """Kills the given sessions (registry entries) by signalling their client processes"""
+    signal_session_processes(entries)
+
+
+def _pip_install_requirement():
+    """Returns the pip requirement radiopadre is to be installed from, or None if installing from a path or repository"""
+    if config.SERVER_INSTALL_PATH and os.path.exists(config.SERVER_INSTALL_PATH):
+        return None
+    if config.SERVER_INSTALL_REPO:
+        return None
+    return config.SERVER_INSTALL_PIP or None
+
+
+def _get_wheelhouse():
+    """
+    Returns pip options for installing from the wheelhouse matching our requirement and extras, building it first
+    if needed (or if --update is given). Returns an empty string to install from the network as usual
+    """
+    global _wheelhouse
+    if _wheelhouse is None:
+        _wheelhouse = ""
+        requirement = _pip_install_requirement()
+        if config.VENV_WHEELHOUSE and requirement:
+            extras = config.VENV_EXTRAS.split(",") if config.VENV_EXTRAS else []
+            path = wheelhouse.find_wheelhouse(requirement, extras, config.VENV_WHEELHOUSE_PATH)
+            if path is None or config.UPDATE:
+                try:
+                    path = wheelhouse.build_wheelhouse(requirement, extras,
+                                                       os.path.join(config.RADIOPADRE_VENV, "bin", "python"),
+                                                       replace=path is not None)
+                except Exception as exc:
+                    warning(f"failed to build wheelhouse: {exc}")
+                    if path is not None:
+                        warning(f"will install from existing wheelhouse {path}")
+            if path is not None:
+                message(f"  Installing from wheelhouse {path}")
+                _wheelhouse = wheelhouse.pip_options(path)
+    return _wheelhouse
 
 
 def update_installation():
@@ -80,11 +116,11 @@ def update_installation():
             exec(code, dict(__file__=activation_script), {})
 
         if new_venv: 
-            shell(f"{pip_install} -U pip setuptools wheel uv")
+            shell(f"{pip_install} {_get_wheelhouse()} -U {' '.join(wheelhouse.BOOTSTRAP_PACKAGES)}")
             if config.VENV_EXTRAS:
                 extras = " ".join(config.VENV_EXTRAS.split(","))
                 message(f"Installing specified extras: {extras}")
-                shell(f"{pip_install} {extras}")
+                shell(f"{pip_install} {_get_wheelhouse()} {extras}")
 
     # now check for a radiopadre install inside the venv
     have_install = check_output("pip show radiopadre")
@@ -118,7 +154,7 @@ def update_installation():
                 install = f"git+{config.SERVER_INSTALL_REPO}@{branch}"
         elif config.SERVER_INSTALL_PIP:
             message(f"--server-install-pip {config.SERVER_INSTALL_PIP} is configured.")
-            install = config.SERVER_INSTALL_PIP
+            install = f"{_get_wheelhouse()} {config.SERVER_INSTALL_PIP}".strip()
         else:
             bye("no radiopadre installation method specified (see --server-install options)")
 
@@ -135,6 +171,9 @@ def update_installation():
         message(f"Running post-installation script {cmd}")
         shell(cmd, env=env)
 
+        # newly installed scripts (e.g. radiopadre-http-server.py) may have been looked up already
+        clear_which_cache()
+
     # if not config.INSIDE_CONTAINER_PORTS:
     #     message(f"  Radiopadre has been installed from {config.SERVER_INSTALL_PATH}")
 
@@ -184,8 +223,9 @@ def start_session(container_name, selected_ports, userside_ports, notebook_path,
         os.environ["RADIOPADRE_DISABLE_CASACORE"] = "1"
 
     # start helper processes
-    iglesia.init_helpers(radiopadre_base, verbose=config.VERBOSE > 0,
-                         interactive=not config.NBCONVERT, certificate=config.SERVER_PEM)
+    with profiler.phase("iglesia.helpers.init_helpers"):
+        iglesia.init_helpers(radiopadre_base, verbose=config.VERBOSE > 0,
+                             interactive=not config.NBCONVERT, certificate=config.SERVER_PEM)
 
     # add CARTA URL, if configured
     if config.CARTA_BROWSER and iglesia.CARTA_VERSION:
@@ -196,9 +236,10 @@ def start_session(container_name, selected_ports, userside_ports, notebook_path,
     jupyter_path = config.RADIOPADRE_VENV + "/bin/jupyter"
     message("Starting: {} {} in {}".format(jupyter_path, " ".join(JUPYTER_OPTS), os.getcwd()))
 
-    notebook_proc = subprocess.Popen([jupyter_path] + JUPYTER_OPTS,
-                                     stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr,
-                                     bufsize=1, universal_newlines=True, env=os.environ)
+    with profiler.phase("jupyter start"):
+        notebook_proc = subprocess.Popen([jupyter_path] + JUPYTER_OPTS,
+                                         stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr,
+                                         bufsize=1, universal_newlines=True, env=os.environ)
 
     ## use this instead to debug the sessison
     #notebook_proc = subprocess.Popen([config.RADIOPADRE_VENV+"/bin/ipython"],
@@ -212,19 +253,15 @@ def start_session(container_name, selected_ports, userside_ports, notebook_path,
     else:
         iglesia.register_helpers(notebook_proc)
 
-        # launch browser
         if browser_urls:
-            if run_browser:
-                iglesia.register_helpers(*run_browser(*browser_urls))
             for url in browser_urls[::-1]:
                 message(f"Browse to URL: {url}", color="GREEN")
 
-
     #    elif not config.REMOTE_MODE_PORTS and not config.INSIDE_CONTAINER_PORTS:
     #        message("Please point your browser to {}".format(" ".join(browser_urls)))
 
-        # pause to let the Jupyter server spin up
-        wait = await_server_startup(jupyter_port, init_wait=0, process=notebook_proc)
+        # wait for the Jupyter server to spin up
+        wait = await_server_startup(jupyter_port, process=notebook_proc)
 
         if wait is None:
             if notebook_proc.returncode is not None:
@@ -233,6 +270,12 @@ def start_session(container_name, selected_ports, userside_ports, notebook_path,
 
         message(f"The jupyter notebook server is running on port {jupyter_port} (after {wait:.2f} secs)")
 
+        # launch browser as soon as the server is ready
+        if browser_urls and run_browser:
+            iglesia.register_helpers(*run_browser(*browser_urls))
+
+        profiler.report()
+
         if config.CONTAINER_TEST:
             message(f"--container-test was specified, dry run is complete")
             sys.exit(0)
@@ -0,0 +1,144 @@
+"""
+Local wheelhouse for offline venv installs.
+
+A wheelhouse is a directory of wheels for radiopadre, the requested extras, and the venv bootstrap packages,
+with all their dependencies. Wheelhouses live under RADIOPADRE_DIR/wheelhouse, in a subdirectory named by a
+hash of the requested server version (the pip requirement), the extras, and the Python version and platform
+(since wheels are specific to these). A manifest.json with the sha256 of every wheel is written last, so only
+complete wheelhouses are used, and these are checked against the manifest before use.
+A wheelhouse can be built once on a node with network access, and copied to (or shared with, via
+--venv-wheelhouse-path) nodes without it: the venv is then created and updated with "--no-index".
+"""
+import os, os.path, sys, json, time, hashlib, shutil, subprocess, sysconfig
+
+import iglesia
+from iglesia.utils import message, warning, debug, make_dir
+
+# packages installed into a new venv before anything else
+BOOTSTRAP_PACKAGES = ["pip", "setuptools", "wheel", "uv"]
+
+# bump this if the wheelhouse layout changes
+_FORMAT = 1
+
+
+def wheelhouse_key(requirement, extras):
+    """Returns key identifying wheelhouse for the given radiopadre pip requirement and list of extras"""
+    spec = dict(format=_FORMAT, requirement=requirement, extras=sorted(extras),
+                python=f"cp{sys.version_info.major}{sys.version_info.minor}", platform=sysconfig.get_platform())
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _search_path(extra_dirs=None):
+    """Returns list of directories to search for wheelhouses: our own first, then any configured shared ones"""
+    return [os.path.join(iglesia.RADIOPADRE_DIR, "wheelhouse")] + \
+           [os.path.expanduser(path) for path in (extra_dirs or "").split(":") if path]
+
+
+def _sha256(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def verify_wheelhouse(path):
+    """Returns True if the wheelhouse at path has a manifest, and its wheels are exactly the ones in the manifest"""
+    manifest_file = os.path.join(path, "manifest.json")
+    if not os.path.exists(manifest_file):
+        return False
+    try:
+        wheels = json.load(open(manifest_file, "rt"))['wheels']
+        present = sorted(name for name in os.listdir(path) if name.endswith(".whl"))
+    except Exception as exc:
+        warning(f"error reading wheelhouse {path}: {exc}, ignoring it")
+        return False
+    if present != sorted(wheels):
+        warning(f"wheelhouse {path} does not match its manifest, ignoring it")
+        return False
+    for name, sha256 in wheels.items():
+        if _sha256(os.path.join(path, name)) != sha256:
+            warning(f"wheelhouse {path}: checksum mismatch for {name}, ignoring the wheelhouse")
+            return False
+    return True
+
+
+def find_wheelhouse(requirement, extras, extra_dirs=None):
+    """
+    Looks for a complete wheelhouse for the given requirement and extras, with wheels matching its manifest.
+
+    :param extra_dirs:  colon-separated list of additional directories to search
+    :return:            path to wheelhouse, or None if not found
+    """
+    key = wheelhouse_key(requirement, extras)
+    for dirname in _search_path(extra_dirs):
+        path = os.path.join(dirname, key)
+        if verify_wheelhouse(path):
+            debug(f"found wheelhouse {path} for {requirement} {' '.join(extras)}")
+            return path
+    return None
+
+
+def _swap_in(staging, path, replace):
+    """
+    Renames the staging directory to path. If path already exists (renaming onto a non-empty directory fails),
+    another client has built the same wheelhouse concurrently, or we are rebuilding it. Unless replace is True,
+    an existing valid wheelhouse is then kept, otherwise it is moved aside and replaced.
+    Returns True if the staging directory was swapped in.
+    """
+    try:
+        os.rename(staging, path)
+        return True
+    except OSError:
+        pass
+    if not replace and verify_wheelhouse(path):
+        debug(f"wheelhouse {path} has been built by another client in the meantime, using it")
+        return False
+    old = f"{path}.old-{os.getpid()}"
+    try:
+        os.rename(path, old)
+    except OSError:
+        pass
+    try:
+        os.rename(staging, path)
+        return True
+    except OSError:
+        # yet another client has swapped in its wheelhouse in the meantime
+        if not verify_wheelhouse(path):
+            raise
+        return False
+    finally:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def build_wheelhouse(requirement, extras, python, replace=False):
+    """
+    Builds (or rebuilds) the wheelhouse for the given requirement and extras, using "pip wheel". Needs
+    network access.
+
+    :param python:  Python interpreter of the venv (whose pip is used)
+    :param replace: if True, an existing wheelhouse is replaced by the new one, otherwise it is used as is
+                    if another client has built it in the meantime
+    :return:        path to wheelhouse
+    """
+    key = wheelhouse_key(requirement, extras)
+    dirname = make_dir(os.path.join(iglesia.RADIOPADRE_DIR, "wheelhouse"))
+    path = os.path.join(dirname, key)
+    staging = f"{path}.tmp-{os.getpid()}"
+    requirements = BOOTSTRAP_PACKAGES + list(extras) + [requirement]
+    message(f"Building wheelhouse {path} for {' '.join(requirements)}")
+    try:
+        subprocess.check_call([python, "-m", "pip", "wheel", "--wheel-dir", staging] + requirements)
+        wheels = sorted(name for name in os.listdir(staging) if name.endswith(".whl"))
+        manifest = dict(requirement=requirement, extras=list(extras), created=time.time(),
+                        wheels={name: _sha256(os.path.join(staging, name)) for name in wheels})
+        with open(os.path.join(staging, "manifest.json"), "wt") as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+        _swap_in(staging, path, replace)
+    finally:
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+    message(f"  wheelhouse contains {len(wheels)} wheels")
+    return path
+
+
+def pip_options(path):
+    """Returns options for pip/uv to install from the given wheelhouse only"""
+    return f"--no-index --find-links {path}"
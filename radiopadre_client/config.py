@@ -1,5 +1,4 @@
-import os, os.path, subprocess, re, getpass
-import six
+import os, os.path, re, getpass
 
 try:
     import configparser
@@ -28,10 +27,11 @@ CONTAINER_DEBUG = False
 CONTAINER_DETACH = False
 CONTAINER_PERSIST = False
 CONTAINER_DEV = False
+PREWARM = 0
 GRIM_REAPER = True
 SSL = None
 BACKEND = []
-UNAME = subprocess.check_output("uname").decode().strip()
+UNAME = os.uname().sysname
 USER = getpass.getuser()
 BROWSER = os.environ.get("RADIOPADRE_BROWSER", "default")
 NEW_WINDOW = False
@@ -51,6 +51,7 @@ K8S_AUTO_CLEANUP = True
 K8S_NODE_SELECTOR = None
 K8S_CPU_REQUEST = None
 K8S_RAM_REQUEST = None
+K8S_WARM_POD = False
 
 
 INSTALL_JS9 = False
@@ -74,16 +75,20 @@ SINGULARITY_REBUILD = None
 PULL_DOCKER = None
 PULL_SINGULARITY = None
 IGNORE_UPDATE_ERRORS = False
+BACKGROUND_UPDATE = False
 FULL_CONSENT = None
 NBCONVERT = None
 VERBOSE = 0
 BORING = False
 NON_INTERACTIVE = 0
 TIMESTAMPS = False
+PROFILE_STARTUP = False
 VENV_REINSTALL = False
 VENV_IGNORE_JS9 = False
 VENV_IGNORE_CASACORE = False
 VENV_EXTRAS = "None"
+VENV_WHEELHOUSE = True
+VENV_WHEELHOUSE_PATH = ""
 VENV_DRY_RUN = None
 
 # set to the unique session ID
@@ -109,6 +114,9 @@ REMOTE_UTILITY_SHELL = "/bin/bash -c"
 # command to pre-execute on remote (e.g. "module load python/3.10.9")
 REMOTE_PREP_COMMAND = ""
 
+# local directory whose notebooks are synced with the remote notebook directory
+NOTEBOOK_SYNC = ""
+
 CONFIG_FILE = os.path.join(iglesia.RADIOPADRE_DIR, "radiopadre-client.config")
 
 COMPLETE_INSTALL_COOKIE = ".radiopadre.install.complete"
@@ -127,7 +135,7 @@ NON_PERSISTING_OPTIONS.add("-u")
 def _get_config_value(section, key):
     globalval = globals().get(key.upper())
     value = section[key]
-    if globalval is None or isinstance(globalval, six.string_types):
+    if globalval is None or isinstance(globalval, str):
         return value
     elif type(globalval) is bool:
         if value.lower() in {'no', '0', 'false'}:
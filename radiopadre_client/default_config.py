@@ -75,6 +75,9 @@ DefaultConfig = OrderedDict(
     DOCKER_CARTA_VERSION=__docker_carta_version__,
     RADIOPADRE_SETTINGS="",
     CONTAINER_DEBUG=False,
+    CONTAINER_PERSIST=False,
+    CONTAINER_DETACH=False,
+    PREWARM=0,
     GRIM_REAPER=True,
     REMOTE_HOP="",
     REMOTE_RADIOPADRE_DIR="~/.radiopadre",
@@ -83,6 +86,7 @@ DefaultConfig = OrderedDict(
     REMOTE_PYTHON="python3",
     REMOTE_PREP_COMMAND="",
     REMOTE_PORT=22,
+    NOTEBOOK_SYNC="",
     INSTALL_JS9=False,
     CLIENT_INSTALL_PATH="~/radiopadre-client",
     CLIENT_INSTALL_REPO="https://github.com/ratt-ru/radiopadre-client.git" if __install_from_branch__ else "",
@@ -96,6 +100,7 @@ DefaultConfig = OrderedDict(
     SINGULARITY_IMAGE_DIR="",
     SINGULARITY_AUTO_BUILD=True,
     IGNORE_UPDATE_ERRORS=False,
+    BACKGROUND_UPDATE=False,
     VERBOSE=0,
     LOG=False,
 #    SSL=None,
@@ -104,6 +109,8 @@ DefaultConfig = OrderedDict(
     VENV_IGNORE_JS9=False,
     VENV_IGNORE_CASACORE=False,
     VENV_EXTRAS="None",
+    VENV_WHEELHOUSE=True,
+    VENV_WHEELHOUSE_PATH="",
     K8S_CONTEXT = "",
     K8S_NAMESPACE = "",
     K8S_UID = -1,
@@ -115,6 +122,7 @@ DefaultConfig = OrderedDict(
     K8S_NODE_SELECTOR = "",
     K8S_CPU_REQUEST = "2",
     K8S_RAM_REQUEST = "8Gi",
+    K8S_WARM_POD = False,
 
     # All of the options above can be persisted in the config file via --save-config-host or --save-config-session.
     # The options below are "one-shot" and non-persisting, they are not saved to the config. This is indicated by a
@@ -128,6 +136,7 @@ DefaultConfig = OrderedDict(
     VENV_REINSTALL=None,
     VENV_DRY_RUN=None,
     PULL_DOCKER=None,
-    PULL_SINGULARITY=None
+    PULL_SINGULARITY=None,
+    PROFILE_STARTUP=None
 )
 
@@ -0,0 +1,154 @@
+"""
+Multi-host fan-out: runs remote sessions for several host:dir targets from one run-radiopadre invocation.
+
+The remote session logic relies on per-process state (config settings, the notebook token, the ssh options), so
+each target is driven by a run-radiopadre child process of its own, while this module drives all the children
+from one asyncio loop, so their probes, installs and launches all proceed concurrently. Before that, the ssh
+master connections for all hosts are opened concurrently (non-interactively, falling back to one at a time for
+hosts that need a password), so the children share one mux per host. Local ports are reserved by each child via
+iglesia.ports, which hands out non-overlapping blocks. The children are run without a browser; once all sessions
+are up (or have failed), their URLs are opened in the browser together.
+"""
+import os, sys, re, asyncio, subprocess, signal
+
+from iglesia.utils import message, warning, error, debug, bye
+from . import config, remote_parser
+from .ssh_mux import SSHMux
+from .server import run_browser
+
+RUN_RADIOPADRE = os.path.abspath(sys.argv[0])
+
+_URL_RE = re.compile(r"Browse to URL: ([^\s\033]+)")
+_UP_MARKER = "The remote radiopadre session is now fully up"
+
+# options that must not be passed on to the children (since they would save the --browser None setting)
+_DROPPED_OPTIONS = {"-s", "--save-config-host", "-e", "--save-config-session"}
+
+
+class _Target(object):
+    def __init__(self, target):
+        self.target = target
+        self.host, self.path = target.split(":", 1)
+        self.urls = []
+        self.up = asyncio.Event()
+        self.proc = None
+        self.status = None
+
+
+async def _open_mux(host, batch):
+    """Opens ssh master connection to host. In batch mode, fails rather than prompt for a password"""
+    mux = SSHMux(host)
+    proc = await asyncio.create_subprocess_exec(*mux.open_command(batch), stdin=subprocess.DEVNULL if batch else None,
+                                                stdout=subprocess.DEVNULL,
+                                                stderr=subprocess.DEVNULL if batch else None)
+    return await proc.wait() == 0
+
+
+async def _open_muxes(hosts):
+    results = await asyncio.gather(*[_open_mux(host, batch=True) for host in hosts])
+    for host, success in zip(hosts, results):
+        if not success:
+            message(f"Opening ssh connection to {host}. You may be prompted for your password.")
+            if not await _open_mux(host, batch=False):
+                warning(f"unable to open ssh connection to {host}, its session will probably fail")
+
+
+async def _run_target(target, child_argv):
+    """Runs a child run-radiopadre for the target, relaying its output, until it exits"""
+    cmd = [sys.executable, RUN_RADIOPADRE] + child_argv + ["--browser", "None", target.target]
+    debug(f"running {' '.join(cmd)}")
+    proc = target.proc = await asyncio.create_subprocess_exec(*cmd, stdin=subprocess.DEVNULL,
+                                                              stdout=asyncio.subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            line = line.decode('utf-8', errors='replace').rstrip()
+            remote_parser.dispatcher(line)(f"[{target.target}] {line}")
+            match = _URL_RE.search(line)
+            if match:
+                target.urls.append(match.group(1))
+            elif _UP_MARKER in line:
+                target.up.set()
+        target.status = await proc.wait()
+    finally:
+        # an exited child counts as done, as far as the browser launch is concerned
+        target.up.set()
+    if target.status:
+        error(f"session for {target.target} has exited with code {target.status}")
+    else:
+        message(f"session for {target.target} has exited")
+
+
+async def _launch_browser(targets):
+    """Opens the URLs of all sessions together, once all are up"""
+    await asyncio.gather(*[target.up.wait() for target in targets])
+    urls = [url for target in targets if target.status is None for url in target.urls]
+    message(f"{len([t for t in targets if t.status is None])} of {len(targets)} session(s) are up")
+    if urls:
+        await asyncio.get_running_loop().run_in_executor(None, run_browser, *urls)
+    message("Press Ctrl+C to kill all sessions")
+
+
+async def _run_all(targets, child_argv):
+    await _open_muxes(sorted({target.host for target in targets}))
+    browser_task = asyncio.create_task(_launch_browser(targets))
+    try:
+        await asyncio.gather(*[_run_target(target, child_argv) for target in targets])
+    finally:
+        browser_task.cancel()
+
+
+def run_fanout(targets, argv, options):
+    """
+    Runs sessions for several host:dir targets concurrently
+
+    :param targets: list of "host:dir" strings
+    :param argv:    full command line, which (minus the targets) is passed on to each child
+    :param options: parsed options
+    :return:        exit code: 0 if all sessions exited cleanly
+    """
+    if options.save_config_host or options.save_config_session:
+        warning("-s/-e are ignored when running sessions on several hosts")
+    # the children can't prompt for input, so anything that would ask for confirmation must be consented to up front
+    if options.venv_reinstall and not options.full_consent:
+        bye("--venv-reinstall asks for confirmation on each host, which is not possible when running sessions\n"
+            "on several hosts. Add --full-consent if you really mean it.")
+    child_argv = [arg for arg in argv if arg not in targets and arg not in _DROPPED_OPTIONS]
+
+    if options.browser is not config.DEFAULT_VALUE:
+        config.BROWSER = options.browser
+    if str(config.BROWSER).upper() in ("NONE", "FALSE", "0"):
+        config.BROWSER = None
+    config.NEW_WINDOW = bool(options.new_window)
+
+    message(f"Starting sessions on {len(targets)} hosts: {' '.join(targets)}")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # the _Target events must be created with our loop current
+    targets = [_Target(target) for target in targets]
+
+    # the children are in our process group, so they get the Ctrl+C too. We let them shut down, unless
+    # Ctrl+C is pressed again
+    interrupts = 0
+    def interrupted():
+        nonlocal interrupts
+        interrupts += 1
+        if interrupts == 1:
+            message("Ctrl+C caught, waiting for sessions to exit")
+        else:
+            warning("Ctrl+C caught again, killing sessions")
+            for target in targets:
+                if target.proc is not None and target.proc.returncode is None:
+                    target.proc.kill()
+    loop.add_signal_handler(signal.SIGINT, interrupted)
+
+    try:
+        loop.run_until_complete(_run_all(targets, child_argv))
+    finally:
+        loop.remove_signal_handler(signal.SIGINT)
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+    # a session killed by a signal has a negative status, so look for any non-zero one
+    return next((target.status for target in targets if target.status), 0)
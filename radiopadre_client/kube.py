@@ -1,8 +1,7 @@
-import os, sys, subprocess, re, time, traceback, shlex, asyncio, signal
+import os, sys, re, time, traceback, shlex, asyncio, signal
 from dataclasses import dataclass
 from typing import Optional, Any
-import getpass, secrets, grp, pwd, json, yaml, uuid
-import rich
+import getpass, secrets, grp, pwd, json, uuid
 
 import kubernetes
 from kubernetes.client.api import core_v1_api
@@ -14,10 +13,16 @@ from urllib3.exceptions import HTTPError, ReadTimeoutError
 from . import config
 
 import iglesia
-from iglesia.utils import DEVNULL, message, warning, error, debug, bye, find_unused_port, Poller, INPUT, find_which
+from iglesia.utils import DEVNULL, message, warning, error, debug, bye, Poller, INPUT, find_which
+from iglesia.ports import reserve_ports
 from iglesia.helpers import NUM_PORTS
 
 from radiopadre_client.server import run_browser
+from .kube_watch import PodWatcher
+from .kube_forward import PortForwarder
+from .kube_logs import LogFollower
+from . import kube_pods
+from .backends import image_utils
 
 config.SESSION_ID = uuid.uuid4().hex
 session_user = getpass.getuser()
@@ -42,15 +47,13 @@ class UserInfo(object):
 _uid = os.getuid()
 _gid = os.getgid()
 
-# Find remote radiopadre script
-def run_k8s_session(pvc_name, notebook_path, extra_arguments):
 
-    kubectl = find_which("kubectl")
-    if not kubectl:
-        error("kubectl binary not found")
-        return 1
+def init_k8s():
+    """
+    Loads k8s config, and works out the context, namespace and nodeSelector to use
 
-    status = 0
+    :return: tuple of context name, namespace, nodeSelector dict, or None on error
+    """
     k8s_context = config.K8S_CONTEXT or None
 
     if k8s_context:
@@ -71,8 +74,8 @@ def run_k8s_session(pvc_name, notebook_path, extra_arguments):
 
     k8s_namespace = ctx.get('namespace', None) or config.K8S_NAMESPACE
     if not k8s_namespace:
-        error(f"no default k8s namespace configured by the '{name}' context, and --k8s-namespace is not given")
-        return 1
+        error(f"no default k8s namespace configured by the '{k8s_context}' context, and --k8s-namespace is not given")
+        return None
     
     # setup nodeSelector
     nodeSel = {}
@@ -83,7 +86,19 @@ def run_k8s_session(pvc_name, notebook_path, extra_arguments):
                 nodeSel[key] = value
             else:
                 error(f"invalid --k8s-node-selector setting: {keyval}")
-                return 1
+                return None
+
+    return k8s_context, k8s_namespace, nodeSel
+
+
+# Find remote radiopadre script
+def run_k8s_session(pvc_name, notebook_path, extra_arguments):
+
+    status = 0
+    k8s_setup = init_k8s()
+    if k8s_setup is None:
+        return 1
+    k8s_context, k8s_namespace, nodeSel = k8s_setup
 
     kube_api = core_v1_api.CoreV1Api()
 
@@ -111,10 +126,25 @@ def run_k8s_session(pvc_name, notebook_path, extra_arguments):
         traceback.print_exc()
         error(f"k8s API error checking for pods: {body}")
         return 1
-    
+
+    has_ext = os.path.split(notebook_path)[1]
+    if has_ext:
+        notebook_dir = os.path.dirname(notebook_path)
+    else:
+        notebook_dir = notebook_path
+    notebook_path = "/mnt/" + notebook_path
+    if not notebook_dir or notebook_dir == "/":
+        notebook_dir = "."
+
+    # look for a running session pod for this directory to reattach to
+    reattach_pod = kube_pods.find_session_pod(pods.items, pvc_name, notebook_path)
+    persist = config.CONTAINER_PERSIST or (reattach_pod is not None and kube_pods.is_persistent(reattach_pod))
+
+    # warm pods and persistent sessions are left alone by the cleanup
     running_pods = []
     for pod in pods.items:
-        if pod.status.phase in ("Running", "Pending") and not pod.metadata.deletion_timestamp:
+        if kube_pods.is_live(pod) and pod is not reattach_pod and not kube_pods.is_warm(pod) \
+                and not kube_pods.is_persistent(pod):
             running_pods.append(pod.metadata.name)
 
     if running_pods:
@@ -130,21 +160,16 @@ def run_k8s_session(pvc_name, notebook_path, extra_arguments):
                     error(f"k8s API error deleting pod: {body}")
                     return 1
 
-    has_ext = os.path.split(notebook_path)[1]
-    if has_ext:
-        notebook_dir = os.path.dirname(notebook_path)
+    urls = []
+    if reattach_pod is not None:
+        # the session ID doubles as the notebook token, and the URLs must use the pod's ports
+        config.SESSION_ID, ports, urls = kube_pods.session_info(reattach_pod)
+        port_block = None
+        message(f"reattaching to running pod {reattach_pod.metadata.name}")
     else:
-        notebook_dir = notebook_path
-    notebook_path = "/mnt/" + notebook_path
-    if not notebook_dir or notebook_dir == "/":
-        notebook_dir = "."
-
-    # allocate suggested ports 
-    starting_port = 10000 + os.getuid() * 3
-    ports = []
-    for _ in range(NUM_PORTS):
-        starting_port = find_unused_port(starting_port + 1, 10000)
-        ports.append(starting_port)
+        # allocate suggested ports (these are held until the port forwarders are started)
+        port_block = reserve_ports(NUM_PORTS, key=f"k8s:{k8s_context}:{notebook_path}")
+        ports = port_block.ports
     iglesia.set_userside_ports(ports)
 
     # propagate our config to command-line arguments
@@ -152,6 +177,8 @@ def run_k8s_session(pvc_name, notebook_path, extra_arguments):
     for key in list(runner_config.keys()):
         if key.startswith("K8S"):
             del runner_config[key]
+    for key in "CONTAINER_PERSIST", "CONTAINER_DETACH", "NOTEBOOK_SYNC":
+        runner_config.pop(key, None)
 
     runner_config['BROWSER'] = 'None'
     runner_config['SKIP_CHECKS'] = False
@@ -164,10 +191,10 @@ def run_k8s_session(pvc_name, notebook_path, extra_arguments):
     # create pod spec
     podname = f"{session_user}-padre-server-{config.SESSION_ID}"
     pod_created = None
-    urls = []
-    aux_processes = {}
+    retcode = None
+    forwarder = None
     _connected = True
-    reported_events = set()
+    watcher = None
 
     # accumulate volume specs for 
     # - directory of interest
@@ -235,7 +262,8 @@ def run_k8s_session(pvc_name, notebook_path, extra_arguments):
     pod_manifest = dict(
         apiVersion  =  'v1',
         kind        =  'Pod',
-        metadata    = dict(name=podname, labels=resource_labels),
+        metadata    = dict(name=podname, labels=resource_labels,
+                           annotations=kube_pods.session_annotations(pvc_name, notebook_path, ports, persist)),
         spec        = dict(
             containers = [dict(
                     image   = config.DOCKER_IMAGE,
@@ -267,8 +295,19 @@ def run_k8s_session(pvc_name, notebook_path, extra_arguments):
         )
     )
 
+    # a warm pod with a matching spec can be taken over instead of creating a new pod
+    warm_manifest = warm_pod = None
+    if config.K8S_WARM_POD and reattach_pod is None:
+        entrypoint = image_utils.get_image_entrypoint(config.DOCKER_IMAGE, docker=find_which("docker"))
+        if entrypoint:
+            warm_manifest = kube_pods.warm_pod_manifest(pod_manifest, entrypoint)
+            warm_pod = kube_pods.find_warm_pod(pods.items, warm_manifest)
+        else:
+            warning(f"can't determine the entrypoint of {config.DOCKER_IMAGE}, so it can't be used with --k8s-warm-pod")
+
     ## save pod def, just for debugging
     if config.VERBOSE > 0:
+        import rich
         rich.print(pod_manifest)
     # open("padre-pod.yaml", "wt").write(yaml.dump(pod_manifest))
 
@@ -279,7 +318,6 @@ def run_k8s_session(pvc_name, notebook_path, extra_arguments):
             warning("this is not fatal if the connection eventually resumes")
             warning("use Ctrl+C if you want to give up")
             _connected = False
-        time.sleep(1)
 
     def connected():
         nonlocal _connected
@@ -287,127 +325,120 @@ def run_k8s_session(pvc_name, notebook_path, extra_arguments):
             message("k8s connection resumed")
             _connected = True
 
-    def check_events():
-        try:
-            events = kube_api.list_namespaced_event(namespace=k8s_namespace, 
-                            field_selector=f"involvedObject.kind=Pod,involvedObject.name={podname}",
-                            _request_timeout=(1,1))
-        except ApiException as exc:
-            body = exc.body and json.loads(exc.body)
-            traceback.print_exc()
-            error(f"k8s API error checking for events: {body}")
-            return 
-        except (ConnectionError, HTTPError) as exc:
-            disconnected()
-            return 
-        connected()
-
-        for event in events.items:
-            if event.metadata.uid not in reported_events:
-                reported_events.add(event.metadata.uid)
-                message(f"k8s event: {event.reason}: {event.message}")
-
     try:
         start_time = time.time()
         provisioning_deadline = start_time + 60
-        message(f"starting radiopadre pod, arguments are: {' '.join(pod_manifest['spec']['containers'][0]['args'])}")
-        resp = kube_api.create_namespaced_pod(body=pod_manifest, namespace=k8s_namespace)
-        pod_created = True
+        container = pod_manifest['spec']['containers'][0]
+        if reattach_pod is not None:
+            podname = reattach_pod.metadata.name
+        elif warm_pod is not None and kube_pods.take_over(kube_api, k8s_namespace, warm_pod, config.SESSION_ID,
+                                                          container['args'], container['env'],
+                                                          pod_manifest['metadata']['annotations']):
+            podname = warm_pod.metadata.name
+            pod_created = True
+        else:
+            warm_pod = None
+
+        # watch the pod and its events. This is started before pod creation, so that no events are missed
+        watcher = PodWatcher(kube_api, k8s_namespace, podname,
+                             label_selector=f"radiopadre_session_id={config.SESSION_ID}",
+                             on_disconnect=disconnected, on_connect=connected)
+        watcher.start()
 
-        retcode = None
-        phase = None
+        if reattach_pod is None and warm_pod is None:
+            message(f"starting radiopadre pod, arguments are: {' '.join(container['args'])}")
+            resp = kube_api.create_namespaced_pod(body=pod_manifest, namespace=k8s_namespace)
+            pod_created = True
 
-        # wait for startup
+        # wait for startup: readiness is driven by the pod's Ready condition, as pushed by the watcher
         while True:
-            check_events()
-            try:
-                resp = kube_api.read_namespaced_pod_status(name=podname, namespace=k8s_namespace,
-                                                            _request_timeout=(1, 1))
-            except (ConnectionError, HTTPError) as exc:
-                disconnected()
+            if watcher.wait(timeout=max(provisioning_deadline - time.time(), 0)) is not None:
+                if watcher.ready or watcher.phase == 'Succeeded':
+                    message("radiopadre pod started")
+                    break
+                elif watcher.phase == 'Failed' or watcher.terminated:
+                    error("pod status is failed -- will proceed to collect logs below")
+                    break
+                elif watcher.deleted:
+                    error("radiopadre pod was deleted")
+                    return 1
                 continue
-            phase = resp.status.phase
-            connected()
-            if phase == 'Running' or phase == 'Succeeded':
-                message("radiopadre pod started")
-                break
-            elif phase == 'Failed':
-                error("pod status is failed -- will proceed to collect logs below")
-                break
             waiting_time = time.time() - start_time
-            if time.time() >= provisioning_deadline:
-                warning(f"Still waiting for pod to start ({round(waiting_time)}s). Messages above may contain more information.")
-                warning("Press Ctrl+C to give up.")
-                provisioning_deadline = time.time() + 60
-                continue
-            time.sleep(1)
-
-        # start port forwarders
-        for port in ports:
-            aux_processes[f"kubectl port-forward {port}"] = \
-                subprocess.Popen([kubectl, "port-forward", podname, f"{port}:{port}"])
+            warning(f"Still waiting for pod to start ({round(waiting_time)}s). Messages above may contain more information.")
+            warning("Press Ctrl+C to give up.")
+            provisioning_deadline = time.time() + 60
+
+        # replenish the warm pod for the next session
+        if warm_manifest is not None:
+            kube_pods.start_warm_pod(kube_api, k8s_namespace, warm_manifest,
+                                     [pod for pod in pods.items if pod is not warm_pod])
+
+        # start port forwarder
+        if port_block is not None:
+            port_block.release()
+        forwarder = PortForwarder(kube_api, k8s_namespace, podname, ports)
+        forwarder.start()
+
+        if reattach_pod is not None:
+            if not kube_pods.attach(kube_api, k8s_namespace, reattach_pod):
+                error(f"pod {podname} has been claimed by another client")
+                return 1
+            pod_created = True
+            forwarder.wait_ready(use_ssl=bool(config.SSL))
+            if urls:
+                iglesia.register_helpers(*run_browser(*urls))
+            message("The remote radiopadre session is now fully up")
+            if persist:
+                message("Press Ctrl+C to detach from the remote session (it will be left running)")
+            else:
+                message("Press Ctrl+C to kill the remote session")
 
-        # read logs
-        last_log_timestamp = None
-        seen_logs = set()
+        # read logs. The follower resumes after the last line seen whenever the stream is reopened.
+        # When reattaching, the earlier log is skipped
+        logs = LogFollower(kube_api, k8s_namespace, podname, container="padre",
+                           since_seconds=1 if reattach_pod is not None else None)
         while retcode is None:
             try:
-                check_events()
                 try:
-                    entries = kube_api.read_namespaced_pod_log(name=podname, namespace=k8s_namespace, container="padre",
-                                follow=True, timestamps=True,
-    #                            since_time=last_log_timestamp,
-                                _preload_content=False, 
-                                _request_timeout=(5, 5)
-                            ).stream()
-                    for entry in entries:
-                        # log.info(f"got [blue]{entry.decode()}[/blue]")
-                        for line in entry.decode().rstrip().split("\n"):
-                            if " " in line:
-                                timestamp, content = line.split(" ", 1)
+                    for content in logs.stream():
+                        message(f"# {content}")
+                        # parse for reactions
+
+                        # check for launch URL
+                        match = re.match(".*Browse to URL: ([^\s\033]+)", content)
+                        if match:
+                            urls.append(match.group(1))
+                            continue
+
+                        if "jupyter notebook server is running" in content:
+                            forwarder.wait_ready(use_ssl=bool(config.SSL))
+                            if urls:
+                                iglesia.register_helpers(*run_browser(*urls))
+                                kube_pods.save_urls(kube_api, k8s_namespace, podname, urls)
+                            message("The remote radiopadre session is now fully up")
+                            if persist:
+                                message("Press Ctrl+C to detach from the remote session (it will be left running)")
                             else:
-                                timestamp, content = line, ""
-                            key = timestamp, hash(content)
-                            last_log_timestamp = timestamp
-                            if key in seen_logs:
-                                continue
-                            seen_logs.add(key)
-                            message(f"# {content}")
-                            # parse for reactions
-
-                            # check for launch URL
-                            match = re.match(".*Browse to URL: ([^\s\033]+)", content)
-                            if match:
-                                urls.append(match.group(1))
-                                continue
-
-                            if "jupyter notebook server is running" in content:
-                                time.sleep(1)
-                                if urls:
-                                    iglesia.register_helpers(*run_browser(*urls))
-                                message("The remote radiopadre session is now fully up")
                                 message("Press Ctrl+C to kill the remote session")
 
                 except ReadTimeoutError as exc:  # not fatal, just means no logs coming
-                    continue
-            
-                # check for return code
-                resp = kube_api.read_namespaced_pod_status(name=podname, namespace=k8s_namespace)
-                connected()
-                contstat = resp.status.container_statuses[0].state
-                waiting = contstat.waiting
-                running = contstat.running
-                terminated = contstat.terminated
-                if waiting:
-                    pass 
-                    # message("container state is 'waiting'")
-                elif running:
                     pass
-                # message(f"container state is 'running'")
-                elif terminated:
+                else:
+                    # log stream has ended, which usually means the container has terminated. Give the watcher
+                    # a moment to report this
+                    if watcher.terminated is None:
+                        watcher.wait(timeout=1)
+
+                # check for return code
+                terminated = watcher.terminated
+                if terminated:
                     retcode = terminated.exit_code
                     message(f"container state is 'terminated', exit code is {retcode}")
                     break
+                if watcher.deleted:
+                    error("radiopadre pod was deleted")
+                    retcode = 1
+                    break
             except (ConnectionError, HTTPError) as exc:
                 traceback.print_exc()
                 disconnected()
@@ -425,35 +456,20 @@ def run_k8s_session(pvc_name, notebook_path, extra_arguments):
         error(f"Exception raised: {exc}")
         return 1
     finally:
+        if watcher is not None:
+            watcher.stop()
         try:
             # pod.initiate_cleanup()
-            # clean up port forwarder subprocesses
-            if aux_processes:
-                # see who's died
-                for desc, proc in list(aux_processes.items()):
-                    retcode = proc.poll()
-                    if retcode is not None:
-                        message(f"{desc} process has died with code {retcode}")
-                        proc.wait()
-                    del aux_processes[desc]
-                # terminate others
-                for desc, proc in list(aux_processes.items()):
-                    message(f"terminating {desc} process")
-                    proc.terminate()
-                for desc, proc in list(aux_processes.items()):
-                    try:
-                        retcode = proc.wait(1)
-                    except subprocess.TimeoutExpired:
-                        warning(f"{desc} process hasn't terminated -- killing it")
-                        proc.kill()
-                        try:
-                            retcode = proc.wait(1)
-                        except subprocess.TimeoutExpired:
-                            warning(f"{desc} process refuses to die")
-                    if retcode is not None:
-                        message(f"{desc} process has exited with code {retcode}")
-
-            if podname and pod_created: 
+            # stop port forwarding
+            if forwarder is not None:
+                forwarder.stop()
+                message("port forwarding traffic:")
+                forwarder.report()
+
+            if podname and pod_created and persist and retcode is None:
+                message(f"leaving pod {podname} running, rerun in the same directory to reattach to it")
+                kube_pods.detach(kube_api, k8s_namespace, podname)
+            elif podname and pod_created:
                 try:
                     message(f"deleting pod {podname}")
                     resp = kube_api.delete_namespaced_pod(name=podname, namespace=k8s_namespace)
@@ -0,0 +1,163 @@
+"""
+In-process port forwarding for the Kubernetes backend.
+
+Replaces one "kubectl port-forward" subprocess per session port with a single PortForwarder object, which
+listens on all the session ports locally and carries connections to the pod over the Kubernetes client's
+port-forward stream API.
+
+Note that the port-forward protocol carries a single TCP connection per port within each websocket, while a
+browser will open many concurrent connections to the notebook server. Each local connection therefore opens a
+websocket of its own to the API server, at the cost of a TLS handshake and an API request per connection (which
+is still much cheaper than a kubectl process per port). Since websockets are opened per connection, an API server
+hiccup only breaks the connections in flight: new connections are retried with backoff until the API server is
+reachable again.
+"""
+import socket, threading
+
+from kubernetes.stream import portforward
+
+from iglesia.utils import message, warning, debug
+from iglesia.readiness import ServerProbe, await_servers
+
+CONNECT_RETRIES = 5         # attempts to open a stream for a new connection
+MAX_BACKOFF = 4             # maximum seconds between attempts
+BUFFER_SIZE = 65536
+READY_WAIT = 30             # seconds to wait for the notebook server to answer through the forwarder
+
+
+class _PortStats(object):
+    """Per-port traffic counters"""
+    def __init__(self):
+        self.bytes_in = self.bytes_out = self.connections = self.failures = self.active = 0
+
+    def __str__(self):
+        return f"{self.connections} connections ({self.active} active, {self.failures} failed), " \
+               f"{_human_size(self.bytes_in)} in, {_human_size(self.bytes_out)} out"
+
+
+def _human_size(nbytes):
+    for unit in ("B", "KiB", "MiB"):
+        if nbytes < 1024:
+            return f"{nbytes:.0f}{unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f}GiB"
+
+
+class PortForwarder(object):
+    """
+    Forwards local ports to the same ports on a pod.
+
+    :param kube_api:    CoreV1Api object
+    :param namespace:   k8s namespace
+    :param podname:     name of pod
+    :param ports:       list of ports to forward
+    """
+    def __init__(self, kube_api, namespace, podname, ports):
+        self.kube_api, self.namespace, self.podname = kube_api, namespace, podname
+        self.ports = list(ports)
+        self.stats = {port: _PortStats() for port in self.ports}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._failing = False
+
+    def start(self):
+        """Binds the local ports and starts accepting connections"""
+        for port in self.ports:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(("localhost", port))
+            listener.listen(16)
+            self._listeners.append(listener)
+            threading.Thread(target=self._accept_loop, args=(listener, port), daemon=True).start()
+        message(f"forwarding ports {' '.join(map(str, self.ports))} to pod {self.podname}")
+
+    def stop(self):
+        """Stops accepting connections. Connections in flight are dropped when we exit"""
+        self._stopped.set()
+        for listener in self._listeners:
+            listener.close()
+        self._listeners = []
+
+    def wait_ready(self, use_ssl=False):
+        """Waits for the notebook server (on the first port) to answer through the forwarder. Returns True if it does"""
+        probe = ServerProbe("jupyter", self.ports[0], path="/api/status", use_ssl=use_ssl)
+        if await_servers([probe], wait=READY_WAIT)["jupyter"] is None:
+            warning(f"notebook server in pod {self.podname} is not answering via port {self.ports[0]}")
+            return False
+        return True
+
+    def report(self):
+        """Reports per-port traffic"""
+        for port, stats in self.stats.items():
+            if stats.connections:
+                message(f"  port {port}: {stats}")
+
+    def _accept_loop(self, listener, port):
+        while not self._stopped.is_set():
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._handle_connection, args=(conn, port), daemon=True).start()
+
+    def _open_stream(self, port):
+        """Opens port-forward websocket to pod. Returns socket connected to the pod port, or None on failure"""
+        backoff = 0.5
+        for attempt in range(CONNECT_RETRIES):
+            try:
+                pf = portforward(self.kube_api.connect_get_namespaced_pod_portforward, self.podname,
+                                 self.namespace, ports=str(port))
+                remote = pf.socket(port)
+                remote.setblocking(True)
+                if self._failing:
+                    message(f"port forwarding to pod {self.podname} has recovered")
+                    self._failing = False
+                return remote
+            except Exception as exc:
+                debug(f"unable to open port-forward stream for port {port} (attempt {attempt + 1}): {exc}")
+                if self._stopped.wait(backoff):
+                    break
+                backoff = min(backoff * 2, MAX_BACKOFF)
+        if not self._failing:
+            warning(f"port forwarding to pod {self.podname} is failing, will keep trying on new connections")
+            self._failing = True
+        return None
+
+    def _handle_connection(self, conn, port):
+        stats = self.stats[port]
+        remote = self._open_stream(port)
+        if remote is None:
+            with self._lock:
+                stats.failures += 1
+            conn.close()
+            return
+        with self._lock:
+            stats.connections += 1
+            stats.active += 1
+        # pump data both ways, each direction in its own thread
+        upstream = threading.Thread(target=self._pump, args=(conn, remote, stats, "bytes_out"), daemon=True)
+        upstream.start()
+        self._pump(remote, conn, stats, "bytes_in")
+        upstream.join()
+        for sock in conn, remote:
+            sock.close()
+        with self._lock:
+            stats.active -= 1
+
+    def _pump(self, source, dest, stats, counter):
+        """Copies data from source to dest socket until EOF, then propagates the EOF"""
+        try:
+            while True:
+                data = source.recv(BUFFER_SIZE)
+                if not data:
+                    break
+                dest.sendall(data)
+                with self._lock:
+                    setattr(stats, counter, getattr(stats, counter) + len(data))
+        except OSError:
+            pass
+        try:
+            dest.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
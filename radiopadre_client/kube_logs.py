@@ -0,0 +1,98 @@
+"""
+Resumable log streaming for the Kubernetes backend.
+
+A LogFollower keeps a single follow=True log stream open against the pod. When the stream is interrupted
+(by a read timeout or a connection error), it is reopened with since_seconds set to cover the time since the
+last line seen, so only a few seconds of log are transferred again, rather than the whole log. Lines carry
+their kubelet timestamps, so the overlap is dropped by timestamp, and only lines sharing the latest timestamp
+need to be remembered to dedupe them. Memory use and transfer thus stay constant however long the session runs.
+"""
+import re, time, calendar
+
+from iglesia.utils import debug
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60           # reconnect if the stream is silent for this long (it may have died silently)
+SINCE_MARGIN = 10           # extra seconds of log requested on resume, to allow for clock skew with the node
+DEDUP_WINDOW = 1024         # maximum number of lines remembered for deduplication
+CHUNK_SIZE = 65536
+
+
+def _parse_timestamp(timestamp):
+    """
+    Parses RFC3339 timestamp as used in k8s logs, e.g. "2024-05-01T12:00:00.123456789Z"
+
+    :return:    tuple of (seconds since epoch, nanoseconds), or None if not a valid timestamp
+    """
+    match = re.match(r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?Z$", timestamp)
+    if not match:
+        return None
+    seconds = calendar.timegm(time.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S"))
+    # trailing zeroes of the fraction are trimmed, so it has to be padded before comparing
+    return seconds, int((match.group(2) or "0").ljust(9, "0")[:9])
+
+
+class LogFollower(object):
+    """
+    Follows the log of a pod's container.
+
+    :param kube_api:    CoreV1Api object
+    :param namespace:   k8s namespace
+    :param podname:     name of pod
+    :param container:   name of container
+    :param since_seconds: if set, the log before this many seconds ago is skipped (e.g. when reattaching)
+    """
+    def __init__(self, kube_api, namespace, podname, container, since_seconds=None):
+        self.kube_api, self.namespace, self.podname, self.container = kube_api, namespace, podname, container
+        self.since_seconds = since_seconds
+        self.last_timestamp = None      # (seconds, nanoseconds) of the latest line seen
+        self._last_hashes = set()       # hashes of lines seen with that timestamp
+        self.reconnects = 0
+
+    def stream(self):
+        """
+        Opens the log stream, resuming after the last line seen, and yields new log lines (without timestamps).
+        Returns when the stream ends, which usually means the container has terminated. Read timeouts and
+        connection errors are passed on to the caller, who can call stream() again to resume.
+        """
+        since_seconds = self.since_seconds
+        if self.last_timestamp is not None:
+            since_seconds = max(int(time.time() - self.last_timestamp[0]), 0) + SINCE_MARGIN
+            self.reconnects += 1
+            debug(f"resuming log stream of {self.podname} with since_seconds={since_seconds}")
+        resp = self.kube_api.read_namespaced_pod_log(name=self.podname, namespace=self.namespace,
+                                                     container=self.container, follow=True, timestamps=True,
+                                                     since_seconds=since_seconds, _preload_content=False,
+                                                     _request_timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        # chunks are not aligned with lines, so an incomplete last line is kept until the rest arrives. If the
+        # stream is interrupted, it is discarded, and will be sent again on resume
+        buffer = b""
+        try:
+            for chunk in resp.stream(CHUNK_SIZE):
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    content = self._filter(line.decode(errors="replace").rstrip())
+                    if content is not None:
+                        yield content
+        finally:
+            resp.release_conn()
+
+    def _filter(self, line):
+        """Splits off timestamp from log line. Returns line content, or None if the line has already been seen"""
+        timestamp, content = line.split(" ", 1) if " " in line else (line, "")
+        key = _parse_timestamp(timestamp)
+        if key is None:
+            return line
+        if self.last_timestamp is not None and key <= self.last_timestamp:
+            if key < self.last_timestamp:
+                return None
+            linehash = hash(content)
+            if linehash in self._last_hashes:
+                return None
+            if len(self._last_hashes) < DEDUP_WINDOW:
+                self._last_hashes.add(linehash)
+            return content
+        self.last_timestamp = key
+        self._last_hashes = {hash(content)}
+        return content
@@ -0,0 +1,223 @@
+"""
+Pod reuse for the Kubernetes backend.
+
+Reattach: session pods are annotated with the PVC and notebook path they serve, their ports and URLs, and the
+client currently attached to them. On launch, a running pod for the same user, PVC and path that has no live
+client attached is reattached to (port forwards are set up for its ports, and its URLs, which carry the session
+token, are reopened), instead of starting a new pod. With --container-persist, the pod is left running when
+the client exits.
+
+Warm pods (--k8s-warm-pod): an idle pod is kept around per user, with volumes mounted and the image started,
+but running a wait loop in place of the image's entrypoint. A new session takes it over by writing a start
+script into the pod, which the wait loop then execs into, so that radiopadre becomes the main process of the
+pod (and its output goes to the pod log) just as in a freshly created pod. The session's directory is served
+from the PVC mounted at /mnt, so a warm pod can be taken over by a session for any directory on that PVC.
+"""
+import os, socket, json, hashlib, shlex, uuid, copy
+
+from kubernetes.client.rest import ApiException
+from kubernetes.stream import stream
+
+from iglesia.utils import message, warning, debug, pid_alive
+
+ANNOTATION = "radiopadre/"
+WARM_LABEL = "radiopadre_warm"
+START_SCRIPT = "/tmp/radiopadre-start"
+# runs in place of the entrypoint in a warm pod, until a session takes it over
+WARM_LOOP = f"while [ ! -f {START_SCRIPT} ]; do sleep 0.2; done; . {START_SCRIPT}"
+
+
+def _annotations(pod):
+    return pod.metadata.annotations or {}
+
+
+def client_id():
+    """Returns ID of this client, as recorded in the pods it is attached to"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _client_alive(client):
+    """Checks if the given client is alive. Clients on other hosts are assumed to be"""
+    if not client:
+        return False
+    host, pid = client.rsplit(":", 1)
+    if host != socket.gethostname():
+        return True
+    return pid_alive(int(pid))
+
+
+def is_live(pod):
+    return pod.status.phase in ("Running", "Pending") and not pod.metadata.deletion_timestamp
+
+
+def is_warm(pod):
+    return (pod.metadata.labels or {}).get(WARM_LABEL) == "true"
+
+
+def is_persistent(pod):
+    return _annotations(pod).get(ANNOTATION + "persist") == "true"
+
+
+def session_annotations(pvc_name, notebook_path, ports, persist):
+    """Returns annotations identifying a session pod"""
+    return {ANNOTATION + "pvc": pvc_name,
+            ANNOTATION + "path": notebook_path,
+            ANNOTATION + "ports": json.dumps(list(ports)),
+            ANNOTATION + "persist": "true" if persist else "false",
+            ANNOTATION + "client": client_id()}
+
+
+def find_session_pod(pods, pvc_name, notebook_path):
+    """Returns running session pod serving the given PVC and path that can be reattached to, or None"""
+    for pod in pods:
+        annotations = _annotations(pod)
+        if pod.status.phase == "Running" and not pod.metadata.deletion_timestamp and not is_warm(pod) and \
+                annotations.get(ANNOTATION + "pvc") == pvc_name and \
+                annotations.get(ANNOTATION + "path") == notebook_path:
+            if _client_alive(annotations.get(ANNOTATION + "client")):
+                message(f"pod {pod.metadata.name} serves this directory, but is attached to another client")
+                continue
+            return pod
+    return None
+
+
+def session_info(pod):
+    """Returns session ID, ports and URLs of a session pod"""
+    annotations = _annotations(pod)
+    return pod.metadata.labels["radiopadre_session_id"], json.loads(annotations[ANNOTATION + "ports"]), \
+           json.loads(annotations.get(ANNOTATION + "urls", "[]"))
+
+
+def _patch(kube_api, namespace, pod, labels=None, annotations=None):
+    """
+    Patches labels and annotations of a pod. If the pod object is given, the patch is conditional on the pod
+    being unchanged since, so that two clients can't claim the same pod.
+
+    :param pod:     pod object, or pod name
+    :return:        True on success, False if the pod has changed (or gone) in the meantime
+    """
+    metadata = dict(labels=labels or {}, annotations=annotations or {})
+    if type(pod) is str:
+        podname = pod
+    else:
+        podname = pod.metadata.name
+        metadata['resourceVersion'] = pod.metadata.resource_version
+    try:
+        kube_api.patch_namespaced_pod(name=podname, namespace=namespace, body=dict(metadata=metadata))
+    except ApiException as exc:
+        if exc.status in (404, 409):
+            debug(f"unable to patch pod {podname}: {exc.reason}")
+            return False
+        raise
+    return True
+
+
+def attach(kube_api, namespace, pod):
+    """Marks pod as attached to this client. Returns False if another client got there first"""
+    return _patch(kube_api, namespace, pod, annotations={ANNOTATION + "client": client_id()})
+
+
+def detach(kube_api, namespace, podname):
+    """Marks pod as not attached to any client"""
+    _patch(kube_api, namespace, podname, annotations={ANNOTATION + "client": ""})
+
+
+def save_urls(kube_api, namespace, podname, urls):
+    """Records session URLs in the pod, for reattaching clients"""
+    _patch(kube_api, namespace, podname, annotations={ANNOTATION + "urls": json.dumps(urls)})
+
+
+def warm_pod_manifest(pod_manifest, entrypoint):
+    """
+    Makes manifest for a warm pod from that of a session pod. The data PVC is mounted at /mnt in its entirety, and
+    session-specific settings are left out. The annotations record the entrypoint to be run on takeover, and a hash
+    of the spec, which a session must match to take the pod over.
+    """
+    manifest = copy.deepcopy(pod_manifest)
+    container = manifest['spec']['containers'][0]
+    container['command'] = ["/bin/sh", "-c", WARM_LOOP]
+    del container['args']
+    container['env'] = [var for var in container['env']
+                        if var['name'] not in ("RADIOPADRE_SESSION_ID", "RADIOPADRE_CONTAINER_NAME")]
+    for mount in container['volumeMounts']:
+        if mount['name'] == "data":
+            mount['mountPath'] = "/mnt"
+            mount.pop('subPath', None)
+    spec_hash = hashlib.sha1(json.dumps(manifest['spec'], sort_keys=True).encode()).hexdigest()
+    labels = {key: value for key, value in manifest['metadata']['labels'].items() if key != "radiopadre_session_id"}
+    labels[WARM_LABEL] = "true"
+    manifest['metadata'] = dict(name=f"{labels['radiopadre_user']}-padre-warm-{uuid.uuid4().hex[:8]}", labels=labels,
+                                annotations={ANNOTATION + "spec": spec_hash,
+                                             ANNOTATION + "entrypoint": json.dumps(entrypoint)})
+    return manifest
+
+
+def find_warm_pod(pods, warm_manifest):
+    """Returns running warm pod matching the given warm pod manifest, or None"""
+    spec_hash = warm_manifest['metadata']['annotations'][ANNOTATION + "spec"]
+    for pod in pods:
+        if is_warm(pod) and pod.status.phase == "Running" and not pod.metadata.deletion_timestamp and \
+                _annotations(pod).get(ANNOTATION + "spec") == spec_hash:
+            return pod
+    return None
+
+
+def take_over(kube_api, namespace, pod, session_id, container_args, env, annotations):
+    """
+    Takes over a warm pod: relabels it as belonging to the session, and starts radiopadre in it.
+
+    :param pod:             warm pod object
+    :param session_id:      session ID
+    :param container_args:  arguments to the entrypoint
+    :param env:             list of environment variable specs (dicts of name, value)
+    :param annotations:     session annotations to add to the pod
+    :return:                True on success, False if the pod could not be taken over
+    """
+    podname = pod.metadata.name
+    entrypoint = json.loads(_annotations(pod)[ANNOTATION + "entrypoint"])
+    if not _patch(kube_api, namespace, pod, labels={WARM_LABEL: None, "radiopadre_session_id": session_id},
+                  annotations=annotations):
+        return False
+    env = {var['name']: var['value'] for var in env}
+    env["RADIOPADRE_CONTAINER_NAME"] = podname
+    script = "".join(f"export {name}={shlex.quote(value)}\n" for name, value in env.items()) + \
+             "exec " + " ".join(map(shlex.quote, list(entrypoint) + list(container_args))) + "\n"
+    # write the script under a temporary name first, so that the wait loop never sees a partial one
+    command = ["/bin/sh", "-c", f'printf "%s" "$1" > {START_SCRIPT}.new && mv {START_SCRIPT}.new {START_SCRIPT}',
+               "sh", script]
+    try:
+        stream(kube_api.connect_get_namespaced_pod_exec, podname, namespace, container="padre", command=command,
+               stderr=True, stdin=False, stdout=True, tty=False)
+    except Exception as exc:
+        warning(f"unable to start session in warm pod {podname}: {exc}")
+        kube_api.delete_namespaced_pod(name=podname, namespace=namespace)
+        return False
+    message(f"took over warm pod {podname}")
+    return True
+
+
+def start_warm_pod(kube_api, namespace, warm_manifest, pods):
+    """
+    Makes sure a warm pod matching warm_manifest is available for the next session. Warm pods made from a
+    different spec are deleted, so that there is at most one per user.
+
+    :param pods:    the user's current pods
+    """
+    spec_hash = warm_manifest['metadata']['annotations'][ANNOTATION + "spec"]
+    have_warm = False
+    for pod in pods:
+        if is_warm(pod) and is_live(pod):
+            if _annotations(pod).get(ANNOTATION + "spec") == spec_hash and not have_warm:
+                have_warm = True
+            else:
+                debug(f"deleting stale warm pod {pod.metadata.name}")
+                try:
+                    kube_api.delete_namespaced_pod(name=pod.metadata.name, namespace=namespace)
+                except ApiException as exc:
+                    warning(f"error deleting warm pod {pod.metadata.name}: {exc.reason}")
+    if not have_warm:
+        message(f"starting warm pod {warm_manifest['metadata']['name']} for the next session")
+        try:
+            kube_api.create_namespaced_pod(body=warm_manifest, namespace=namespace)
+        except ApiException as exc:
+            warning(f"error starting warm pod: {exc.reason}")
@@ -0,0 +1,157 @@
+"""
+Cluster-wide image pre-pull for the Kubernetes backend (run-radiopadre -K --prepull).
+
+Session pods use imagePullPolicy IfNotPresent, so the first session on each node would otherwise pay for a pull
+of the (multi-GB) image. This creates (or updates) a DaemonSet whose pods pull the image in an init container
+that exits immediately, then idle in a pause container. The pods are watched to report progress per node, and
+the DaemonSet is deleted once every node selected by --k8s-node-selector has pulled the image (or failed to).
+"""
+import time, uuid, json, traceback
+
+from kubernetes import watch
+from kubernetes.client.api import core_v1_api, apps_v1_api
+from kubernetes.client.rest import ApiException
+
+from iglesia.utils import message, warning, error, debug
+from . import config
+from .kube import init_k8s, session_user
+
+PAUSE_IMAGE = "registry.k8s.io/pause:3.9"
+PREPULL_TIMEOUT = 3600      # seconds to wait for all nodes to complete
+WATCH_TIMEOUT = 30          # renew the watch this often, to recheck the DaemonSet status
+# init container waiting reasons that mean the pull has failed (the kubelet will keep retrying, but we don't wait)
+PULL_ERRORS = {"ErrImagePull", "ImagePullBackOff", "InvalidImageName", "ErrImageNeverPull"}
+
+
+def _daemonset_manifest(name, run_id, node_selector):
+    labels = dict(radiopadre_user=session_user, radiopadre_prepull=name)
+    return dict(
+        apiVersion  = "apps/v1",
+        kind        = "DaemonSet",
+        metadata    = dict(name=name, labels=labels),
+        spec        = dict(
+            # the selector can't be changed on update, so the run ID only goes into the pod labels
+            selector = dict(matchLabels=labels),
+            template = dict(
+                metadata = dict(labels=dict(radiopadre_prepull_run=run_id, **labels)),
+                spec     = dict(
+                    initContainers = [dict(
+                        name    = "prepull",
+                        image   = config.DOCKER_IMAGE,
+                        imagePullPolicy = "Always",
+                        command = ["/bin/sh", "-c", "true"],
+                        resources = dict(requests=dict(cpu="10m", memory="16Mi"))
+                    )],
+                    containers = [dict(
+                        name    = "pause",
+                        image   = PAUSE_IMAGE,
+                        resources = dict(requests=dict(cpu="1m", memory="8Mi"))
+                    )],
+                    nodeSelector = node_selector,
+                    terminationGracePeriodSeconds = 0
+                )
+            )
+        )
+    )
+
+
+def _pull_state(pod):
+    """Returns state of image pull in pod: "pending", "pulling", "done" or "failed", plus description"""
+    statuses = pod.status.init_container_statuses
+    if not pod.spec.node_name or not statuses:
+        return "pending", "waiting to be scheduled"
+    state = statuses[0].state
+    if state.terminated:
+        if state.terminated.exit_code == 0:
+            return "done", "image pulled"
+        return "failed", f"init container exited with code {state.terminated.exit_code}"
+    if state.running:
+        return "done", "image pulled"
+    if state.waiting and state.waiting.reason in PULL_ERRORS:
+        return "failed", f"{state.waiting.reason}: {state.waiting.message}"
+    return "pulling", "pulling image"
+
+
+def run_prepull():
+    """Pre-pulls config.DOCKER_IMAGE onto all matching nodes. Returns exit code"""
+    k8s_setup = init_k8s()
+    if k8s_setup is None:
+        return 1
+    k8s_context, k8s_namespace, node_selector = k8s_setup
+
+    kube_api = core_v1_api.CoreV1Api()
+    apps_api = apps_v1_api.AppsV1Api()
+
+    name = f"{session_user}-padre-prepull"
+    run_id = uuid.uuid4().hex[:12]
+    manifest = _daemonset_manifest(name, run_id, node_selector)
+    node_states = {}
+    created = False
+
+    try:
+        try:
+            apps_api.create_namespaced_daemon_set(namespace=k8s_namespace, body=manifest)
+            message(f"created DaemonSet {name} to pre-pull {config.DOCKER_IMAGE}")
+        except ApiException as exc:
+            if exc.status != 409:
+                raise
+            # left over from an interrupted run: update it, which replaces its pods
+            apps_api.replace_namespaced_daemon_set(name=name, namespace=k8s_namespace, body=manifest)
+            message(f"updated existing DaemonSet {name} to pre-pull {config.DOCKER_IMAGE}")
+        created = True
+
+        deadline = time.time() + PREPULL_TIMEOUT
+        while time.time() < deadline:
+            # number of nodes is only known once the DaemonSet controller has caught up with our spec
+            daemonset = apps_api.read_namespaced_daemon_set(name=name, namespace=k8s_namespace)
+            if daemonset.status and (daemonset.status.observed_generation or 0) >= daemonset.metadata.generation:
+                num_nodes = daemonset.status.desired_number_scheduled
+                if num_nodes == 0:
+                    warning("no nodes match the --k8s-node-selector setting, nothing to do")
+                    return 1
+                finished = [state for state, _ in node_states.values() if state in ("done", "failed")]
+                if len(finished) >= num_nodes:
+                    break
+                debug(f"{len(finished)}/{num_nodes} nodes finished")
+
+            w = watch.Watch()
+            for event in w.stream(kube_api.list_namespaced_pod, namespace=k8s_namespace,
+                                  label_selector=f"radiopadre_prepull_run={run_id}", timeout_seconds=WATCH_TIMEOUT):
+                pod = event['object']
+                if event['type'] == "DELETED" or not pod.spec.node_name:
+                    continue
+                state = _pull_state(pod)
+                if node_states.get(pod.spec.node_name) != state:
+                    node_states[pod.spec.node_name] = state
+                    report = warning if state[0] == "failed" else message
+                    report(f"  node {pod.spec.node_name}: {state[1]}")
+                    # recheck the DaemonSet status whenever a node finishes
+                    if state[0] in ("done", "failed"):
+                        w.stop()
+        else:
+            warning(f"timed out after {PREPULL_TIMEOUT}s")
+
+        done = sorted(node for node, (state, _) in node_states.items() if state == "done")
+        failed = sorted(node for node, (state, _) in node_states.items() if state != "done")
+        message(f"{config.DOCKER_IMAGE} is present on {len(done)} node(s)")
+        if failed:
+            warning(f"pre-pull did not complete on {len(failed)} node(s): {' '.join(failed)}")
+            return 1
+        return 0
+
+    except KeyboardInterrupt:
+        message("Ctrl+C caught, cleaning up")
+        return 1
+    except ApiException as exc:
+        body = exc.body and json.loads(exc.body)
+        traceback.print_exc()
+        error(f"k8s API error: {body}")
+        return 1
+    finally:
+        if created:
+            message(f"deleting DaemonSet {name}")
+            try:
+                apps_api.delete_namespaced_daemon_set(name=name, namespace=k8s_namespace,
+                                                      propagation_policy="Background")
+            except ApiException as exc:
+                error(f"k8s API error deleting DaemonSet {name}: {exc.reason}")
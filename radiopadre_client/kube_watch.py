@@ -0,0 +1,169 @@
+"""
+Watch-based tracking of the radiopadre pod.
+
+Rather than polling the pod status and event list, a PodWatcher keeps two watch streams open against the
+API server: one for pods matching the session's label selector, and one for events involving the pod. State
+changes are pushed into a queue that the client waits on. If a stream is interrupted, it is resumed from the
+last resourceVersion seen (or re-listed, if the API server has compacted that version away).
+"""
+import threading, queue, json
+
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+from requests import ConnectionError
+from urllib3.exceptions import HTTPError
+
+from iglesia.utils import message, error, debug
+
+WATCH_TIMEOUT = 300         # server-side timeout of a single watch request, after which it is renewed
+MAX_BACKOFF = 8             # maximum seconds to wait before reconnecting after a connection error
+
+
+class _ResourceExpired(Exception):
+    """Raised when a watch can't be resumed because its resourceVersion is too old (HTTP 410 Gone)"""
+    pass
+
+
+class PodWatcher(object):
+    """
+    Watches a pod and its events. Pod updates are available via wait() or the pod attribute, events are
+    reported as they arrive.
+
+    :param kube_api:        CoreV1Api object
+    :param namespace:       k8s namespace
+    :param podname:         name of pod
+    :param label_selector:  label selector identifying the pod (i.e. its session ID label)
+    :param on_disconnect:   called (from a watcher thread) when the connection to the API server is lost
+    :param on_connect:      called (from a watcher thread) when the connection to the API server is resumed
+    """
+    def __init__(self, kube_api, namespace, podname, label_selector, on_disconnect=None, on_connect=None):
+        self.kube_api, self.namespace, self.podname, self.label_selector = kube_api, namespace, podname, label_selector
+        self.on_disconnect, self.on_connect = on_disconnect, on_connect
+        self.pod = None             # latest pod object
+        self.deleted = False        # set when the pod has been deleted
+        self._updates = queue.Queue()
+        self._stopped = threading.Event()
+        self._watches = []
+        self._reported_events = set()
+        self._disconnected = False
+
+    def start(self):
+        """Starts the watcher threads"""
+        pod_selector = dict(label_selector=self.label_selector)
+        # events carry no labels of their own, so these are selected by the pod they involve
+        event_selector = dict(field_selector=f"involvedObject.kind=Pod,involvedObject.name={self.podname}")
+        threading.Thread(target=self._watch_loop, daemon=True,
+                         args=(self.kube_api.list_namespaced_pod, pod_selector, self._handle_pod)).start()
+        threading.Thread(target=self._watch_loop, daemon=True,
+                         args=(self.kube_api.list_namespaced_event, event_selector, self._handle_event)).start()
+
+    def stop(self):
+        """Stops the watcher threads"""
+        self._stopped.set()
+        for w in self._watches:
+            w.stop()
+
+    def wait(self, timeout=None):
+        """
+        Waits for a pod update
+
+        :param timeout: seconds to wait, or None to wait indefinitely
+        :return:        updated pod object, or None if no update arrived within the timeout
+        """
+        try:
+            pod = self._updates.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        # skip to the latest update, since we only care about the current state
+        while not self._updates.empty():
+            pod = self._updates.get_nowait()
+        return pod
+
+    @property
+    def phase(self):
+        return self.pod.status.phase if self.pod is not None and self.pod.status else None
+
+    @property
+    def ready(self):
+        """True if the pod's Ready condition is set"""
+        conditions = self.pod is not None and self.pod.status and self.pod.status.conditions
+        return any(cond.type == "Ready" and cond.status == "True" for cond in conditions or [])
+
+    @property
+    def terminated(self):
+        """Container termination state, or None if the container has not terminated"""
+        statuses = self.pod is not None and self.pod.status and self.pod.status.container_statuses
+        return statuses[0].state.terminated if statuses else None
+
+    def _handle_pod(self, etype, pod):
+        if pod.metadata.name != self.podname:
+            return
+        self.pod = pod
+        if etype == "DELETED":
+            self.deleted = True
+        self._updates.put(pod)
+
+    def _handle_event(self, etype, event):
+        if etype != "DELETED" and event.metadata.uid not in self._reported_events:
+            self._reported_events.add(event.metadata.uid)
+            message(f"k8s event: {event.reason}: {event.message}")
+
+    def _watch_loop(self, list_func, selector, handler):
+        """Lists and then watches the given resource type, resuming after errors, until stopped"""
+        resource_version = None
+        backoff = 1
+        while not self._stopped.is_set():
+            try:
+                # (re)list if we have no valid resourceVersion to resume from
+                if resource_version is None:
+                    result = list_func(namespace=self.namespace, _request_timeout=(5, 10), **selector)
+                    for item in result.items:
+                        handler("ADDED", item)
+                    resource_version = result.metadata.resource_version
+                    self._set_connected(True)
+                w = watch.Watch()
+                self._watches.append(w)
+                try:
+                    for event in w.stream(list_func, namespace=self.namespace, resource_version=resource_version,
+                                          timeout_seconds=WATCH_TIMEOUT, allow_watch_bookmarks=True, **selector):
+                        if event['type'] == "ERROR":
+                            if event['raw_object'].get('code') == 410:
+                                raise _ResourceExpired()
+                            error(f"k8s watch error: {event['raw_object'].get('message')}")
+                            continue
+                        resource_version = event['object'].metadata.resource_version
+                        self._set_connected(True)
+                        if event['type'] != "BOOKMARK":
+                            handler(event['type'], event['object'])
+                finally:
+                    self._watches.remove(w)
+                backoff = 1
+            except _ResourceExpired:
+                debug("k8s watch resourceVersion expired, re-listing")
+                resource_version = None
+            except ApiException as exc:
+                if exc.status == 410:
+                    debug("k8s watch resourceVersion expired, re-listing")
+                    resource_version = None
+                    continue
+                body = exc.body and json.loads(exc.body)
+                error(f"k8s API error in watch: {body}")
+                self._backoff(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+            except (ConnectionError, HTTPError) as exc:
+                if self._stopped.is_set():
+                    break
+                self._set_connected(False)
+                self._backoff(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def _set_connected(self, connected):
+        """Reports changes in connection state via the callbacks"""
+        if connected == self._disconnected:
+            self._disconnected = not connected
+            callback = self.on_connect if connected else self.on_disconnect
+            if callback:
+                callback()
+
+    def _backoff(self, seconds):
+        self._stopped.wait(seconds)
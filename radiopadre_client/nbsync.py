@@ -0,0 +1,162 @@
+"""
+Two-way sync of notebooks between a local directory and the notebook directory of a remote session (--notebook-sync).
+
+Before the session, new and changed local notebooks are pushed to the remote; after the session, new and changed
+remote notebooks are pulled back. Both sides are compared by content hash (the remote side is hashed by a single
+ssh command), so unchanged notebooks never go over the wire, and the changed ones go in one gzipped tarball per
+direction, over the ssh master connection. The hashes as of the last sync are kept per host/directory pair under
+RADIOPADRE_DIR/nbsync, so that we can tell which side has changed: a notebook that has changed on both sides is
+left alone on push, and pulled into a separate "conflict" copy. Only top-level *.ipynb files are synced, and
+nothing is ever deleted.
+"""
+import os, os.path, io, re, json, glob, shlex, hashlib, tarfile, subprocess
+
+import iglesia
+from iglesia.utils import message, warning, debug, make_dir
+from . import config
+
+STATE_DIR = os.path.join(iglesia.RADIOPADRE_DIR, "nbsync")
+
+# marker prefixing the JSON line printed by the remote hashing script
+_HASH_MARKER = "RADIOPADRE_NBSYNC:"
+
+_HASH_SCRIPT = "import glob, json, hashlib; print('" + _HASH_MARKER + \
+               "' + json.dumps({name: hashlib.sha256(open(name, 'rb').read()).hexdigest() " \
+               "for name in glob.glob('*.ipynb')}))"
+
+
+def _hash_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _size(nbytes):
+    return f"{nbytes/2**20:.1f} MB" if nbytes >= 2**20 else f"{nbytes/2**10:.1f} kB"
+
+
+class NotebookSync(object):
+    """
+    Syncs notebooks between a local and a remote directory.
+
+    :param mux:         SSHMux of the remote host
+    :param local_dir:   local directory
+    :param remote_dir:  remote directory (interpreted by the remote shell, so can use "~")
+    """
+    def __init__(self, mux, local_dir, remote_dir):
+        self.mux = mux
+        self.local_dir = os.path.abspath(os.path.expanduser(local_dir))
+        self.remote_dir = remote_dir or "."
+        key = hashlib.sha256(f"{mux.host}:{self.remote_dir}:{self.local_dir}".encode()).hexdigest()[:16]
+        self.host_label = re.sub(r"[^\w@.-]", "_", mux.host)
+        self.state_file = os.path.join(STATE_DIR, f"{self.host_label}-{key}.json")
+
+    def _remote(self, command, **kw):
+        """Runs command in the remote directory, returns CompletedProcess"""
+        cmd = self.mux.command() + [config.REMOTE_UTILITY_SHELL,
+                                    shlex.quote(f"cd {self.remote_dir} && {command}")]
+        debug(f"nbsync: running {' '.join(cmd)}")
+        return subprocess.run(cmd, stdout=subprocess.PIPE, **kw)
+
+    def _load_state(self):
+        """Returns dict of notebook name -> hash as of the last sync"""
+        if not os.path.exists(self.state_file):
+            return {}
+        try:
+            return json.load(open(self.state_file, "rt"))['notebooks']
+        except Exception as exc:
+            warning(f"error reading {self.state_file}: {exc}, ignoring")
+            return {}
+
+    def _save_state(self, synced):
+        make_dir(STATE_DIR)
+        state = dict(host=self.mux.host, local_dir=self.local_dir, remote_dir=self.remote_dir, notebooks=synced)
+        try:
+            with open(self.state_file + ".new", "wt") as statefile:
+                json.dump(state, statefile, indent=2)
+            os.rename(self.state_file + ".new", self.state_file)
+        except Exception as exc:
+            warning(f"error writing {self.state_file}: {exc}")
+
+    def local_hashes(self):
+        """Returns dict of notebook name -> hash for the local directory"""
+        return {os.path.basename(path): _hash_file(path)
+                for path in glob.glob(os.path.join(glob.escape(self.local_dir), "*.ipynb"))}
+
+    def remote_hashes(self):
+        """Returns dict of notebook name -> hash for the remote directory, or None if it can't be read"""
+        result = self._remote(f"{config.REMOTE_PYTHON} -c {shlex.quote(_HASH_SCRIPT)}", stderr=subprocess.DEVNULL)
+        for line in result.stdout.decode('utf-8', errors='replace').split("\n"):
+            if line.startswith(_HASH_MARKER):
+                return json.loads(line[len(_HASH_MARKER):])
+        warning(f"nbsync: unable to read notebooks in {self.mux.host}:{self.remote_dir}, skipping sync")
+        return None
+
+    def push(self):
+        """Pushes new and changed local notebooks to the remote"""
+        remote = self.remote_hashes()
+        if remote is None:
+            return
+        local = self.local_hashes()
+        last = self._load_state()
+        synced = {name: h for name, h in local.items() if remote.get(name) == h}
+        names = []
+        for name, h in sorted(local.items()):
+            if name in synced:
+                continue
+            if name in remote and remote[name] != last.get(name):
+                if h != last.get(name):
+                    warning(f"nbsync: {name} has changed both locally and on {self.mux.host}, not pushing it")
+                continue
+            names.append(name)
+        if names:
+            buffer = io.BytesIO()
+            with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+                for name in names:
+                    tar.add(os.path.join(self.local_dir, name), arcname=name)
+            data = buffer.getvalue()
+            message(f"nbsync: pushing {len(names)} notebook(s) to {self.mux.host}:{self.remote_dir} ({_size(len(data))})")
+            if self._remote("tar xzf -", input=data).returncode:
+                warning("nbsync: push has failed")
+                return
+            synced.update({name: local[name] for name in names})
+        else:
+            message("nbsync: remote notebooks are up to date")
+        self._save_state(dict(last, **synced))
+
+    def pull(self):
+        """Pulls new and changed remote notebooks back. Notebooks changed on both sides are saved as conflict copies"""
+        remote = self.remote_hashes()
+        if remote is None:
+            return
+        local = self.local_hashes()
+        last = self._load_state()
+        synced = {name: h for name, h in remote.items() if local.get(name) == h}
+        names = sorted(name for name, h in remote.items() if name not in synced and h != last.get(name))
+        if not names:
+            message("nbsync: local notebooks are up to date")
+            self._save_state(dict(last, **synced))
+            return
+        result = self._remote("tar czf - -- " + " ".join(map(shlex.quote, names)))
+        if result.returncode:
+            warning("nbsync: pull has failed")
+            return
+        message(f"nbsync: pulled {len(names)} notebook(s) from {self.mux.host}:{self.remote_dir} "
+                f"({_size(len(result.stdout))})")
+        with tarfile.open(fileobj=io.BytesIO(result.stdout), mode="r:gz") as tar:
+            for member in tar.getmembers():
+                if member.name not in names or not member.isfile():
+                    continue
+                content = tar.extractfile(member).read()
+                path = os.path.join(self.local_dir, member.name)
+                if member.name in local and local[member.name] != last.get(member.name):
+                    path = os.path.join(self.local_dir, re.sub(r"\.ipynb$", "", member.name) +
+                                        f".conflict-{self.host_label}.ipynb")
+                    warning(f"nbsync: {member.name} has changed both locally and on {self.mux.host}, "
+                            f"saving remote version as {os.path.basename(path)}")
+                else:
+                    synced[member.name] = hashlib.sha256(content).hexdigest()
+                # write to new file and rename, so that a notebook is never left half-written
+                with open(path + ".nbsync-new", "wb") as f:
+                    f.write(content)
+                os.replace(path + ".nbsync-new", path)
+        self._save_state(dict(last, **synced))
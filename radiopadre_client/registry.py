@@ -0,0 +1,191 @@
+"""
+Session registry.
+
+Keeps track of running radiopadre sessions (of all back-ends) on this host. Sessions are recorded in a single
+JSON file in RADIOPADRE_DIR, keyed by session ID, and protected by a lockfile, so that concurrent clients can
+safely add and remove entries. This replaces scanning "docker ps" output and per-container session files.
+
+Each entry is a dict with the following fields:
+
+    backend:        name of back-end ("docker", "singularity", "venv")
+    name:           container name (None for virtualenv sessions)
+    pid:            PID of the client process that owns the session, or None for a persistent (detached) session
+    persist:        True if the session is persistent, i.e. can be detached (a singularity session then runs in
+                    an instance, which needs to be stopped)
+    ports:          list of selected ports followed by userside ports
+    rootdir:        directory being served
+    session_id:     session ID (also the notebook token)
+    start_time:     time of session start (seconds since epoch)
+"""
+import os, os.path, socket, time, json
+from collections import OrderedDict
+
+import iglesia
+from iglesia.utils import debug, warning, bye, FileLock, pid_alive
+
+BACKENDS = ("docker", "singularity", "venv")
+
+
+def _state_files():
+    """Returns names of lockfile and registry file. These are per-host, since RADIOPADRE_DIR may be shared"""
+    base = os.path.join(iglesia.RADIOPADRE_DIR, f"sessions-{socket.gethostname()}")
+    return base + ".lock", base + ".json"
+
+
+def _lock():
+    """Returns context manager holding an exclusive lock on the registry lockfile"""
+    return FileLock(_state_files()[0])
+
+
+def _load():
+    """Loads registry file, returns dict of session_id -> entry"""
+    _, filename = _state_files()
+    if not os.path.exists(filename):
+        return {}
+    try:
+        return json.load(open(filename, "rt"))
+    except Exception as exc:
+        warning(f"error reading {filename}: {exc}, ignoring")
+        return {}
+
+
+def _save(entries):
+    _, filename = _state_files()
+    try:
+        with open(filename + ".new", "wt") as regfile:
+            json.dump(entries, regfile, indent=1)
+        os.chmod(filename + ".new", 0o600)
+        os.rename(filename + ".new", filename)
+    except Exception as exc:
+        warning(f"error writing {filename}: {exc}")
+
+
+def register(session_id, backend, name, ports, rootdir, pid=None):
+    """
+    Adds a session to the registry
+
+    :param session_id:  session ID
+    :param backend:     name of back-end
+    :param name:        container name, or None
+    :param ports:       list of selected ports followed by userside ports
+    :param rootdir:     directory being served
+    :param pid:         PID of owning process. Default is the current process.
+    """
+    entry = dict(backend=backend, name=name, pid=os.getpid() if pid is None else pid, persist=False,
+                 ports=list(ports), rootdir=rootdir, session_id=session_id, start_time=time.time())
+    with _lock():
+        entries = _load()
+        entries[session_id] = entry
+        _save(entries)
+    debug(f"registered {backend} session {session_id} in {rootdir}")
+
+
+def update(session_id, **fields):
+    """Updates fields of registry entry, if it exists"""
+    with _lock():
+        entries = _load()
+        if session_id in entries:
+            entries[session_id].update(**fields)
+            _save(entries)
+
+
+def unregister(*session_ids):
+    """Removes sessions from the registry"""
+    with _lock():
+        entries = _load()
+        removed = [sid for sid in session_ids if entries.pop(sid, None) is not None]
+        if removed:
+            _save(entries)
+
+
+def release(session_id):
+    """Removes session from the registry on exit of its owning process, unless it has been detached"""
+    with _lock():
+        entries = _load()
+        if entries.get(session_id, {}).get('pid') == os.getpid():
+            del entries[session_id]
+            _save(entries)
+
+
+def unresponsive_sessions(entries, wait=5):
+    """
+    Checks that the Jupyter servers of the given sessions are responding. All sessions are probed concurrently.
+
+    :param entries: list of registry entries
+    :param wait:    number of seconds to wait for the servers
+    :return:        list of entries whose servers are not responding
+    """
+    from iglesia.readiness import ServerProbe, await_servers
+    from . import config
+    probes = [ServerProbe(entry['session_id'], entry['ports'][0], path="/api/status", use_ssl=bool(config.SSL))
+              for entry in entries]
+    ready = await_servers(probes, wait=wait) if probes else {}
+    return [entry for entry in entries if ready[entry['session_id']] is None]
+
+
+def list_sessions(rootdir=None, probe_detached=False):
+    """
+    Returns running sessions. Entries whose owning process has died are removed from the registry. For
+    container sessions, the orphaned containers are killed.
+
+    :param rootdir:         if not None, only sessions serving this directory are returned
+    :param probe_detached:  if True, persistent (detached) sessions are checked for a responding Jupyter server,
+                            and the dead ones are killed and removed from the registry
+    :return:                OrderedDict of session_id -> entry, most recent session first
+    """
+    with _lock():
+        entries = _load()
+        stale = [entry for entry in entries.values() if entry['pid'] is not None and not pid_alive(entry['pid'])]
+        if stale:
+            for entry in stale:
+                del entries[entry['session_id']]
+            _save(entries)
+    orphans = [entry for entry in stale if entry['name']]
+    if orphans:
+        debug(f"clearing up {len(orphans)} orphaned container(s)")
+        kill_sessions(orphans, wait=False, unregister_sessions=False)
+
+    sessions = sorted(entries.values(), key=lambda entry: entry['start_time'], reverse=True)
+    if rootdir is not None:
+        sessions = [entry for entry in sessions if entry['rootdir'] == rootdir]
+    if probe_detached:
+        dead = unresponsive_sessions([entry for entry in sessions if entry['pid'] is None])
+        if dead:
+            for entry in dead:
+                warning(f"persistent session {entry['session_id']} is not responding, killing it")
+            kill_sessions(dead)
+            sessions = [entry for entry in sessions if entry not in dead]
+    return OrderedDict([(entry['session_id'], entry) for entry in sessions])
+
+
+def identify_session(session_dict, arg):
+    """Returns entry for session given by ordinal number, session ID (or unique prefix thereof), or container name.
+    Exits with error on mismatch"""
+    if len(arg) <= 4 and arg.isdigit():
+        num = int(arg)
+        if num >= len(session_dict):
+            bye(f"invalid session #{num}, we only have {len(session_dict)} running")
+        return list(session_dict.values())[num]
+    matches = [entry for sid, entry in session_dict.items() if sid.startswith(arg) or entry['name'] == arg]
+    if not matches:
+        bye(f"no such radiopadre session: {arg}")
+    if len(matches) > 1:
+        bye(f"session ID {arg} is ambiguous, please specify more characters")
+    return matches[0]
+
+
+def kill_sessions(entries, wait=True, unregister_sessions=True):
+    """
+    Kills the given sessions. Sessions are grouped by back-end, and each back-end kills its sessions in one batch.
+
+    :param entries:             list of registry entries
+    :param wait:                if False, does not wait for the kills to complete
+    :param unregister_sessions: if True, sessions are also removed from the registry
+    """
+    import importlib
+    for backend in BACKENDS:
+        batch = [entry for entry in entries if entry['backend'] == backend]
+        if batch:
+            importlib.import_module(f"radiopadre_client.backends.{backend}").kill_sessions(batch, wait=wait)
+    if unregister_sessions:
+        unregister(*[entry['session_id'] for entry in entries])
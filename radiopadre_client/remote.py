@@ -1,21 +1,62 @@
-import os, sys, subprocess, re, time, traceback, shlex, asyncio, signal
+import os, sys, subprocess, time, traceback, shlex, asyncio, signal, json
 
-from . import config
+from . import config, remote_cache, remote_parser
+from .ssh_mux import SSHMux, ssh_mux_options
+from .nbsync import NotebookSync
 
 import iglesia
-from iglesia.utils import DEVNULL, message, warning, error, debug, bye, find_unused_port, Poller, INPUT
+from iglesia import profiler
+from iglesia.utils import DEVNULL, message, warning, error, debug, bye, Poller, INPUT
+from iglesia.ports import reserve_ports
 from iglesia.helpers import NUM_PORTS
+from iglesia.readiness import ServerProbe, await_servers
 
 from radiopadre_client.server import run_browser
 
-# which method to use to dispatch messages from remote. Default is message().
-_dispatch_message = {': WARNING: ':warning, ': ERROR: ':error, ': DEBUG:':debug}
+# marker prefixing the JSON line printed by the remote probe script
+_PROBE_MARKER = "RADIOPADRE_PROBE:"
+
+# seconds to wait for the notebook server to answer through the port forwards
+FORWARD_WAIT = 30
+
+# bash function printing a stamp (name:mtime:inode) of the given paths, used to validate cached remote state
+_STAMP_FUNCTION = r"""_stamp() { if stat -c %Y / >/dev/null 2>&1; then stat -c '%n:%Y:%i' "$@" 2>/dev/null; """ + \
+                  r"""else stat -f '%N:%m:%i' "$@" 2>/dev/null; fi | tr '\n' ' '; }"""
+
+def _make_probe_script(commands, files, venv, runscript):
+    """
+    Forms up a bash script that probes the remote environment in a single round trip, and prints the results
+    as a JSON dict on one line, prefixed by _PROBE_MARKER. Paths are left unquoted so that "~" is expanded
+    by the remote shell.
+
+    :param commands:    list of commands to look for in the remote PATH
+    :param files:       dict of key -> (test, path) file checks, with tests specified bash-style, e.g. "-d"
+    :param venv:        remote virtualenv path (can be empty)
+    :param runscript:   name of client script to look for inside the virtualenv
+    :return:            script, which prints a dict of "which" -> {command: path}, "files" -> {key: bool},
+                        "venv" -> expanded venv path, "venv_runscript" -> path to runscript within venv,
+                        "stamp" -> stamp of the venv and runscript (see _STAMP_FUNCTION)
+    """
+    lines = [_STAMP_FUNCTION,
+             r"""_s() { local v="${1//\\/\\\\}"; v="${v//\"/\\\"}"; printf '"%s"' "$v"; }""",
+             r"""_t() { if eval "[ $1 ]" 2>/dev/null; then printf true; else printf false; fi; }""",
+             f"venv=$(echo {venv})" if venv else "venv=",
+             f'venv_runscript=$( [ -n "$venv" ] && [ -f "$venv/bin/activate" ] && '
+             f'source "$venv/bin/activate" >/dev/null 2>&1 && type -P {runscript} )',
+             f"""printf '{_PROBE_MARKER}{{"which": {{'"""]
+    lines.append("\nprintf ', '\n".join([f"""printf '"{cmd}": '; _s "$(type -P {cmd})" """ for cmd in commands]))
+    lines.append("""printf '}, "files": {'""")
+    lines.append("\nprintf ', '\n".join([f"""printf '"{key}": '; _t {shlex.quote(f"{test} {path}")}"""
+                                        for key, (test, path) in files.items()]))
+    lines.append(f"""runscript_path=${{venv_runscript:-$(type -P {runscript})}}""")
+    lines.append("""printf '}, "venv": '; _s "$venv"; printf ', "venv_runscript": '; _s "$venv_runscript"; """
+                 """printf ', "stamp": '; _s "$(_stamp "$venv" "$venv/bin" "$runscript_path")"; printf '}\\n'""")
+    return "\n".join(lines)
 
-# Find remote radiopadre script
 def run_remote_session(command, copy_initial_notebook, notebook_path, extra_arguments,
                        version_extracter=None, expected_version=None):
     
-    SSH_MUX_OPTS = f"-p {config.REMOTE_PORT} -o ControlPath=/tmp/ssh_mux_radiopadre_%C -o ControlMaster=auto -o ControlPersist=1h".split()
+    SSH_MUX_OPTS = ssh_mux_options()
 
     SCP_OPTS = ["scp"] + SSH_MUX_OPTS
     SSH_OPTS = ["ssh", "-t", "-t"] + SSH_MUX_OPTS + [config.REMOTE_HOST]
@@ -23,8 +64,10 @@ def run_remote_session(command, copy_initial_notebook, notebook_path, extra_argu
 
 # See, possibly: https://stackoverflow.com/questions/44348083/how-to-send-sigint-ctrl-c-to-current-remote-process-over-ssh-without-t-optio
 
-    # master ssh connection, to be closed when we exit
-    message(f"Opening ssh connection to {config.REMOTE_HOST}. You may be prompted for your password.")
+    # master ssh connection: opened up front, and left to persist for the next session. The port forwards we
+    # add to it are cancelled when we exit
+    mux = SSHMux(config.REMOTE_HOST)
+    mux.open()
     debug("  {}".format(" ".join(SSH_OPTS)))
 
 
@@ -87,8 +130,40 @@ def run_remote_session(command, copy_initial_notebook, notebook_path, extra_argu
         """
         if config.SKIP_CHECKS:
             return command
+        if command in probe['which']:
+            return probe['which'][command]
         return (ssh_remote("which " + command, fail_retcode=1, stderr=DEVNULL) or "").strip()
 
+    def check_probed_file(key, remote_file, test):
+        """
+        Like check_remote_file(), but uses the result of the initial remote probe, if available
+        """
+        if key in probe['files']:
+            return probe['files'][key]
+        return check_remote_file(remote_file, test)
+
+    def probe_remote():
+        """
+        Probes the remote environment in one round trip. Returns dict of facts (see _make_probe_script)
+        """
+        files = dict(venv_dir=("-d", config.RADIOPADRE_VENV or "''"),
+                     venv_activate=("-f", f"{config.RADIOPADRE_VENV}/bin/activate"))
+        if config.CLIENT_INSTALL_PATH:
+            files['client_install_path'] = ("-d", config.CLIENT_INSTALL_PATH)
+            files['client_install_git'] = ("-d", f"{config.CLIENT_INSTALL_PATH}/.git")
+        if config.SSL:
+            files['remote_pem'] = ("-f", f"{config.REMOTE_RADIOPADRE_DIR}/{config.SERVER_PEM_BASENAME}")
+        if copy_initial_notebook:
+            files['notebook_dir'] = ("-d", notebook_path or ".")
+            files['notebook'] = ("-f", "{}/{}".format(notebook_path or ".", copy_initial_notebook))
+        script = _make_probe_script(["git", "docker", "singularity", runscript0], files,
+                                    config.RADIOPADRE_VENV, runscript0)
+        output = ssh_remote(script)
+        for line in output.split("\n"):
+            if line.startswith(_PROBE_MARKER):
+                return json.loads(line[len(_PROBE_MARKER):])
+        bye(f"Unexpected output from remote probe on {config.REMOTE_HOST}: {output}")
+
     # --update or --auto-init disables --skip-checks
     if config.SKIP_CHECKS:
         if config.UPDATE:
@@ -103,13 +178,54 @@ def run_remote_session(command, copy_initial_notebook, notebook_path, extra_argu
     remote_config['BROWSER'] = 'None'
     remote_config['SKIP_CHECKS'] = False
     remote_config['VENV_REINSTALL'] = False
+    # notebooks are synced from this end
+    remote_config.pop('NOTEBOOK_SYNC', None)
     # delete remote options
     for key in [key for key in remote_config.keys() if key.startswith("REMOTE_")]:
         del remote_config[key]
 
+    # which runscript to look for
+    runscript0 = "run-radiopadre"
+
+    # form up remote venv path, but do not expand ~ at this point (it may be a different username on the remote)
+    env = os.environ.copy()
+    env.setdefault("RADIOPADRE_DIR", config.REMOTE_RADIOPADRE_DIR or "~/.radiopadre")
+    config.RADIOPADRE_VENV = (config.RADIOPADRE_VENV or "").format(**env)
+
+    # key of remote cache entry: settings that affect the outcome of the remote probe
+    cache_host = f"{config.REMOTE_HOST}:{config.REMOTE_PORT}"
+    cache_key = [config.BACKEND, config.RADIOPADRE_VENV, config.CLIENT_INSTALL_PATH, config.REMOTE_HOP,
+                 config.REMOTE_UTILITY_SHELL, config.REMOTE_RADIOPADRE_DIR]
+    cache_entry = None
+    if config.UPDATE or config.AUTO_INIT:
+        remote_cache.invalidate(cache_host)
+    elif not config.SKIP_CHECKS:
+        cache_entry = remote_cache.load(cache_host, cache_key)
+
     # Check for various remote bits
-    if config.VERBOSE and not config.SKIP_CHECKS:
-        message(f"Checking installation on {config.REMOTE_HOST}.")
+    checks_start = time.time()
+    probe = dict(which={}, files={}, venv=config.RADIOPADRE_VENV, venv_runscript="")
+    if cache_entry:
+        # validate cache with one stat of the venv and runscript
+        stamp = ssh_remote(f"{_STAMP_FUNCTION}; _stamp " +
+                           " ".join(map(shlex.quote, remote_cache.stamp_paths(cache_entry['probe']))))
+        if stamp.strip() == cache_entry['probe']['stamp'].strip():
+            message(f"Using cached installation state for {config.REMOTE_HOST} (run with -u to refresh)")
+            probe = cache_entry['probe']
+            client_version = cache_entry.get('client_version')
+            if client_version and expected_version and client_version != expected_version:
+                warning(f"Remote client version was {client_version} last time, local version is {expected_version}")
+        else:
+            message(f"Remote installation on {config.REMOTE_HOST} has changed since the last check")
+            cache_entry = None
+    if not config.SKIP_CHECKS and not cache_entry:
+        if config.VERBOSE:
+            message(f"Checking installation on {config.REMOTE_HOST}.")
+        probe = probe_remote()
+        debug(f"remote probe returns {probe}")
+    # the probe expands "~" on the remote for us
+    if probe['venv']:
+        config.RADIOPADRE_VENV = probe['venv']
 
     has_git = check_remote_command("git")
 
@@ -135,13 +251,6 @@ def run_remote_session(command, copy_initial_notebook, notebook_path, extra_argu
     if remote_config["BACKEND"] != "docker":
         config.CONTAINER_PERSIST = config.CONTAINER_DEBUG = False
 
-    # which runscript to look for
-    runscript0 = "run-radiopadre"
-
-    # form up remote venv path, but do not expand ~ at this point (it may be a different username on the remote)
-    env = os.environ.copy()
-    env.setdefault("RADIOPADRE_DIR", config.REMOTE_RADIOPADRE_DIR or "~/.radiopadre")
-    config.RADIOPADRE_VENV = (config.RADIOPADRE_VENV or "").format(**env)
     # this variable used in error and info messages
     remote_venv = f"{config.REMOTE_HOST}:{config.RADIOPADRE_VENV}"
 
@@ -163,10 +272,8 @@ def run_remote_session(command, copy_initial_notebook, notebook_path, extra_argu
         if config.AUTO_INIT and config.VENV_REINSTALL:
             if not config.RADIOPADRE_VENV:
                 bye(f"Can't do --auto-init --venv-reinstall because --radiopadre-venv is not set")
-            if "~" in config.RADIOPADRE_VENV:
-                config.RADIOPADRE_VENV = ssh_remote(f"echo {config.RADIOPADRE_VENV}").strip()  # expand "~" on remote
-            if check_remote_file(f"{config.RADIOPADRE_VENV}", "-d"):
-                if not check_remote_file(f"{config.RADIOPADRE_VENV}/bin/activate", "-f"):
+            if probe['files']['venv_dir']:
+                if not probe['files']['venv_activate']:
                     error(f"{remote_venv}/bin/activate does not exist. Bat country!")
                     bye(f"Refusing to touch this virtualenv. Please remove it by hand if you must.")
                 cmd = f"rm -fr {config.RADIOPADRE_VENV}"
@@ -182,15 +289,15 @@ def run_remote_session(command, copy_initial_notebook, notebook_path, extra_argu
                         bye(f"'{inp}' is not a 'yes'. Phew!")
                     message("OK, nuking it!")
                 ssh_remote(cmd)
+                probe['files']['venv_dir'] = probe['files']['venv_activate'] = False
+                probe['venv_runscript'] = ""
             # force update
             do_update = True
 
         # (b) look inside venv
         if runscript is None and config.RADIOPADRE_VENV:
-            if "~" in config.RADIOPADRE_VENV:
-                config.RADIOPADRE_VENV = ssh_remote(f"echo {config.RADIOPADRE_VENV}").strip()  # expand "~" on remote
-            if check_remote_file(f"{config.RADIOPADRE_VENV}/bin/activate", "-f"):
-                if ssh_remote(f"source {config.RADIOPADRE_VENV}/bin/activate && which {runscript0}", fail_retcode=1):
+            if probe['files']['venv_activate']:
+                if probe['venv_runscript']:
                     runscript = f"source {config.RADIOPADRE_VENV}/bin/activate && {runscript0}"
                     message(f"Using remote client script within {config.RADIOPADRE_VENV}")
                 else:
@@ -222,7 +329,7 @@ def run_remote_session(command, copy_initial_notebook, notebook_path, extra_argu
         message("Trying to --auto-init an installation for you...")
 
         # try to auto-init a virtual environment
-        if not check_remote_file(f"{config.RADIOPADRE_VENV}/bin/activate", "-f"):
+        if not check_probed_file('venv_activate', f"{config.RADIOPADRE_VENV}/bin/activate", "-f"):
             message(f"Creating virtualenv {remote_venv}")
             ssh_remote_v(f"{config.REMOTE_PYTHON} -mvenv {config.RADIOPADRE_VENV}", main_process=True)
             ssh_remote_v(f"source {config.RADIOPADRE_VENV}/bin/activate && {pip_install} -U pip setuptools wheel uv", main_process=True)
@@ -236,11 +343,11 @@ def run_remote_session(command, copy_initial_notebook, notebook_path, extra_argu
     # Now, figure out how to install or update the client package
     if not runscript or do_update:
         # installing from a specified existing path
-        if config.CLIENT_INSTALL_PATH and check_remote_file(config.CLIENT_INSTALL_PATH, "-d"):
+        if config.CLIENT_INSTALL_PATH and check_probed_file('client_install_path', config.CLIENT_INSTALL_PATH, "-d"):
             install_path = config.CLIENT_INSTALL_PATH
             message(f"--client-install-path {install_path} is configured and exists on {config.REMOTE_HOST}.")
             # update if managed by git
-            if check_remote_file(f"{install_path}/.git", "-d") and config.UPDATE:
+            if check_probed_file('client_install_git', f"{install_path}/.git", "-d") and config.UPDATE:
                 if has_git:
                     if config.CLIENT_INSTALL_BRANCH:
                         cmd = f"cd {install_path} && git fetch origin && git checkout {config.CLIENT_INSTALL_BRANCH} && git pull"
@@ -289,34 +396,51 @@ def run_remote_session(command, copy_initial_notebook, notebook_path, extra_argu
 
         message("Success!")
 
+    # cache remote state, unless we have just changed it
+    elif not config.SKIP_CHECKS and not cache_entry:
+        remote_cache.save(cache_host, cache_key, probe)
+
     runscript = f"export RADIOPADRE_DIR={config.REMOTE_RADIOPADRE_DIR}; {runscript}"
 
     # copy certificate to remote, if it is missing
     if config.SSL:
         remote_pem = f"{config.REMOTE_RADIOPADRE_DIR}/{config.SERVER_PEM_BASENAME}"
-        if not check_remote_file(remote_pem, "-f"):
+        if not check_probed_file('remote_pem', remote_pem, "-f"):
             message(f"Copying SSL certificate to {config.REMOTE_HOST}")
             scp_to_remote(config.SERVER_PEM, remote_pem)
 
+    # push new and changed local notebooks to remote (pulled back when the session exits)
+    nbsync = None
+    if config.NOTEBOOK_SYNC and command == "load":
+        if not os.path.isdir(os.path.expanduser(config.NOTEBOOK_SYNC)):
+            bye(f"--notebook-sync: {config.NOTEBOOK_SYNC} is not a directory")
+        sync_dir = notebook_path or "."
+        if sync_dir.endswith(".ipynb"):
+            sync_dir = os.path.dirname(sync_dir) or "."
+        nbsync = NotebookSync(mux, config.NOTEBOOK_SYNC, sync_dir)
+        with profiler.phase("notebook sync"):
+            nbsync.push()
+
     # copy notebook to remote
     if copy_initial_notebook:
         if not os.path.exists(copy_initial_notebook):
             bye("{} doesn't exist".format(copy_initial_notebook))
-        if check_remote_file(notebook_path or ".", "-d"):
+        if check_probed_file('notebook_dir', notebook_path or ".", "-d"):
             nbpath = "{}/{}".format(notebook_path or ".", copy_initial_notebook)
-            if check_remote_file(nbpath, "-f"):
+            if check_probed_file('notebook', nbpath, "-f"):
                 message(f"remote notebook {nbpath} exists, will not copy over")
             else:
                 message(f"remote notebook {nbpath} doesn't exist, will copy over")
                 scp_to_remote(copy_initial_notebook, notebook_path)
             notebook_path = nbpath
 
+    profiler.record("remote installation checks", checks_start)
+
     # allocate suggested ports (in resume mode, this will be overridden by the session settings)
-    starting_port = 10000 + os.getuid() * 3
-    ports = []
-    for _ in range(NUM_PORTS):
-        starting_port = find_unused_port(starting_port + 1, 10000)
-        ports.append(starting_port)
+    # (these are held until the ssh forwards are set up)
+    with profiler.phase("port allocation"):
+        port_block = reserve_ports(NUM_PORTS, key=f"{config.REMOTE_HOST}:{notebook_path}")
+        ports = port_block.ports
     iglesia.set_userside_ports(ports)
 
     remote_config["remote"] = ":".join(map(str, ports))
@@ -343,25 +467,64 @@ def run_remote_session(command, copy_initial_notebook, notebook_path, extra_argu
     status = 0
     eof_reported = False
 
-    loop = asyncio.get_event_loop()
+    launch_start = time.time()
+    # use a loop of our own: nothing in the stream readers below may block it, else the remote's output
+    # isn't drained, and the remote can stall on a full pipe. Slow operations are run as separate tasks
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     proc = loop.run_until_complete(
         asyncio.create_subprocess_exec(*args,
             stdin=asyncio.subprocess.PIPE,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE))
 
-    remote_running = False
-    jupyter_running = asyncio.Event()
+    forward_task = jupyter_port = None
+    aux_tasks = []
 
-    async def proc_awaiter(proc, *cancellables):
+    async def proc_awaiter(proc):
         await proc.wait()
-        for task in cancellables:
+        for task in aux_tasks:
             task.cancel()
 
-    async def remote_jupyter_waiter(event):
-        await event.wait()
+    async def forward_ports(forwards):
+        """Sends port forward request to ssh mux process"""
+        ssh2_args = mux.forward_command(forwards)
+        if config.VERBOSE:
+            message(f"sending forward request to ssh mux process: {' '.join(ssh2_args)}")
+        fwd_proc = await asyncio.create_subprocess_exec(*ssh2_args, stdin=asyncio.subprocess.DEVNULL)
+        retcode = await fwd_proc.wait()
+        if retcode:
+            warning(f"ssh port forward request has failed with code {retcode}")
+        else:
+            mux.add_forwards(forwards)
 
-    startup_waiter = asyncio.Task(remote_jupyter_waiter(jupyter_running))
+    async def launch_browser():
+        """Launches browser once the port forwards are in place"""
+        try:
+            if forward_task is not None:
+                await forward_task
+                # make sure the notebook server answers through the forwards before pointing a browser at it
+                probe = ServerProbe("jupyter", jupyter_port, path="/api/status", use_ssl=bool(config.SSL))
+                ready = await loop.run_in_executor(None, lambda: await_servers([probe], wait=FORWARD_WAIT))
+                if ready["jupyter"] is None:
+                    warning(f"notebook server is not answering via port {jupyter_port}")
+            if urls:
+                # the browser launch may block, so it goes to a thread
+                iglesia.register_helpers(*await loop.run_in_executor(None, run_browser, *urls))
+            message("The remote radiopadre session is now fully up")
+            profiler.report()
+            if USE_VENV or not config.CONTAINER_PERSIST:
+                message("Press Ctrl+C to kill the remote session")
+            else:
+                message("Press D<Enter> to detach from remote session, or Ctrl+C to kill it")
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            traceback.print_exc()
+            error(f"error launching browser: {exc}")
+
+    # startup announcements may come from either stream, so both readers share a parser
+    parser = remote_parser.RemoteOutputParser(version_extracter)
 
     async def remote_stream_reader(stream, stream_name, is_stderr=False):
         while not stream.at_eof():
@@ -374,89 +537,62 @@ def run_remote_session(command, copy_initial_notebook, notebook_path, extra_argu
             else:
                 print_output = not line.startswith("radiopadre:") or command != 'load'
             if not empty_line and (config.VERBOSE or print_output):
-                for key, dispatch in _dispatch_message.items():
-                    if key in line:
-                        dispatch(u"{}: {}".format(stream_name, line))
-                        break
-                else:
-                    message(u"{}: {}".format(stream_name, line))
+                remote_parser.dispatcher(line)(u"{}: {}".format(stream_name, line))
             if not line or stream.at_eof():
                 continue
+            event = parser.parse(line)
+            if event is None:
+                continue
+            event, value = event
             # check remote version
-            if version_extracter is not None:
-                remote_version = version_extracter(line)
-                if remote_version:
-                    if remote_version != expected_version:
-                        message(f"Remote client version ({remote_version}) does not match local version ({expected_version})", 
-                                color="RED")
-                        message(f"This may lead to unexpected failures. Please try to update remote installation", color="RED")
-                        message(f"by running with -u --venv-reinstall", color="RED")
-                    else:
-                        message("remote version matches our own, all is well")
-            # if remote is not yet started, check output
-            match = re.match(r".*radiopadre is running on host ([^\s]+)", line)
-            if match:
-                remote_hostname = match.group(1)
+            if event == remote_parser.VERSION:
+                if not config.SKIP_CHECKS:
+                    remote_cache.update(cache_host, client_version=value)
+                if value != expected_version:
+                    message(f"Remote client version ({value}) does not match local version ({expected_version})", 
+                            color="RED")
+                    message(f"This may lead to unexpected failures. Please try to update remote installation", color="RED")
+                    message(f"by running with -u --venv-reinstall", color="RED")
+                else:
+                    message("remote version matches our own, all is well")
+            elif event == remote_parser.HOST:
                 if config.VERBOSE:
-                    message(f"ultimate host self-identifies as {remote_hostname}")
-            nonlocal remote_running
-            if not remote_running:
-                # check for session ID
-                match = re.match(".*Session ID/notebook token is '([0-9a-f]+)'", line)
-                if match:
-                    config.SESSION_ID = match.group(1)
-                    continue
-                # check for notebook port, and launch second ssh with port forwards when we have it
-                re_ports = ":".join([r"([\d]+)"]*(NUM_PORTS*2))   # form up regex for ddd:ddd:...
-                match = re.match(rf".*Selected ports: {re_ports}[\s]*$", line)
-                if match:
-                    ports = list(map(int, match.groups()))
-                    remote_ports = ports[:NUM_PORTS]
-                    local_ports = ports[NUM_PORTS:]
-                    if config.VERBOSE:
-                        message(f"Detected ports {':'.join(map(str, local_ports))} -> {':'.join(map(str, remote_ports))}")
-                    ssh2_args = ["ssh"] + SSH_MUX_OPTS + ["-O", "forward", config.REMOTE_HOST]
-                    for loc, rem in zip(local_ports, remote_ports):
-                        ssh2_args += ["-L", f"localhost:{loc}:{remote_hostname}:{rem}"]
-                    # tell mux process to forward the ports
-                    if config.VERBOSE:
-                        message(f"sending forward request to ssh mux process: {' '.join(ssh2_args)}")
-                    subprocess.call(ssh2_args)
-                    continue
-
-                # check for launch URL
-                match = re.match(r".*Browse to URL: ([^\s\033]+)", line)
-                if match:
-                    urls.append(match.group(1))
-                    continue
-
-                if "jupyter notebook server is running" in line:
-                    remote_running = True
-                    time.sleep(1)
-                    if urls:
-                        iglesia.register_helpers(*run_browser(*urls))
-                    message("The remote radiopadre session is now fully up")
-                    if USE_VENV or not config.CONTAINER_PERSIST:
-                        message("Press Ctrl+C to kill the remote session")
-                    else:
-                        message("Press D<Enter> to detach from remote session, or Ctrl+C to kill it")
+                    message(f"ultimate host self-identifies as {value}")
+            elif event == remote_parser.SESSION_ID:
+                config.SESSION_ID = value
+            # launch second ssh with port forwards when we have the notebook port
+            elif event == remote_parser.PORTS:
+                remote_ports = value[:NUM_PORTS]
+                local_ports = value[NUM_PORTS:]
+                if config.VERBOSE:
+                    message(f"Detected ports {':'.join(map(str, local_ports))} -> {':'.join(map(str, remote_ports))}")
+                forwards = [f"localhost:{loc}:{parser.hostname}:{rem}" for loc, rem in zip(local_ports, remote_ports)]
+                # tell mux process to forward the ports
+                port_block.release()
+                nonlocal forward_task, jupyter_port
+                jupyter_port = local_ports[0]
+                forward_task = loop.create_task(forward_ports(forwards))
+                aux_tasks.append(forward_task)
+            elif event == remote_parser.URL:
+                urls.append(value)
+            elif event == remote_parser.RUNNING:
+                profiler.record("remote session startup", launch_start)
+                aux_tasks.append(loop.create_task(launch_browser()))
 
         nonlocal eof_reported
         if not eof_reported:
             message(f"The ssh process to {config.REMOTE_HOST} reports EOF")
             eof_reported = True
 
-    # async def proc_awaiter(proc, *cancellables):
-    #     await proc.wait()
-
-
-    try:
-        job = asyncio.gather(
-            proc_awaiter(proc, startup_waiter),
+    async def run_session():
+        await asyncio.gather(
+            proc_awaiter(proc),
             remote_stream_reader(proc.stdout, config.REMOTE_HOST),
             remote_stream_reader(proc.stderr, f"{config.REMOTE_HOST} stderr", is_stderr=True),
         )
-        results = loop.run_until_complete(job)
+
+    try:
+        loop.run_until_complete(run_session())
         status = proc.returncode
 
     except SystemExit as exc:
@@ -505,5 +641,16 @@ def run_remote_session(command, copy_initial_notebook, notebook_path, extra_argu
             proc.kill()
 
     loop.run_until_complete(cleanup_process(proc))
+    for task in aux_tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*aux_tasks, return_exceptions=True))
+    loop.run_until_complete(loop.shutdown_default_executor())
+    loop.close()
+
+    if nbsync is not None:
+        nbsync.pull()
+
+    # free up the local ports for the next session
+    mux.cancel_forwards()
 
     return status
@@ -0,0 +1,82 @@
+import os, os.path, re, json, time
+
+import iglesia
+from iglesia.utils import warning, debug, make_dir
+
+# Per-host cache of remote installation state (i.e. the result of the remote probe in run_remote_session(),
+# plus the remote client version). Entries are validated against a stamp (name:mtime:inode) of the remote
+# virtualenv and runscript, so a repeat connection needs only one cheap stat on the remote.
+
+CACHE_DIR = os.path.join(iglesia.RADIOPADRE_DIR, "remote-cache")
+
+# probed file checks that are specific to a session, and should not be cached
+_SESSION_SPECIFIC_FILES = {"notebook_dir", "notebook", "remote_pem"}
+
+
+def _cache_file(host):
+    return os.path.join(CACHE_DIR, re.sub(r"[^\w@.-]", "_", host) + ".json")
+
+
+def load(host, key):
+    """
+    Loads cache entry for host. Returns entry dict, or None if there is no entry, or if the entry was
+    created with a different key (i.e. with different settings affecting the remote probe)
+    """
+    filename = _cache_file(host)
+    if not os.path.exists(filename):
+        return None
+    try:
+        entry = json.load(open(filename, "rt"))
+    except Exception as exc:
+        warning(f"error reading {filename}: {exc}, ignoring")
+        return None
+    if entry.get('key') != key:
+        debug(f"remote cache entry {filename} is for different settings, ignoring")
+        return None
+    return entry
+
+
+def save(host, key, probe, **kw):
+    """
+    Saves cache entry for host, given a probe dict (as returned by the remote probe), and any extra
+    items to be stored.
+    """
+    make_dir(CACHE_DIR)
+    probe = dict(probe)
+    probe['files'] = {name: value for name, value in probe['files'].items() if name not in _SESSION_SPECIFIC_FILES}
+    entry = dict(key=key, probe=probe, timestamp=time.time(), **kw)
+    filename = _cache_file(host)
+    try:
+        with open(filename + ".new", "wt") as cachefile:
+            json.dump(entry, cachefile, indent=2)
+        os.rename(filename + ".new", filename)
+    except Exception as exc:
+        warning(f"error writing {filename}: {exc}")
+
+
+def update(host, **kw):
+    """Updates items in an existing cache entry for host"""
+    filename = _cache_file(host)
+    if os.path.exists(filename):
+        try:
+            entry = json.load(open(filename, "rt"))
+            entry.update(**kw)
+            with open(filename + ".new", "wt") as cachefile:
+                json.dump(entry, cachefile, indent=2)
+            os.rename(filename + ".new", filename)
+        except Exception as exc:
+            warning(f"error updating {filename}: {exc}")
+
+
+def invalidate(host):
+    """Removes cache entry for host"""
+    filename = _cache_file(host)
+    if os.path.exists(filename):
+        debug(f"removing remote cache entry {filename}")
+        os.unlink(filename)
+
+
+def stamp_paths(probe):
+    """Returns list of remote paths whose stamp is used to validate a cache entry"""
+    venv = probe['venv']
+    return [venv, f"{venv}/bin", probe['venv_runscript'] or probe['which'].get('run-radiopadre') or ""]
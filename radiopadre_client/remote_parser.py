@@ -0,0 +1,80 @@
+"""
+Parser for the console output of a remote radiopadre session.
+
+Every line from the remote is classified for dispatch (message, warning, error or debug), and, until the remote
+session is up, checked for the startup announcements (version, hostname, session ID, ports, URLs). All the
+startup patterns are folded into a single precompiled regex, so each line is scanned once. Once the
+"jupyter notebook server is running" line has been seen, only the dispatch classification remains, since
+that is all that chatty kernels can still trigger.
+"""
+import re
+
+from iglesia.utils import message, warning, error, debug
+from iglesia.helpers import NUM_PORTS
+
+# event types returned by RemoteOutputParser.parse()
+VERSION = "version"
+HOST = "host"
+SESSION_ID = "session_id"
+PORTS = "ports"
+URL = "url"
+RUNNING = "running"
+
+_STARTUP_RE = re.compile("|".join([
+    r"radiopadre is running on host (?P<host>\S+)",
+    r"Session ID/notebook token is '(?P<session_id>[0-9a-f]+)'",
+    # selected remote ports, followed by the local ports they are to be forwarded to
+    rf"Selected ports: (?P<ports>\d+(?::\d+){{{NUM_PORTS * 2 - 1}}})\s*$",
+    r"Browse to URL: (?P<url>[^\s\033]+)",
+    r"(?P<running>jupyter notebook server is running)"]))
+
+_LEVEL_RE = re.compile(r": (?:(WARNING|ERROR): |(DEBUG):)")
+
+_DISPATCH = dict(WARNING=warning, ERROR=error, DEBUG=debug)
+
+
+def dispatcher(line):
+    """Returns function that should be used to report the given line of remote output"""
+    match = _LEVEL_RE.search(line)
+    return _DISPATCH[match.group(1) or match.group(2)] if match else message
+
+
+class RemoteOutputParser(object):
+    """
+    Tracks the startup of a remote session from its output. A single parser should be fed the lines of both the
+    stdout and stderr of the remote.
+
+    :param version_extracter:   callable returning the client version announced in a line of output, or None
+    """
+    def __init__(self, version_extracter=None):
+        self.version_extracter = version_extracter
+        self.version = None
+        self.hostname = None
+        self.running = False
+
+    def parse(self, line):
+        """
+        Checks a line of output for startup announcements.
+
+        :return:    tuple of event type and value, or None if the line announces nothing. The value of a PORTS
+                    event is a list of ints, that of a RUNNING event is True, the others are strings.
+        """
+        if self.running:
+            return None
+        if self.version is None and self.version_extracter is not None:
+            version = self.version_extracter(line)
+            if version:
+                self.version = version
+                return VERSION, version
+        match = _STARTUP_RE.search(line)
+        if match is None:
+            return None
+        event = match.lastgroup
+        if event == PORTS:
+            return event, list(map(int, match.group(event).split(":")))
+        if event == HOST:
+            self.hostname = match.group(event)
+        elif event == RUNNING:
+            self.running = True
+            return event, True
+        return event, match.group(event)
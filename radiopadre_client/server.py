@@ -1,14 +1,16 @@
 from __future__ import print_function
-import os, os.path, sys, subprocess, time, glob, uuid, shutil, fnmatch, webbrowser
+import os, os.path, sys, time, glob, uuid, shutil, fnmatch, atexit
 
-from . import config
+from . import config, registry
 import iglesia
-from iglesia.utils import DEVNULL, DEVZERO, message, warning, bye, find_unused_port, find_which
+from iglesia import profiler
+from iglesia.utils import DEVNULL, DEVZERO, message, warning, bye, find_which
+from iglesia.ports import reserve_ports
 from iglesia.helpers import NUM_PORTS
 from .notebooks import default_notebook_code
 
 
-backend = None
+backend = backend_name = None
 
 JUPYTER_OPTS = LOAD_DIR = LOAD_NOTEBOOK = None
 
@@ -20,16 +22,16 @@ def run_browser(*urls):
     procs = []
     # open browser if needed
     if config.BROWSER:
+        import webbrowser
         browser = config.BROWSER
         message(f"Running browser '{browser}' for {' '.join(urls)}\r")
         controller = webbrowser.get(None if browser.upper() == "DEFAULT" else browser)
         message("  if this fails, specify a correct browser type with --browser and rerun,")
         message("  or else browse to the URL given above (\"Browse to URL:\") yourself.")
-        # sometimes the notebook does not respond immediately, so take a second
-        time.sleep(1)
-        controller.open(urls[0], new=1 if config.NEW_WINDOW else 2)
-        for url in urls[1:]:
-            controller.open_new_tab(url)
+        with profiler.phase("browser launch"):
+            controller.open(urls[0], new=1 if config.NEW_WINDOW else 2)
+            for url in urls[1:]:
+                controller.open_new_tab(url)
     else:
         message("--no-browser given, or browser not set, not opening a browser for you\r")
         message("Please browse to: {}\n".format(" ".join(urls)))
@@ -38,12 +40,14 @@ def run_browser(*urls):
 
 
 def run_radiopadre_server(command, arguments, notebook_path, workdir=None):
-    global backend
+    global backend, backend_name
 
     # message("Welcome to Radiopadre!")
     USE_VENV = USE_DOCKER = USE_SINGULARITY = False
 
-    for backend in config.BACKEND:
+    probe_start = time.time()
+    for backend_name in config.BACKEND:
+        backend = backend_name
         if backend == "venv":
             USE_VENV = True
             import radiopadre_client.backends.venv
@@ -72,58 +76,72 @@ def run_radiopadre_server(command, arguments, notebook_path, workdir=None):
         message(f"The '{backend}' back-end is not available.")
     else:
         bye(f"None of the specified back-ends are available.")
+    profiler.record("backend probing", probe_start)
 
     # if not None, gives the six port assignments
     attaching_to_ports = container_name = None
+    # if not None, holds the reserved ports until the session is started
+    port_block = None
 
     # ### ps/ls command
     if command == 'ps' or command == 'ls':
-        session_dict = backend.list_sessions()
+        session_dict = registry.list_sessions(probe_detached=True)
         num = len(session_dict)
         message("{} session{} running".format(num, "s" if num != 1 else ""))
-        for i, (id, (name, path, uptime, session_id, ports)) in enumerate(session_dict.items()):
-            print("{i}: id {id}, name {name}, in {path}, up since {uptime}".format(**locals()))
+        for i, (session_id, entry) in enumerate(session_dict.items()):
+            uptime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry['start_time']))
+            name = entry['name'] or f"pid {entry['pid']}"
+            message(f"{i}: {entry['backend']} session {session_id}, {name}, in {entry['rootdir']}, up since {uptime}")
         sys.exit(0)
 
     # ### kill command
     if command == 'kill':
-        session_dict = backend.list_sessions()
+        session_dict = registry.list_sessions()
         if not session_dict:
             bye("no sessions running, nothing to kill")
         if arguments[0] == "all":
-            kill_sessions = session_dict.keys()
+            kill_sessions = list(session_dict.values())
         else:
-            kill_sessions = [backend.identify_session(session_dict, arg) for arg in arguments]
-        backend.kill_sessions(session_dict, kill_sessions)
+            kill_sessions = [registry.identify_session(session_dict, arg) for arg in arguments]
+        registry.kill_sessions(kill_sessions)
         sys.exit(0)
 
     ## attach command
     if command == "resume":
-        session_dict = backend.list_sessions()
+        session_dict = registry.list_sessions(probe_detached=True)
+        if not session_dict:
+            bye("no sessions running, nothing to attach to")
         if arguments:
-            id_ = backend.identify_session(session_dict, arguments[0])
+            entry = registry.identify_session(session_dict, arguments[0])
         else:
-            if not session_dict:
-                bye("no sessions running, nothing to attach to")
-            config.SESSION_ID = session_dict.keys()[0]
-        container_name, path, _, _, attaching_to_ports = session_dict[id_]
-        message(f"  Attaching to existing session {config.SESSION_ID} running in {path}")
+            entry = list(session_dict.values())[0]
+        config.SESSION_ID = entry['session_id']
+        container_name, attaching_to_ports = entry['name'], entry['ports']
+        message(f"  Attaching to existing session {config.SESSION_ID} running in {entry['rootdir']}")
 
     # load command
     elif command == 'load':
         attaching_to_ports = None
+        # reattach to a detached persistent session for the same directory, if there is one
+        if config.CONTAINER_PERSIST and not USE_VENV and not config.INSIDE_CONTAINER_PORTS and not config.NBCONVERT:
+            path = notebook_path or "."
+            rootdir = os.path.realpath(path if os.path.isdir(path) else os.path.dirname(path) or ".")
+            for entry in registry.list_sessions(rootdir=rootdir, probe_detached=True).values():
+                if entry['pid'] is None and entry['backend'] == backend_name:
+                    config.SESSION_ID = entry['session_id']
+                    container_name, attaching_to_ports = entry['name'], entry['ports']
+                    message(f"  Reattaching to persistent session {config.SESSION_ID} running in {rootdir}")
+                    break
 
     # else unknown command
     else:
         bye("unknown command {}".format(command))
 
-    running_session_dict = None
-
     # ### SETUP LOCAL SESSION PROPERTIES: container_name, session_id, port assignments
 
-    # REATTACH MODE: everything is read from the session file
+    # REATTACH MODE: everything is read from the session registry
     if attaching_to_ports:
-        # session_id and container_name already set above. Ports read from session file and printed to the console
+        # session_id and container_name already set above. Ports read from session registry and printed to the console
         # for the benefit of the remote end (if any)
         jupyter_port, helper_port, http_port, carta_port, carta_ws_port, wetty_port = selected_ports = attaching_to_ports[:NUM_PORTS]
         userside_ports = attaching_to_ports[NUM_PORTS:]
@@ -140,14 +158,12 @@ def run_radiopadre_server(command, arguments, notebook_path, workdir=None):
         if not USE_VENV:
             container_name = "radiopadre-{}-{}".format(config.USER, uuid.uuid4().hex)
             message(f"Starting new session in container {container_name}")
-            # get dict of running sessions (for GRIM_REAPER later)
-            running_session_dict = backend.list_sessions()
         else:
             container_name = None
             message("Starting new session in virtual environment")
-        selected_ports = [find_unused_port(1024)]
-        for i in range(1, NUM_PORTS):
-            selected_ports.append(find_unused_port(selected_ports[-1] + 1))
+        with profiler.phase("port allocation"):
+            port_block = reserve_ports(NUM_PORTS, key=os.path.abspath(notebook_path or "."))
+            selected_ports = port_block.ports
 
         if config.REMOTE_MODE_PORTS:
             userside_ports = config.REMOTE_MODE_PORTS
@@ -200,12 +216,10 @@ def run_radiopadre_server(command, arguments, notebook_path, workdir=None):
     # ### ATTACHING TO EXISTING SESSION: complete the attachment and exit
 
     if attaching_to_ports:
-        url = f"http://localhost:{userside_jupyter_port}/tree#running?token={session_id}"
+        url = f"http://localhost:{userside_jupyter_port}/tree#running?token={config.SESSION_ID}"
         # in local mode, see if we need to open a browser. Else just print the URL -- remote script will pick it up
         if not config.REMOTE_MODE_PORTS and browser:
-            message(f"driving browser: {config.BROWSER} {url}")
-            subprocess.call([config.BROWSER, url], stdout=DEVNULL)
-            time.sleep(1)
+            run_browser(url)
         else:
             message(f"Browse to URL: {url}", color="GREEN")
         # emit message so remote initiates browsing
@@ -249,16 +263,18 @@ def run_radiopadre_server(command, arguments, notebook_path, workdir=None):
     if config.NBCONVERT and not LOAD_NOTEBOOK:
         bye("a notebook must be specified in order to use --nbconvert")
 
-    # if using containers (and not inside a container), see if older sessions need to be reaped
-    if running_session_dict and config.GRIM_REAPER:
-        kill_sessions = []
-        for cont, (_, path, _, sid, _) in running_session_dict.items():
-            if sid != config.SESSION_ID and os.path.samefile(path, os.getcwd()):
-                message(f"reaping older session {sid}")
-                kill_sessions.append(cont)
-
-        if kill_sessions:
-            backend.kill_sessions(running_session_dict, kill_sessions, ignore_fail=True)
+    # unless inside a container, see if older sessions need to be reaped, and register this one
+    if not config.INSIDE_CONTAINER_PORTS and not config.NBCONVERT:
+        if config.GRIM_REAPER and container_name:
+            kill_sessions = [entry for entry in registry.list_sessions(rootdir=os.getcwd()).values()
+                             if entry['name']]
+            for entry in kill_sessions:
+                message(f"reaping older session {entry['session_id']}")
+            if kill_sessions:
+                registry.kill_sessions(kill_sessions, wait=False)
+        registry.register(config.SESSION_ID, backend_name, container_name, selected_ports + userside_ports,
+                          rootdir=os.getcwd())
+        atexit.register(registry.release, config.SESSION_ID)
 
     # virtual environment
     os.environ["RADIOPADRE_VENV"] = config.RADIOPADRE_VENV
@@ -271,7 +287,8 @@ def run_radiopadre_server(command, arguments, notebook_path, workdir=None):
         os.environ["PUPPETEER_EXECUTABLE_PATH"] = chromium
 
     # init paths & environment
-    iglesia.init()
+    with profiler.phase("iglesia.init"):
+        iglesia.init()
     iglesia.set_userside_ports(userside_ports)
 
     global JUPYTER_OPTS
@@ -287,7 +304,8 @@ def run_radiopadre_server(command, arguments, notebook_path, workdir=None):
         os.environ.pop("RADIOPADRE_NBCONVERT", None)
 
     # update installation etc.
-    backend.update_installation()
+    with profiler.phase("backend.update_installation"):
+        backend.update_installation()
 
     # (when running natively (i.e. in a virtual environment), the notebook app doesn't pass the token to the browser
     # command properly... so let it pick its own token then)
@@ -358,7 +376,9 @@ def run_radiopadre_server(command, arguments, notebook_path, workdir=None):
         #     urls.append(url)
 
 
-    # now we're ready to start the session
+    # now we're ready to start the session, so hand off the reserved ports
+    if port_block is not None:
+        port_block.release()
 
     backend.start_session(container_name, selected_ports, userside_ports,
                           notebook_path, urls, run_browser=browser and run_browser)
@@ -0,0 +1,103 @@
+"""
+Management of the ssh master (ControlMaster) connection to a remote host.
+
+All ssh and scp commands to a host go through a single master connection (see ssh_mux_options()). SSHMux opens
+the master eagerly, so that the handshake (and any password prompt) happens up front rather than in the middle
+of the first remote command, checks it with "-O check", and keeps track of the port forwards it adds via
+"-O forward", so that these can be cancelled ("-O cancel") when the session exits. Otherwise the forwards
+would live on in the master until it expires, and keep the local ports occupied.
+"""
+import subprocess
+
+from iglesia.utils import message, warning, debug
+from . import config
+
+CHECK_TIMEOUT = 10
+
+
+def ssh_mux_options():
+    """Returns ssh options for connecting via the per-host multiplexing master connection"""
+    return f"-p {config.REMOTE_PORT} -o ControlPath=/tmp/ssh_mux_radiopadre_%C -o ControlMaster=auto -o ControlPersist=1h".split()
+
+
+class SSHMux(object):
+    """
+    Master ssh connection to a host.
+
+    :param host:    [user@]host
+    """
+    def __init__(self, host):
+        self.host = host
+        self.forwards = []      # list of "-L" specs added by forward()
+
+    def command(self, *args):
+        """Returns ssh command line running via the master, with the given extra arguments"""
+        return ["ssh"] + ssh_mux_options() + list(args) + [self.host]
+
+    def open_command(self, batch=False):
+        """Returns ssh command line opening the master. In batch mode, ssh fails rather than prompt for a password"""
+        return self.command("-M", "-N", "-f", *(["-o", "BatchMode=yes"] if batch else []))
+
+    def check(self):
+        """Returns True if the master connection is up"""
+        try:
+            return subprocess.call(self.command("-O", "check"), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, timeout=CHECK_TIMEOUT) == 0
+        except subprocess.TimeoutExpired:
+            return False
+
+    def open(self):
+        """Opens the master connection, if not already up. Returns True on success"""
+        if self.check():
+            debug(f"ssh master connection to {self.host} is up")
+            return True
+        message(f"Opening ssh connection to {self.host}. You may be prompted for your password.")
+        if subprocess.call(self.open_command()) != 0 or not self.check():
+            warning(f"unable to open ssh master connection to {self.host}")
+            return False
+        return True
+
+    def forward_command(self, forwards):
+        """Returns ssh command line asking the master to add the given "-L" forwards"""
+        return self.command("-O", "forward", *[arg for spec in forwards for arg in ("-L", spec)])
+
+    def add_forwards(self, forwards):
+        """Records forwards added via forward_command(), for cancel_forwards()"""
+        self.forwards += list(forwards)
+
+    def forward(self, forwards):
+        """Asks the master to add the given "-L" forwards. Returns True on success"""
+        if subprocess.call(self.forward_command(forwards), stdin=subprocess.DEVNULL) != 0:
+            return False
+        self.add_forwards(forwards)
+        return True
+
+    def cancel_forwards(self):
+        """Cancels all forwards added by us"""
+        if self.forwards:
+            debug(f"cancelling port forwards via ssh master connection to {self.host}")
+            cmd = self.command("-O", "cancel", *[arg for spec in self.forwards for arg in ("-L", spec)])
+            if subprocess.call(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL) != 0:
+                warning(f"failed to cancel port forwards to {self.host}")
+            self.forwards = []
+
+
+def warm(hosts, options):
+    """
+    Pre-establishes master connections to the given hosts (--ssh-warm)
+
+    :param hosts:   list of "[user@]host" strings (a trailing ":dir" is ignored)
+    :param options: parsed options
+    :return:        exit code: 0 if all connections are up
+    """
+    status = 0
+    for host in hosts:
+        host = host.split(":", 1)[0]
+        # picks up per-host settings such as REMOTE_PORT
+        config.init_specific_options(host, None, options)
+        if SSHMux(host).open():
+            message(f"ssh master connection to {host} is up, and will persist for an hour of inactivity")
+        else:
+            status = 1
+    return status